@@ -1,65 +1,33 @@
 import customtkinter as ctk
 import tkinter.messagebox
 import threading
+import multiprocessing
 import os
 import re
 from PIL import Image, ImageTk
 from io import BytesIO
-import requests
-from dotenv import load_dotenv, set_key
+from dotenv import set_key
 from danbooru_api import DanbooruClient
 from downloader import DownloadManager
 from cache_manager import ThumbnailCache
 from security import SecurityManager
+from config import load_settings
+from profiling import PROFILER, span, timed
+from tk_watchdog import TkWatchdog
+from metrics import start_metrics_server
+from transport import TRANSPORT
+from resume_manager import ResumeManager
+from sync_engine import SyncEngine
+from id_import import IdImporter, load_post_ids
+from layout import folder_layout, locate, iter_post_files
+from archive import archived_post_ids
+from library import LIBRARY_FILE, Library, QueryError, open_image
 
 ctk.set_appearance_mode("Dark")
 ctk.set_default_color_theme("blue")
 
 import json
 
-class ResumeManager:
-    def __init__(self, download_path, security_manager):
-        self.file_path = os.path.join(download_path, ".danbooru_resume.json")
-        self.security = security_manager
-        self.state = self.load()
-
-    def load(self):
-        if os.path.exists(self.file_path):
-            try:
-                with open(self.file_path, 'r', encoding='utf-8') as f:
-                    encrypted_data = f.read()
-                    decrypted_data = self.security.decrypt(encrypted_data)
-                    return json.loads(decrypted_data)
-            except:
-                pass
-        return {}
-
-    def save(self, query, top_id, last_page, is_complete):
-        data = {
-            "query": query,
-            "top_id": top_id,
-            "last_page": last_page,
-            "is_complete": is_complete,
-            "updated_at": str(os.path.getmtime(self.file_path)) if os.path.exists(self.file_path) else None
-        }
-        try:
-            json_str = json.dumps(data, indent=2)
-            encrypted_data = self.security.encrypt(json_str)
-            with open(self.file_path, 'w', encoding='utf-8') as f:
-                f.write(encrypted_data)
-        except Exception as e:
-            print(f"Error saving resume state: {e}")
-
-    def get_query(self):
-        return self.state.get("query")
-
-    def get_state(self):
-        return {
-            "top_id": self.state.get("top_id"),
-            "last_page": self.state.get("last_page", 1),
-            "is_complete": self.state.get("is_complete", False)
-        }
-
 class PostFrame(ctk.CTkFrame):
     def __init__(self, master, post, cache, selection_callback=None, on_load_finish=None, **kwargs):
         super().__init__(master, **kwargs)
@@ -149,7 +117,7 @@ class PostFrame(ctk.CTkFrame):
     def open_viewer(self):
         # Use large_file_url if available, else file_url, else fallback to preview
         target_url = self.post.get('large_file_url') or self.post.get('file_url') or self.preview_url
-        ImageViewer(self.winfo_toplevel(), target_url, self.id)
+        ImageViewer(self.winfo_toplevel(), target_url, self.id, local_post=self.post if self.post.get('local_folder') else None)
 
     def toggle_tags(self, event=None):
         if self.tags_display:
@@ -180,25 +148,42 @@ class PostFrame(ctk.CTkFrame):
 
     def _download_thumbnail(self):
         try:
+            if self.post.get('local_folder'):
+                # Local library result: its preview or the file itself, no network
+                with span("thumbnail.local"):
+                    source = open_image(self.post, preview=True)
+                    if source is None:
+                        raise FileNotFoundError(f"Post {self.id} isn't on disk any more")
+                    with Image.open(source) as img:
+                        img.thumbnail((100, 100))
+                        img = img.convert("RGBA")
+                    ctk_img = ctk.CTkImage(light_image=img, dark_image=img, size=img.size)
+                self.after(0, lambda: self._update_thumb_ui(ctk_img))
+                if self.on_load_finish: self.after(0, self.on_load_finish)
+                return
+
             # Check cache first
             cached_img = self.cache.load(self.id)
             if cached_img:
-                cached_img.thumbnail((100, 100))
-                ctk_img = ctk.CTkImage(light_image=cached_img, dark_image=cached_img, size=cached_img.size)
+                with span("thumbnail.decode"):
+                    cached_img.thumbnail((100, 100))
+                    ctk_img = ctk.CTkImage(light_image=cached_img, dark_image=cached_img, size=cached_img.size)
                 self.after(0, lambda: self._update_thumb_ui(ctk_img))
                 if self.on_load_finish: self.after(0, self.on_load_finish)
                 return
 
-            response = requests.get(self.preview_url, timeout=10)
+            with span("thumbnail.fetch"):
+                response = TRANSPORT.get("previews", self.preview_url)
             if response.status_code == 200:
                 img_data = BytesIO(response.content)
                 
                 # Save to cache
                 self.cache.save(self.id, img_data)
                 
-                img = Image.open(img_data)
-                img.thumbnail((100, 100))
-                ctk_img = ctk.CTkImage(light_image=img, dark_image=img, size=img.size)
+                with span("thumbnail.decode"):
+                    img = Image.open(img_data)
+                    img.thumbnail((100, 100))
+                    ctk_img = ctk.CTkImage(light_image=img, dark_image=img, size=img.size)
                 
                 self.after(0, lambda: self._update_thumb_ui(ctk_img))
                 if self.on_load_finish: self.after(0, self.on_load_finish)
@@ -220,13 +205,14 @@ class PostFrame(ctk.CTkFrame):
             pass
 
 class ImageViewer(ctk.CTkToplevel):
-    def __init__(self, parent, image_url, post_id):
+    def __init__(self, parent, image_url, post_id, local_post=None):
         super().__init__(parent)
         self.title(f"Image Viewer - {post_id}")
         self.geometry("800x800")
         
         self.image_url = image_url
         self.post_id = post_id
+        self.local_post = local_post
         
         self.canvas = ctk.CTkCanvas(self, bg="black", highlightthickness=0)
         self.canvas.pack(fill="both", expand=True)
@@ -257,10 +243,14 @@ class ImageViewer(ctk.CTkToplevel):
 
     def load_image(self):
         try:
-            response = requests.get(self.image_url, stream=True, timeout=30)
-            response.raise_for_status()
-            
-            img_data = BytesIO(response.content)
+            if self.local_post:
+                img_data = open_image(self.local_post)
+                if img_data is None:
+                    raise FileNotFoundError(f"Post {self.post_id} isn't on disk any more")
+            else:
+                response = TRANSPORT.get("files", self.image_url)
+                response.raise_for_status()
+                img_data = BytesIO(response.content)
             self.original_image = Image.open(img_data)
             
             self.after(0, self.fit_to_window)
@@ -287,6 +277,7 @@ class ImageViewer(ctk.CTkToplevel):
         
         self.redraw()
 
+    @timed("viewer.redraw")
     def redraw(self):
         if not self.original_image: return
         
@@ -414,7 +405,7 @@ class SettingsDialog(ctk.CTkToplevel):
     def __init__(self, parent, current_username, current_apikey, current_path, current_limit, current_safe_search, current_cache_days, current_cache_size, current_email):
         super().__init__(parent)
         self.title("Settings")
-        self.geometry("400x550")
+        self.geometry("400x650")
         self.parent = parent
         
         self.grid_columnconfigure(1, weight=1)
@@ -486,12 +477,29 @@ class SettingsDialog(ctk.CTkToplevel):
         except:
             current_max_workers = 8
         self.concurrency_entry.insert(0, str(current_max_workers))
+
+        # Auto mode: the value above is only the starting point
+        self.auto_concurrency_var = ctk.BooleanVar(value=getattr(self.parent, "auto_concurrency", False))
+        self.auto_concurrency_chk = ctk.CTkCheckBox(self, text="Auto", width=60, variable=self.auto_concurrency_var)
+        self.auto_concurrency_chk.grid(row=8, column=2, padx=10, pady=10)
         
         self.skip_download_confirmation = os.getenv("DANBOORU_SKIP_CONFIRMATION", "False").lower() == "true"
 
+        # Bandwidth limit (applied immediately, also to running downloads)
+        ctk.CTkLabel(self, text="Bandwidth Limit (KB/s, 0=Off):").grid(row=9, column=0, padx=10, pady=10, sticky="w")
+        self.bandwidth_entry = ctk.CTkEntry(self)
+        self.bandwidth_entry.grid(row=9, column=1, padx=10, pady=10, sticky="ew")
+        self.bandwidth_entry.insert(0, str(getattr(self.parent, "bandwidth_limit", 0)))
+
+        # Profiling (takes effect on next launch, like --profile)
+        ctk.CTkLabel(self, text="Profiling (next launch):").grid(row=10, column=0, padx=10, pady=10, sticky="w")
+        self.profiling_var = ctk.BooleanVar(value=getattr(self.parent, "profiling", False))
+        self.profiling_chk = ctk.CTkCheckBox(self, text="Enable", variable=self.profiling_var)
+        self.profiling_chk.grid(row=10, column=1, padx=10, pady=10, sticky="w")
+
         # Buttons Frame
         self.btn_frame = ctk.CTkFrame(self, fg_color="transparent")
-        self.btn_frame.grid(row=9, column=0, columnspan=3, padx=20, pady=20)
+        self.btn_frame.grid(row=11, column=0, columnspan=3, padx=20, pady=20)
 
         self.save_btn = ctk.CTkButton(self.btn_frame, text="Confirm", command=self.save_settings, fg_color="green", width=100)
         self.save_btn.pack(side="left", padx=10)
@@ -509,6 +517,7 @@ class SettingsDialog(ctk.CTkToplevel):
         self.cache_days_entry.bind("<FocusOut>", self.validate_cache_days)
         self.cache_size_entry.bind("<FocusOut>", self.validate_cache_size)
         self.concurrency_entry.bind("<FocusOut>", self.validate_concurrency)
+        self.bandwidth_entry.bind("<FocusOut>", self.validate_bandwidth)
 
     def validate_email(self, event=None):
         value = self.email_entry.get().strip()
@@ -559,6 +568,16 @@ class SettingsDialog(ctk.CTkToplevel):
             self.concurrency_entry.delete(0, "end")
             self.concurrency_entry.insert(0, "8")
 
+    def validate_bandwidth(self, event=None):
+        try:
+            val = int(self.bandwidth_entry.get())
+            if val < 0:
+                raise ValueError
+        except ValueError:
+            tkinter.messagebox.showwarning("Invalid Input", "Bandwidth Limit must be 0 (off) or a positive number of KB/s.")
+            self.bandwidth_entry.delete(0, "end")
+            self.bandwidth_entry.insert(0, "0")
+
     def browse_path(self):
         folder = ctk.filedialog.askdirectory()
         if folder:
@@ -609,7 +628,14 @@ class SettingsDialog(ctk.CTkToplevel):
             if max_workers > 32: max_workers = 32
         except:
             max_workers = 8
-        self.parent.update_settings(username, apikey, path, limit, safe_search, cache_days, cache_size, max_workers, email)
+
+        try:
+            bandwidth_limit = max(0, int(self.bandwidth_entry.get()))
+        except:
+            bandwidth_limit = 0
+        self.parent.update_settings(username, apikey, path, limit, safe_search, cache_days, cache_size, max_workers, email,
+                                    profiling=self.profiling_var.get(), bandwidth_limit=bandwidth_limit,
+                                    auto_concurrency=self.auto_concurrency_var.get())
         self.destroy()
 
 import sys
@@ -625,7 +651,7 @@ def resource_path(relative_path):
     return os.path.join(base_path, relative_path)
 
 class App(ctk.CTk):
-    def __init__(self, username=None, apikey=None):
+    def __init__(self, username=None, apikey=None, profile_mode=None, watchdog_ms=None, metrics_port=None, bandwidth_limit=None):
         super().__init__()
         self.title("Danbooru Downloader")
         self.geometry("1000x700")
@@ -637,45 +663,32 @@ class App(ctk.CTk):
             print(f"Failed to load icon: {e}")
         
         self.toplevel_window = None
-        load_dotenv()
         self.env_file = ".env"
         self.security = SecurityManager()
 
-        self.username = self.security.decrypt(os.getenv("DANBOORU_USERNAME")) or ""
-        self.apikey = self.security.decrypt(os.getenv("DANBOORU_APIKEY")) or ""
-        self.email = self.security.decrypt(os.getenv("DANBOORU_EMAIL")) or "unknown@example.com"
-        
-        # Encrypted Path
-        encrypted_path = os.getenv("DANBOORU_DOWNLOAD_PATH")
-        decrypted_path = self.security.decrypt(encrypted_path)
-        self.download_path = decrypted_path if decrypted_path else os.path.join(os.getcwd(), "downloads")
-
-        try:
-            self.preview_limit = int(os.getenv("DANBOORU_PREVIEW_LIMIT", "20"))
-        except:
-            self.preview_limit = 20
-        
-        # Encrypted Safe Search
-        encrypted_safe_search = os.getenv("DANBOORU_SAFE_SEARCH")
-        decrypted_safe_search = self.security.decrypt(encrypted_safe_search)
-        # Handle default (decrypted_safe_search might be empty if env missing)
-        safe_search_str = decrypted_safe_search if decrypted_safe_search else "False"
-        self.safe_search = safe_search_str.lower() == "true"
-        
-        try:
-            self.cache_days = int(os.getenv("DANBOORU_CACHE_DAYS", "7"))
-            self.cache_size = int(os.getenv("DANBOORU_CACHE_SIZE", "500"))
-        except:
-            self.cache_days = 7
-            self.cache_size = 500
-
-
-        try:
-            self.max_workers = int(os.getenv("DANBOORU_MAX_WORKERS", "8"))
-        except:
-            self.max_workers = 8
-
-        self.skip_download_confirmation = os.getenv("DANBOORU_SKIP_CONFIRMATION", "False").lower() == "true"
+        settings = load_settings(self.security)
+        self.username = settings["username"]
+        self.apikey = settings["apikey"]
+        self.email = settings["email"]
+        self.download_path = settings["download_path"]
+        self.preview_limit = settings["preview_limit"]
+        self.safe_search = settings["safe_search"]
+        self.cache_days = settings["cache_days"]
+        self.cache_size = settings["cache_size"]
+        self.max_workers = settings["max_workers"]
+        self.api_rate = settings["api_rate"]
+        self.enum_partitions = settings["enum_partitions"]
+        self.bandwidth_limit = bandwidth_limit if bandwidth_limit is not None else settings["bandwidth_limit"]
+        self.auto_concurrency = settings["auto_concurrency"]
+        self.transfer_settings = {k: settings[k] for k in ("stall_min_rate", "stall_window", "hedge_percentile", "layout",
+                                                          "dedup", "content_index", "archive_format", "archive_shard_mb",
+                                                          "write_chunk_kb", "write_buffer_kb", "preallocate", "direct_io", "fsync",
+                                                          "postprocess", "postprocess_workers", "metadata_sidecar")}
+        self.skip_download_confirmation = settings["skip_download_confirmation"]
+        self.profiling = settings["profiling"]
+
+        if profile_mode or self.profiling:
+            PROFILER.start(profile_mode or "spans")
 
         self.history_file = "search_history.json"
         self.search_history = self.load_history()
@@ -683,14 +696,23 @@ class App(ctk.CTk):
         self.cache = ThumbnailCache(max_days=self.cache_days, max_size_mb=self.cache_size)
         threading.Thread(target=self.cache.cleanup, daemon=True).start()
 
-        self.api = DanbooruClient(self.username, self.apikey, self.username, self.email)
-        self.downloader = DownloadManager(max_workers=self.max_workers)
+        TRANSPORT.apply_settings(settings)
+        self.api = DanbooruClient(self.username, self.apikey, self.username, self.email, rate_limit=self.api_rate)
+        self.downloader = self._create_downloader()
+        # Every thumbnail of a page loads at once; open the connections before the first search
+        TRANSPORT.ensure_pool_size("previews", self.preview_limit)
+        TRANSPORT.warmup("api", self.api.BASE_URL)
+        TRANSPORT.warmup("previews", self.api.CDN_URL, connections=min(self.preview_limit, 8))
         self.posts_frames = {} 
         self.selected_posts_data = {} # Persistence for selections: id -> post_data
         self.current_page = 1
         self.total_pages = 1
         self.total_posts = 0
         self.current_tags = ""
+        self.search_id = 0
+        self.page_loading = False
+        self.local_search = False
+        self.library = None
 
 
         self.bind("<Button-1>", self.on_global_click)
@@ -698,9 +720,37 @@ class App(ctk.CTk):
         self._setup_ui()
         self.after(500, self.check_visibility)
 
+        self.watchdog = None
+        watchdog_ms = watchdog_ms if watchdog_ms is not None else settings["ui_watchdog_ms"]
+        if watchdog_ms:
+            self.watchdog = TkWatchdog(self, threshold_ms=watchdog_ms, log_path="ui_stalls.log").install()
+
+        metrics_port = metrics_port if metrics_port is not None else settings["metrics_port"]
+        if metrics_port:
+            try:
+                start_metrics_server(metrics_port)
+            except OSError as e:
+                print(f"Failed to start metrics server on port {metrics_port}: {e}")
+
+    def _create_downloader(self):
+        downloader = DownloadManager(max_workers=self.max_workers, bandwidth_limit=self.bandwidth_limit * 1024,
+                                     auto_concurrency=self.auto_concurrency,
+                                     autotune_log="autotune_log.jsonl" if self.auto_concurrency else None)
+        downloader.apply_settings(self.transfer_settings)
+        return downloader
+
     def on_closing(self):
         if self.downloader:
             self.downloader.stop_all()
+            self.downloader.close()
+        if self.library:
+            self.library.close()
+        if PROFILER.enabled:
+            PROFILER.stop()
+            PROFILER.write_report()
+        if self.watchdog:
+            self.watchdog.uninstall()
+            print(self.watchdog.summary())
         self.destroy()
 
     def on_global_click(self, event):
@@ -713,6 +763,7 @@ class App(ctk.CTk):
         except:
             pass
 
+    @timed("ui.check_visibility")
     def check_visibility(self):
         try:
             # Scrollable frame visible area
@@ -745,18 +796,16 @@ class App(ctk.CTk):
 
         self.after(300, self.check_visibility)
 
+    @timed("ui.local_file_count")
     def update_local_file_count(self):
-        try:
-            if not os.path.exists(self.download_path):
-                self.local_files_label.configure(text="Local Files: 0")
-                return
+        # The scan walks the layout's subfolders; keep it off the Tk thread
+        threading.Thread(target=self._count_local_files, args=(self.download_path,), daemon=True).start()
 
+    def _count_local_files(self, path):
+        try:
             count = 0
-            with os.scandir(self.download_path) as entries:
-                for entry in entries:
-                     if entry.is_file() and re.match(r"^\d+\..+$", entry.name):
-                        count += 1
-            
+            if os.path.exists(path):
+                count = sum(1 for _ in iter_post_files(path)) + len(archived_post_ids(path))
             self.after(0, lambda: self.local_files_label.configure(text=f"Local Files: {count}"))
         except Exception as e:
             print(f"Error counting local files: {e}")
@@ -795,22 +844,30 @@ class App(ctk.CTk):
 
         self.search_btn = ctk.CTkButton(self.sidebar, text="Search", command=self.start_search)
         self.search_btn.grid(row=3, column=0, padx=20, pady=10)
+
+        # Search the downloaded posts (local library) instead of Danbooru
+        self.local_search_var = ctk.BooleanVar(value=False)
+        self.local_search_chk = ctk.CTkCheckBox(self.sidebar, text="Search Downloaded", variable=self.local_search_var)
+        self.local_search_chk.grid(row=4, column=0, padx=20, pady=(0, 10))
+
+        self.import_ids_btn = ctk.CTkButton(self.sidebar, text="Import IDs", command=self.start_id_import, fg_color="gray")
+        self.import_ids_btn.grid(row=5, column=0, padx=20, pady=10)
         
         # Spacer to push buttons to bottom
-        self.sidebar.grid_rowconfigure(4, weight=1)
+        self.sidebar.grid_rowconfigure(6, weight=1)
 
         self.download_btn = ctk.CTkButton(self.sidebar, text="Download", command=self.start_download_selected, state="disabled", fg_color="green")
-        self.download_btn.grid(row=5, column=0, padx=20, pady=10)
+        self.download_btn.grid(row=7, column=0, padx=20, pady=10)
 
         self.open_folder_btn = ctk.CTkButton(self.sidebar, text="Open Folder", command=self.open_download_folder, fg_color="gray")
-        self.open_folder_btn.grid(row=6, column=0, padx=20, pady=10)
+        self.open_folder_btn.grid(row=8, column=0, padx=20, pady=10)
 
         # Global Key Bindings
         self.bind("q", self.focus_tags_entry)
         self.bind("Q", self.focus_tags_entry)
 
         self.path_label = ctk.CTkLabel(self.sidebar, text=f"Path: ...{self.download_path[-20:]}", font=ctk.CTkFont(size=10))
-        self.path_label.grid(row=7, column=0, padx=5, pady=5)
+        self.path_label.grid(row=9, column=0, padx=5, pady=5)
 
         # Top Bar
         self.top_bar = ctk.CTkFrame(self, height=50, corner_radius=0)
@@ -917,15 +974,17 @@ class App(ctk.CTk):
         else:
             self.toplevel_window.focus()
 
-    def update_settings(self, username, apikey, path, limit, safe_search, cache_days, cache_size, max_workers, email):
+    def update_settings(self, username, apikey, path, limit, safe_search, cache_days, cache_size, max_workers, email, profiling=False, bandwidth_limit=0, auto_concurrency=False):
         self.username = username
         self.apikey = apikey
         self.download_path = path
         self.preview_limit = limit
+        TRANSPORT.ensure_pool_size("previews", limit)
         self.safe_search = safe_search
         self.cache_days = cache_days
         self.cache_size = cache_size
         self.email = email
+        self.profiling = profiling
         
         # Update cache settings
         self.cache.max_days = cache_days
@@ -935,12 +994,20 @@ class App(ctk.CTk):
         self.path_label.configure(text=f"Path: {display_path}")
         self.update_local_file_count()
         
-        self.api = DanbooruClient(self.username, self.apikey, self.username, self.email)
+        self.api = DanbooruClient(self.username, self.apikey, self.username, self.email, rate_limit=self.api_rate)
 
-        # Update Downloader if max_workers changed
-        if max_workers != self.max_workers:
+        # Update Downloader if max_workers or auto mode changed
+        self.bandwidth_limit = bandwidth_limit
+        if max_workers != self.max_workers or auto_concurrency != self.auto_concurrency:
             self.max_workers = max_workers
-            self.downloader = DownloadManager(max_workers=self.max_workers)
+            self.auto_concurrency = auto_concurrency
+            if self.downloader.tuner:
+                self.downloader.tuner.stop()
+            # Let the old one finish its post-processing queue without holding up the UI
+            threading.Thread(target=self.downloader.close, daemon=True).start()
+            self.downloader = self._create_downloader()
+        else:
+            self.downloader.set_bandwidth_limit(self.bandwidth_limit * 1024)
 
         if not os.path.exists(self.env_file):
             open(self.env_file, 'w').close()
@@ -954,6 +1021,9 @@ class App(ctk.CTk):
         set_key(self.env_file, "DANBOORU_CACHE_DAYS", str(cache_days))
         set_key(self.env_file, "DANBOORU_CACHE_SIZE", str(cache_size))
         set_key(self.env_file, "DANBOORU_MAX_WORKERS", str(max_workers))
+        set_key(self.env_file, "DANBOORU_PROFILE", str(profiling))
+        set_key(self.env_file, "DANBOORU_BANDWIDTH_LIMIT", str(bandwidth_limit))
+        set_key(self.env_file, "DANBOORU_AUTO_CONCURRENCY", str(auto_concurrency))
         
         # Also update the skip confirmation setting while we are here, to be safe, 
         # although it's usually updated separately.
@@ -1013,6 +1083,7 @@ class App(ctk.CTk):
         except Exception as e:
             print(f"Error saving history: {e}")
 
+    @timed("ui.update_history")
     def update_history(self, query):
         if not query: return
         
@@ -1056,7 +1127,7 @@ class App(ctk.CTk):
         self.update_download_button_state()
 
     def update_download_button_state(self):
-        if len(self.selected_posts_data) > 0:
+        if len(self.selected_posts_data) > 0 and not self.local_search: # local results are downloaded already
             self.download_btn.configure(state="normal", text=f"Download ({len(self.selected_posts_data)})")
         else:
             self.download_btn.configure(state="disabled", text="Download")
@@ -1068,11 +1139,16 @@ class App(ctk.CTk):
     def start_search(self):
         self.current_tags = self.tags_entry.get().lower().strip()
         self.update_history(self.current_tags)
+        self.local_search = self.local_search_var.get()
         
-        if self.safe_search:
+        if self.safe_search and not self.local_search: # the library applies it as a rating filter
             self.current_tags += " is:sfw "
             
         self.current_page = 1
+        self.total_pages = 1
+        self.total_posts = 0
+        self.search_id += 1
+        self.page_loading = True
         self.selected_posts_data.clear() 
         self.select_all_chk.deselect()
         self.update_download_button_state()
@@ -1092,19 +1168,66 @@ class App(ctk.CTk):
         threading.Thread(target=self._search_thread_init, daemon=True).start()
 
     def _search_thread_init(self):
-        # Fetch count first
+        # Fetch the count and the first page at the same time; the page label
+        # is filled in whenever the count arrives.
+        search_id = self.search_id
+        if self.local_search:
+            try:
+                self._update_library()
+            except Exception as e:
+                print(f"Library update error: {e}")
+                if not self.library:
+                    self.after(0, self._on_search_error, f"Couldn't open the local library: {e}", search_id)
+                    return
+                # Opened but the import failed: search what it holds already
+        threading.Thread(target=self._count_thread, args=(self.current_tags, search_id), daemon=True).start()
+        self._search_thread()
+
+    def _update_library(self):
+        """Open the download folder's library and import what was downloaded since the last search."""
+        path = os.path.join(self.download_path, LIBRARY_FILE)
+        if self.library and self.library.path != path:
+            self.library.close()
+            self.library = None
+        if not self.library:
+            os.makedirs(self.download_path, exist_ok=True)
+            self.library = Library(path)
+        with span("library.update"):
+            imported = self.library.update(self.download_path)
+        if imported:
+            print(f"Library: {imported} posts imported")
+
+    def _count_thread(self, tags, search_id):
         try:
-            total_posts = self.api.get_post_counts(self.current_tags)
-            self.total_posts = total_posts
-            import math
-            self.total_pages = math.ceil(total_posts / self.preview_limit)
-            if self.total_pages < 1: self.total_pages = 1
-            self.after(0, lambda: self.total_pages_label.configure(text=f"/ {self.total_pages}"))
+            if self.local_search:
+                total_posts = self.library.count(tags, exclude_ratings=self._local_excluded_ratings())
+            else:
+                total_posts = self.api.get_post_counts(tags)
         except:
+            total_posts = None
+        self.after(0, self._on_post_count, total_posts, search_id)
+
+    def _on_post_count(self, total_posts, search_id):
+        if search_id != self.search_id:
+            return # A newer search has started
+
+        if total_posts is None:
             self.total_pages = 1
-            self.after(0, lambda: self.total_pages_label.configure(text="/ ?"))
+            self.total_pages_label.configure(text="/ ?")
+            return
 
-        self._search_thread()
+        import math
+        self.total_posts = total_posts
+        self.total_pages = math.ceil(total_posts / self.preview_limit)
+        if self.total_pages < 1: self.total_pages = 1
+        self.total_pages_label.configure(text=f"/ {self.total_pages}")
+
+        # If the page already finished loading, catch up on what depended on the count
+        if not self.page_loading:
+            if self.current_page < self.total_pages:
+                self.next_btn.configure(state="normal")
+            if not getattr(self, 'render_task', None):
+                self.scrollable_frame.configure(label_text=f"Results ({self.total_posts:,})")
 
     def prev_page(self):
         if self.current_page > 1:
@@ -1130,6 +1253,7 @@ class App(ctk.CTk):
             self.page_entry.insert(0, str(self.current_page))
 
     def _load_page(self):
+        self.page_loading = True
         self.prev_btn.configure(state="disabled")
         self.next_btn.configure(state="disabled")
         self.go_btn.configure(state="disabled")
@@ -1169,12 +1293,21 @@ class App(ctk.CTk):
         if self.images_loaded_count >= self.images_to_load_total:
             self.loading_overlay.grid_forget()
 
+    @timed("search.fetch_page")
     def _search_thread(self):
+        search_id = self.search_id
         try:
-            posts = self.api.fetch_posts(self.current_tags, limit=self.preview_limit, page=self.current_page)
+            if self.local_search:
+                with span("library.search"):
+                    posts = self.library.search(self.current_tags, limit=self.preview_limit,
+                                                offset=(self.current_page - 1) * self.preview_limit,
+                                                exclude_ratings=self._local_excluded_ratings())
+            else:
+                posts = self.api.fetch_posts(self.current_tags, limit=self.preview_limit, page=self.current_page, only="browse")
             
             # Filter posts that have file_url (others are skipped in display)
-            valid_posts = [p for p in posts if 'file_url' in p]
+            # With only= projections the key can be present but null, so check the value
+            valid_posts = [p for p in posts if p.get('file_url') or p.get('local_folder')]
             self.images_to_load_total = len(valid_posts)
             self.images_loaded_count = 0
             
@@ -1182,11 +1315,31 @@ class App(ctk.CTk):
                  self.after(0, lambda: self.loading_overlay.grid_forget())
 
             self.after(0, self._display_results, posts)
+        except QueryError as e:
+            self.after(0, self._on_search_error, f"Invalid query: {e}", search_id)
         except Exception as e:
             print(f"Search error: {e}")
-            self.after(0, lambda: self.loading_overlay.grid_forget())
+            if self.local_search:
+                self.after(0, self._on_search_error, f"Local search failed: {e}", search_id)
+            else:
+                self.after(0, lambda: self.loading_overlay.grid_forget())
+
+    def _local_excluded_ratings(self):
+        return "qe" if self.safe_search else "" # what is:sfw leaves out
+
+    def _on_search_error(self, message, search_id):
+        if search_id != self.search_id:
+            return # A newer search has started
+        self.page_loading = False
+        self.loading_overlay.grid_forget()
+        self.search_btn.configure(text="Search", state="normal")
+        self.go_btn.configure(state="normal")
+        self.total_pages_label.configure(text="/ 1")
+        self.scrollable_frame.configure(label_text="Results")
+        tkinter.messagebox.showerror("Search Error", message)
 
     def _display_results(self, posts):
+        self.page_loading = False
         self._clear_results()
         # Incremental Rendering to prevent UI freeze
         # Render a small batch, then schedule the next batch
@@ -1209,11 +1362,13 @@ class App(ctk.CTk):
         # Start rendering
         self._render_batch(posts, 0)
         
+    @timed("ui.render_batch")
     def _render_batch(self, posts, index, batch_size=5):
         # Stop if index is out of bounds
         if index >= len(posts):
             self.render_task = None
-            self.scrollable_frame.configure(label_text=f"Results ({self.total_posts:,})")
+            # total_posts stays 0 until the count request comes back
+            self.scrollable_frame.configure(label_text=f"Results ({self.total_posts:,})" if self.total_posts else "Results")
             return
 
         end_index = min(index + batch_size, len(posts))
@@ -1221,7 +1376,7 @@ class App(ctk.CTk):
         
         # Render current batch
         for post in batch:
-            if 'file_url' not in post:
+            if not post.get('file_url') and not post.get('local_folder'):
                 continue
             
             # Safety check
@@ -1323,6 +1478,74 @@ class App(ctk.CTk):
         self.bulk_download_btn.configure(state="disabled", text="Starting...")
         threading.Thread(target=self._bulk_download_thread, daemon=True).start()
 
+    def start_id_import(self):
+        id_file = ctk.filedialog.askopenfilename(title="Import Post IDs", filetypes=[("ID lists", "*.txt *.csv"), ("All files", "*.*")])
+        if not id_file:
+            return
+
+        try:
+            post_ids = load_post_ids(id_file)
+        except Exception as e:
+            tkinter.messagebox.showerror("Import Error", f"Could not read {id_file}:\n{e}")
+            return
+
+        if not post_ids:
+            tkinter.messagebox.showinfo("No IDs", "No post IDs found in this file.")
+            return
+
+        if not getattr(self, "skip_download_confirmation", False):
+             dialog = ConfirmationDialog(self, "Confirm Import", f"File: {os.path.basename(id_file)}\nPost IDs: {len(post_ids):,}\n\nDo you want to proceed with the download?")
+             if not dialog.result:
+                 return
+
+             if dialog.dont_ask_again:
+                 self.skip_download_confirmation = True
+                 self.update_settings_confirmation_skip(True)
+
+        self.import_ids_btn.configure(state="disabled")
+        self.bulk_download_btn.configure(state="disabled", text="Starting...")
+        threading.Thread(target=self._id_import_thread, args=(post_ids,), daemon=True).start()
+
+    def _id_import_thread(self, post_ids):
+        self.downloader.stop_event.clear() # Reset stop flag
+        self.after(0, lambda: self.pause_btn.configure(state="normal"))
+        self.after(0, lambda: self.cancel_btn.configure(state="normal"))
+
+        importer = IdImporter(self.api, self.downloader, self.download_path, "is:sfw" if self.safe_search else "")
+        downloaded_count = 0
+        status_text = "IDs: 0"
+
+        def on_item_complete(path, skipped):
+            nonlocal downloaded_count
+            downloaded_count += 1
+            self.after(0, lambda: self.bulk_download_btn.configure(text=f"Downloading ({downloaded_count})"))
+            self.after(0, lambda: self.progress_label.configure(text=f"{status_text} | Downloaded: {downloaded_count}"))
+
+        def on_item_error(err):
+            print(f"ID import error: {err}")
+
+        def on_status(text):
+            nonlocal status_text
+            status_text = text
+            self.after(0, lambda t=text, c=downloaded_count: self.progress_label.configure(text=f"{t} | Downloaded: {c}"))
+
+        stats = importer.run(post_ids, {
+            'on_progress': None,
+            'on_complete': on_item_complete,
+            'on_error': on_item_error,
+            'on_status': on_status
+        })
+        print(f"ID import finished: {stats}")
+
+        self.after(0, lambda: self.import_ids_btn.configure(state="normal"))
+        self.after(0, lambda: self.bulk_download_btn.configure(state="normal", text="Download All"))
+        self.after(0, lambda: self.pause_btn.configure(state="disabled"))
+        self.after(0, lambda: self.cancel_btn.configure(state="disabled"))
+        if not self.downloader.stop_event.is_set():
+             self.after(0, lambda: self.progress_label.configure(
+                 text=f"Completed: {downloaded_count} files | Already had: {stats['already_present']} | Unavailable: {stats['missing']}"))
+             self.update_local_file_count()
+
     def toggle_pause(self):
         is_paused = self.downloader.toggle_pause()
         if is_paused:
@@ -1334,6 +1557,7 @@ class App(ctk.CTk):
         self.downloader.stop_all()
         self.download_btn.configure(state="normal")
         self.bulk_download_btn.configure(state="normal", text="Download All")
+        self.import_ids_btn.configure(state="normal")
         self.pause_btn.configure(state="disabled", text="Pause", fg_color="orange")
         self.cancel_btn.configure(state="disabled")
         self.progress_label.configure(text="Cancelled")
@@ -1354,6 +1578,7 @@ class App(ctk.CTk):
         total = len(posts_to_download)
         completed = 0
         
+        layout = folder_layout(self.download_path, self.downloader.layout)
         futures = []
         for post in posts_to_download:
             if self.downloader.stop_event.is_set(): break
@@ -1363,8 +1588,7 @@ class App(ctk.CTk):
             if not frame: continue
             
             file_url = post.get('file_url')
-            file_ext = post.get('file_ext', 'jpg')
-            save_path = os.path.join(self.download_path, f"{pid}.{file_ext}")
+            save_path = locate(self.download_path, post, layout)
             
             frame.set_status("Downloading...", "orange")
             
@@ -1396,12 +1620,15 @@ class App(ctk.CTk):
                 save_path,
                 on_progress,
                 on_complete,
-                on_error
+                on_error,
+                post.get('file_size'),
+                post.get('md5')
             )
             futures.append(future)
 
         for f in futures:
             f.result()
+        self.downloader.flush() # with the "batch" fsync policy, files are moved into place here
             
         self.after(0, lambda: self.download_btn.configure(state="normal", text=f"Download ({len(self.selected_posts_data)})"))
         self.after(0, lambda: self.pause_btn.configure(state="disabled"))
@@ -1416,135 +1643,36 @@ class App(ctk.CTk):
         self.after(0, lambda: self.pause_btn.configure(state="normal"))
         self.after(0, lambda: self.cancel_btn.configure(state="normal"))
         
-        resume_mgr = ResumeManager(self.download_path, self.security)
-        stored_query = resume_mgr.get_query()
-        saved_state = resume_mgr.get_state()
-        saved_top_id = saved_state.get("top_id")
-        saved_last_page = saved_state.get("last_page")
-        saved_is_complete = saved_state.get("is_complete")
-        
-        saved_last_page = saved_state.get("last_page")
-        saved_is_complete = saved_state.get("is_complete")
-        
         # Query Mismatch Check REMOVED (Handled in start_bulk_download)
+        resume_mgr = ResumeManager(self.download_path, self.security)
+        engine = SyncEngine(self.api, self.downloader, self.download_path, resume_mgr, partitions=self.enum_partitions)
 
+        # If repair mode is ON, we ignore resume logic and scan everything.
+        # If repair mode is OFF, we only fetch the id ranges we don't have yet.
         repair_mode = self.repair_mode_var.get()
-        page = 1
-        limit = 100 
         downloaded_count = 0
-        
-        # Runtime State
-        current_run_top_id = None
-        gap_bridged = False
-        
-        # If repair mode is ON, we ignore resume logic and scan everything.
-        # If repair mode is OFF, we use Smart Resume.
-        
-        if not repair_mode and saved_last_page and saved_last_page > 1:
-            # We start at page 1 to check for new posts, but we know we have a jump target.
-            pass
-        elif not repair_mode and saved_is_complete:
-            # We just check for new posts.
-            pass
+        status_text = "Page: 0"
         
         def on_item_complete(path, skipped):
             nonlocal downloaded_count
             downloaded_count += 1
             self.after(0, lambda: self.bulk_download_btn.configure(text=f"Downloading ({downloaded_count})"))
-            self.after(0, lambda: self.progress_label.configure(text=f"Page: {page} | Downloaded: {downloaded_count}"))
+            self.after(0, lambda: self.progress_label.configure(text=f"{status_text} | Downloaded: {downloaded_count}"))
 
         def on_item_error(err):
             print(f"Bulk download error: {err}")
 
-        while True:
-            if self.downloader.stop_event.is_set(): break
-            
-            # Wait if paused (blocks here until resumed)
-            self.downloader.pause_event.wait()
-            
-            self.after(0, lambda p=page, c=downloaded_count: self.bulk_download_btn.configure(text=f"Downloading ({c})"))
-            self.after(0, lambda p=page, c=downloaded_count: self.progress_label.configure(text=f"Page: {p} | Downloaded: {c}"))
-            
-            try:
-                posts = self.api.fetch_posts(self.current_tags, limit=limit, page=page)
-                if not posts:
-                    # End of results
-                    if not repair_mode:
-                        # Mark as complete only if we reached the end naturally
-                        resume_mgr.save(self.current_tags, current_run_top_id or saved_top_id, page, True)
-                    break
-                
-                # Capture top_id of this run (first post of first page)
-                if current_run_top_id is None and len(posts) > 0:
-                    current_run_top_id = posts[0]['id']
-
-                # Smart Resume Logic (Gap Bridge)
-                if not repair_mode and not gap_bridged and saved_top_id:
-                    # Check if we bridged the gap
-                    bridge_index = -1
-                    for i, post in enumerate(posts):
-                        if post['id'] == saved_top_id:
-                            bridge_index = i
-                            break
-                    
-                    if bridge_index != -1:
-                        print(f"Gap bridged at ID {saved_top_id} (Page {page})")
-                        gap_bridged = True
-                        
-                        # If we were already complete, we can stop here (after downloading new posts)
-                        if saved_is_complete:
-                            # Download new posts (before the bridge)
-                            new_posts = posts[:bridge_index]
-                            if new_posts:
-                                batch_futures = self.downloader.start_download_batch(
-                                    new_posts, 
-                                    self.download_path, 
-                                    {'on_progress': None, 'on_complete': on_item_complete, 'on_error': on_item_error}
-                                )
-                                for f in batch_futures: f.result()
-                            
-                            print("Already complete, stopping.")
-                            # Update top_id to new one
-                            resume_mgr.save(self.current_tags, current_run_top_id, saved_last_page, True)
-                            break
-                        else:
-                            # Not complete, so we download new posts, then JUMP.
-                            new_posts = posts[:bridge_index]
-                            if new_posts:
-                                batch_futures = self.downloader.start_download_batch(
-                                    new_posts, 
-                                    self.download_path, 
-                                    {'on_progress': None, 'on_complete': on_item_complete, 'on_error': on_item_error}
-                                )
-                                for f in batch_futures: f.result()
-                            
-                            # JUMP
-                            if saved_last_page > page:
-                                msg = f"Gap found! Jumping to page {saved_last_page}..."
-                                print(msg)
-                                self.after(0, lambda m=msg: self.progress_label.configure(text=m))
-                                page = saved_last_page
-                                continue
-                            
-                # Normal Download
-                batch_futures = self.downloader.start_download_batch(
-                    posts, 
-                    self.download_path, 
-                    {'on_progress': None, 'on_complete': on_item_complete, 'on_error': on_item_error}
-                )
-                for f in batch_futures: 
-                    if self.downloader.stop_event.is_set(): break
-                    f.result()
-                
-                # Save state after each page
-                if not repair_mode:
-                    resume_mgr.save(self.current_tags, current_run_top_id or saved_top_id, page, False)
-                
-                page += 1
-                
-            except Exception as e:
-                print(f"Bulk download loop error: {e}")
-                break
+        def on_status(text):
+            nonlocal status_text
+            status_text = text
+            self.after(0, lambda t=text, c=downloaded_count: self.progress_label.configure(text=f"{t} | Downloaded: {c}"))
+
+        engine.run(self.current_tags, repair_mode, {
+            'on_progress': None,
+            'on_complete': on_item_complete,
+            'on_error': on_item_error,
+            'on_status': on_status
+        })
 
         self.after(0, lambda: self.bulk_download_btn.configure(state="normal", text="Download All"))
         self.after(0, lambda: self.pause_btn.configure(state="disabled"))
@@ -1555,11 +1683,21 @@ class App(ctk.CTk):
              self.update_local_file_count()
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support() # post-processing and sharded workers re-enter the frozen exe
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--username", help="Danbooru Username")
     parser.add_argument("--apikey", help="Danbooru API Key")
+    parser.add_argument("--profile", nargs="?", const="spans", choices=["spans", "cprofile", "sampling"],
+                        help="Time key code paths and write a report on exit (optionally with cProfile or stack sampling)")
+    parser.add_argument("--watchdog", nargs="?", type=int, const=200, metavar="MS",
+                        help="Log UI stalls longer than MS milliseconds (default 200) with a stack sample")
+    parser.add_argument("--metrics-port", type=int, metavar="PORT",
+                        help="Serve Prometheus metrics on http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--bandwidth-limit", type=int, metavar="KBPS",
+                        help="Cap total download speed in KB/s (overrides the setting for this session; 0 = off)")
     args = parser.parse_args()
 
-    app = App(username=args.username, apikey=args.apikey)
+    app = App(username=args.username, apikey=args.apikey, profile_mode=args.profile, watchdog_ms=args.watchdog,
+              metrics_port=args.metrics_port, bandwidth_limit=args.bandwidth_limit)
     app.mainloop()
@@ -0,0 +1,325 @@
+"""
+Archive output: bulk downloads stored in zip or tar shards instead of
+millions of loose files.
+
+Each finished file is appended to the folder's current shard
+(posts-00001.zip, posts-00002.zip, ...) and a new shard is started once it
+reaches the shard size. A sidecar index (.danbooru_archive.db, sqlite)
+maps every post id to its shard, member name and the offset of its bytes
+in the shard, so skip/resume checks never open an archive and a post can
+be read back with one seek. Members are stored uncompressed; images are
+compressed already.
+
+Shards are finalized (zip central directory, tar end blocks) after every
+page, so they are valid archives for any zip/tar tool between pages. A
+shard left open by a crash is repaired when it is next written to:
+anything after the last indexed member is dropped and downloaded again.
+One writer per shard prefix; processes sharing a folder use different
+prefixes. Given the DownloadManager's DiskWriter, shards follow its fsync
+policy: "file" fsyncs every member before it is indexed, "batch" fsyncs
+the shard when it is finalized at the end of a page.
+
+    python archive.py D:\\Mirror\\miku            # list shards
+    python archive.py D:\\Mirror\\miku --extract 7231234 out.jpg
+"""
+import os
+import re
+import time
+import shutil
+import sqlite3
+import struct
+import tarfile
+import zipfile
+import threading
+
+INDEX_FILE = ".danbooru_archive.db"
+FORMATS = ("zip", "tar")
+DEFAULT_SHARD_SIZE = 1024 * 1024 * 1024
+
+MEMBER_PATTERN = re.compile(r"^(\d+)\.\w+$")
+COPY_BUFFER = 1048576
+
+def _post_id(name):
+    match = MEMBER_PATTERN.match(name)
+    if not match:
+        raise ValueError(f"Not a post file name: {name!r}")
+    return int(match.group(1))
+
+class ArchiveIndex:
+    """The sidecar index of a folder's shards; safe to share between threads and processes."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, INDEX_FILE)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS members (
+                id INTEGER PRIMARY KEY,
+                shard TEXT NOT NULL,
+                name TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                md5 TEXT,
+                added_at REAL
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS shards (
+                name TEXT PRIMARY KEY,
+                prefix TEXT NOT NULL,
+                format TEXT NOT NULL,
+                end_offset INTEGER NOT NULL DEFAULT 0,
+                finished INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS members_shard ON members (shard)")
+        self.conn.commit()
+
+    def contains(self, post_id):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM members WHERE id = ?", (post_id,)).fetchone() is not None
+
+    def post_ids(self):
+        with self.lock:
+            return {row[0] for row in self.conn.execute("SELECT id FROM members")}
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM members").fetchone()[0]
+
+    def lookup(self, post_id):
+        """(shard, member name, offset, size) or None."""
+        with self.lock:
+            return self.conn.execute("SELECT shard, name, offset, size FROM members WHERE id = ?", (post_id,)).fetchone()
+
+    def read(self, post_id):
+        """The post's file content, or None if it isn't archived here."""
+        entry = self.lookup(post_id)
+        if not entry:
+            return None
+        shard, _, offset, size = entry
+        with open(os.path.join(self.folder, shard), 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def shards(self):
+        """[(name, format, end_offset, finished, members)]"""
+        with self.lock:
+            return self.conn.execute("""
+                SELECT s.name, s.format, s.end_offset, s.finished, COUNT(m.id)
+                FROM shards s LEFT JOIN members m ON m.shard = s.name
+                GROUP BY s.name ORDER BY s.name
+            """).fetchall()
+
+    def members(self, shard):
+        """[(post id, name, offset, size, md5)] of shard, in file order."""
+        with self.lock:
+            return self.conn.execute("SELECT id, name, offset, size, md5 FROM members WHERE shard = ? ORDER BY offset",
+                                     (shard,)).fetchall()
+
+    def open_shard(self, prefix, fmt):
+        """The prefix's unfinished shard as (name, end_offset), creating the next one if there is none."""
+        with self.lock:
+            row = self.conn.execute("SELECT name, end_offset FROM shards WHERE prefix = ? AND format = ? AND finished = 0 "
+                                    "ORDER BY name DESC LIMIT 1", (prefix, fmt)).fetchone()
+            if row:
+                return row
+            number = self.conn.execute("SELECT COUNT(*) FROM shards WHERE prefix = ?", (prefix,)).fetchone()[0] + 1
+            name = f"{prefix}-{number:05d}.{fmt}"
+            self.conn.execute("INSERT INTO shards (name, prefix, format) VALUES (?, ?, ?)", (name, prefix, fmt))
+            self.conn.commit()
+            return name, 0
+
+    def add(self, post_id, shard, name, offset, size, md5, end_offset):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO members (id, shard, name, offset, size, md5, added_at) "
+                              "VALUES (?, ?, ?, ?, ?, ?, ?)", (post_id, shard, name, offset, size, md5, time.time()))
+            self.conn.execute("UPDATE shards SET end_offset = ? WHERE name = ?", (end_offset, shard))
+            self.conn.commit()
+
+    def relocate(self, shard, rows, end_offset):
+        """rows: iterable of (post id, new offset), after a shard was rebuilt."""
+        with self.lock:
+            self.conn.executemany("UPDATE members SET offset = ? WHERE id = ?", [(offset, post_id) for post_id, offset in rows])
+            self.conn.execute("UPDATE shards SET end_offset = ? WHERE name = ?", (end_offset, shard))
+            self.conn.commit()
+
+    def finish_shard(self, shard):
+        with self.lock:
+            self.conn.execute("UPDATE shards SET finished = 1 WHERE name = ?", (shard,))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def archived_post_ids(folder):
+    """Ids of the posts stored in folder's archive shards (empty if it has none)."""
+    if not os.path.exists(os.path.join(folder, INDEX_FILE)):
+        return set()
+    index = ArchiveIndex(folder)
+    try:
+        return index.post_ids()
+    finally:
+        index.close()
+
+class ArchiveWriter:
+    """Appends finished downloads to a folder's shards. Thread-safe; writes are serialized."""
+
+    def __init__(self, folder, fmt="zip", shard_size=DEFAULT_SHARD_SIZE, prefix="posts", disk=None):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown archive format {fmt!r}, expected one of {', '.join(FORMATS)}")
+        self.folder = folder
+        self.format = fmt
+        self.shard_size = shard_size
+        self.prefix = prefix
+        self.disk = disk # DiskWriter whose fsync policy covers the shards
+        self.index = ArchiveIndex(folder)
+        if disk and disk.fsync != "none":
+            with self.index.lock:
+                self.index.conn.execute("PRAGMA synchronous=FULL") # commits reach the disk too
+        self.lock = threading.Lock()
+        self.shard = None
+        self.file = None
+        self.archive = None # ZipFile / TarFile on self.file
+        self.end_offset = 0
+
+    def has(self, name):
+        return self.index.contains(_post_id(name))
+
+    def add_file(self, path, name, md5=None):
+        """Append the file at path as member name. Returns False if the post is archived already."""
+        post_id = _post_id(name)
+        size = os.path.getsize(path)
+        with self.lock:
+            if self.index.contains(post_id):
+                return False
+            self._open(size)
+            with open(path, 'rb') as src:
+                offset = self._append(self.archive, self.file, name, src, size)
+            self.file.flush()
+            if self.disk and self.disk.fsync == "file":
+                self.disk.sync_fd(self.file.fileno()) # the member is on disk before the index points at it
+            self.end_offset = self.file.tell() if self.format == "zip" else self.archive.offset
+            self.index.add(post_id, self.shard, name, offset, size, md5, self.end_offset)
+        return True
+
+    def flush(self):
+        """Finalize the current shard so it is a valid archive on disk. The next add reopens it."""
+        with self.lock:
+            self._close()
+
+    def close(self):
+        self.flush()
+        self.index.close()
+
+    def _open(self, size):
+        if self.archive and self.end_offset and self.end_offset + size > self.shard_size:
+            self._close()
+            self.index.finish_shard(self.shard)
+        if self.archive:
+            return
+        self.shard, self.end_offset = self.index.open_shard(self.prefix, self.format)
+        path = os.path.join(self.folder, self.shard)
+        if self.format == "tar":
+            # Tar members are self-contained: cutting off the end blocks (or a crash's leftovers) is enough
+            self.file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+            self.file.truncate(self.end_offset)
+            self.file.seek(self.end_offset)
+            self.archive = tarfile.open(fileobj=self.file, mode='w', format=tarfile.PAX_FORMAT)
+            return
+        if self.end_offset and not self._zip_intact(path):
+            print(f"{self.shard} wasn't closed properly; rebuilding it from the index")
+            self._rebuild_zip(path)
+        self.file = open(path, 'r+b' if self.end_offset else 'w+b')
+        self.archive = zipfile.ZipFile(self.file, 'a' if self.end_offset else 'w')
+
+    def _close(self):
+        if not self.archive:
+            return
+        self.archive.close() # writes the zip central directory / tar end blocks
+        if self.disk and self.disk.fsync == "file":
+            self.file.flush()
+            self.disk.sync_fd(self.file.fileno())
+        self.file.close()
+        self.archive = None
+        self.file = None
+        if self.disk:
+            self.disk.finished(os.path.join(self.folder, self.shard)) # "batch" fsyncs it with the page
+
+    def _zip_intact(self, path):
+        try:
+            with zipfile.ZipFile(path) as zf:
+                return len(zf.infolist()) == len(self.index.members(self.shard))
+        except (OSError, zipfile.BadZipFile):
+            return False
+
+    def _rebuild_zip(self, path):
+        tmp = path + ".rebuild"
+        moved = []
+        with open(path, 'rb') as old, open(tmp, 'w+b') as f, zipfile.ZipFile(f, 'w') as zf:
+            for post_id, name, offset, size, _ in self.index.members(self.shard):
+                old.seek(offset)
+                moved.append((post_id, self._append(zf, f, name, _Slice(old, size), size)))
+            end_offset = f.tell()
+        os.replace(tmp, path)
+        self.index.relocate(self.shard, moved, end_offset)
+        self.end_offset = end_offset
+
+    def _append(self, archive, f, name, src, size):
+        """Write one member; returns the offset of its data in the shard."""
+        if self.format == "tar":
+            info = tarfile.TarInfo(name)
+            info.size = size
+            info.mtime = int(time.time())
+            archive.addfile(info, src)
+            padded = (size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+            return archive.offset - padded
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        info.file_size = size
+        with archive.open(info, 'w') as dest:
+            shutil.copyfileobj(src, dest, COPY_BUFFER)
+        # The data starts after the local header, whose extra field length varies (zip64)
+        end = f.tell()
+        f.seek(info.header_offset + 26)
+        name_length, extra_length = struct.unpack("<HH", f.read(4))
+        f.seek(end)
+        return info.header_offset + 30 + name_length + extra_length
+
+class _Slice:
+    """Reads at most size bytes from f's current position."""
+
+    def __init__(self, f, size):
+        self.f = f
+        self.left = size
+
+    def read(self, n=-1):
+        if n < 0 or n > self.left:
+            n = self.left
+        data = self.f.read(n)
+        self.left -= len(data)
+        return data
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect a folder's archive shards")
+    parser.add_argument("folder")
+    parser.add_argument("--extract", nargs=2, metavar=("POST_ID", "OUTPUT"), help="Write one post's file to OUTPUT")
+    args = parser.parse_args()
+
+    index = ArchiveIndex(args.folder)
+    if args.extract:
+        data = index.read(int(args.extract[0]))
+        if data is None:
+            raise SystemExit(f"Post {args.extract[0]} isn't archived in {args.folder}")
+        with open(args.extract[1], 'wb') as f:
+            f.write(data)
+        print(f"Wrote {len(data)} bytes to {args.extract[1]}")
+    else:
+        for name, fmt, end_offset, finished, members in index.shards():
+            print(f"{name}: {members} posts, {end_offset / 1048576:.1f} MB{'' if finished else ' (open)'}")
+        print(f"{index.count()} posts archived")
+    index.close()
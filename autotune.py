@@ -0,0 +1,133 @@
+import json
+import time
+import threading
+from collections import deque
+from metrics import DOWNLOAD_CONCURRENCY_LIMIT
+
+class ConcurrencyTuner:
+    """
+    AIMD controller for DownloadManager's number of active transfers.
+
+    Every interval it looks at the window that just ended: bytes/s, median
+    time to first byte, failed attempts and 429s.
+    - Congestion (any 429, failures above ERROR_RATE of the attempts, or time
+      to first byte above LATENCY_FACTOR x the best seen): multiply the
+      limit by BACKOFF.
+    - Otherwise, while transfers are queueing for a slot, add one. If the
+      last step up didn't raise throughput by GAIN, step back and hold for
+      HOLD_WINDOWS windows before probing upwards again.
+    Decisions are printed when the limit changes and every window is
+    appended to log_path (JSONL) if given; decisions keeps only the last
+    HISTORY of them.
+    """
+
+    BACKOFF = 0.75
+    GAIN = 0.05
+    ERROR_RATE = 0.1
+    LATENCY_FACTOR = 3.0
+    HOLD_WINDOWS = 5
+    HISTORY = 300 # windows kept in memory (10 minutes at the default interval)
+
+    def __init__(self, downloader, min_limit=1, max_limit=32, interval=2.0, log_path=None):
+        self.downloader = downloader
+        self.gate = downloader.gate
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.interval = interval
+        self.log_path = log_path
+        self.decisions = deque(maxlen=self.HISTORY)
+        self.best_ttfb = None
+        self.before_increase = None # throughput of the window before the last step up
+        self.hold = 0
+        self._last = None
+        self._stop = threading.Event()
+        DOWNLOAD_CONCURRENCY_LIMIT.set(self.gate.limit)
+
+    def start(self):
+        threading.Thread(target=self._run, name="concurrency-tuner", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _snapshot(self):
+        d = self.downloader
+        with d.stats_lock:
+            ttfb = list(d.ttfb_samples)
+            d.ttfb_samples.clear()
+            return {"time": time.monotonic(), "bytes": d.bytes_transferred, "attempts": d.attempt_count,
+                    "errors": d.error_count, "throttled": d.throttled_count, "waited": self.gate.waited, "ttfb": ttfb}
+
+    def _run(self):
+        self._last = self._snapshot()
+        while not self._stop.wait(self.interval):
+            self.tick()
+
+    def tick(self):
+        now = self._snapshot()
+        last, self._last = self._last, now
+        elapsed = now["time"] - last["time"]
+        moved = now["bytes"] - last["bytes"]
+        demand = self.gate.waiting > 0 or now["waited"] > last["waited"]
+        if not moved and not demand:
+            return None # idle
+
+        throughput = moved / elapsed if elapsed > 0 else 0
+        attempts = now["attempts"] - last["attempts"]
+        errors = now["errors"] - last["errors"]
+        throttled = now["throttled"] - last["throttled"]
+        ttfb = sorted(now["ttfb"])
+        median_ttfb = ttfb[len(ttfb) // 2] if ttfb else None
+        if median_ttfb is not None:
+            self.best_ttfb = median_ttfb if self.best_ttfb is None else min(self.best_ttfb, median_ttfb)
+
+        limit = self.gate.limit
+        new_limit = limit
+        if throttled:
+            reason = f"{throttled} x 429"
+            new_limit = int(limit * self.BACKOFF)
+        elif attempts and errors / attempts > self.ERROR_RATE:
+            reason = f"{errors}/{attempts} attempts failed"
+            new_limit = int(limit * self.BACKOFF)
+        elif median_ttfb and self.best_ttfb and median_ttfb > self.best_ttfb * self.LATENCY_FACTOR and median_ttfb > 0.2:
+            reason = f"time to first byte {median_ttfb * 1000:.0f} ms (best {self.best_ttfb * 1000:.0f} ms)"
+            new_limit = int(limit * self.BACKOFF)
+        elif self.before_increase is not None and throughput < self.before_increase * (1 + self.GAIN):
+            reason = "last step up didn't raise throughput"
+            new_limit = limit - 1
+            self.hold = self.HOLD_WINDOWS
+        elif not demand:
+            reason = "no transfers waiting for a slot"
+        elif self.hold > 0:
+            self.hold -= 1
+            reason = "holding"
+        else:
+            reason = "transfers waiting, probing up"
+            new_limit = limit + 1
+
+        new_limit = max(self.min_limit, min(self.max_limit, new_limit))
+        self.before_increase = throughput if new_limit > limit else None
+        if new_limit < limit and "step up" not in reason:
+            self.hold = self.HOLD_WINDOWS
+
+        decision = {
+            "at": time.time(), "limit": limit, "new_limit": new_limit, "reason": reason,
+            "mb_per_s": round(throughput / 1048576, 2), "ttfb_ms": round(median_ttfb * 1000) if median_ttfb else None,
+            "errors": errors, "throttled": throttled,
+        }
+        self.decisions.append(decision)
+        if new_limit != limit:
+            self.gate.set_limit(new_limit)
+            DOWNLOAD_CONCURRENCY_LIMIT.set(new_limit)
+            print(f"[autotune] {limit} -> {new_limit}: {reason} ({decision['mb_per_s']} MB/s)")
+        self._log(decision)
+        return decision
+
+    def _log(self, decision):
+        if not self.log_path:
+            return
+        try:
+            with open(self.log_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(decision) + "\n")
+        except Exception as e:
+            print(f"Failed to write autotune log: {e}")
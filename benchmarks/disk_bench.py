@@ -0,0 +1,113 @@
+"""
+Download write paths compared against the local stand-in server.
+
+Every mode downloads the same posts into a fresh folder under --dir (put
+it on the disk you care about: an HDD, a network share, ...):
+
+    legacy        64 KB chunks through open('wb') (the old write path)
+    buffered      1 MB coalesced writes, preallocated files
+    large         256 KB chunks, 4 MB writes, preallocated
+    direct        1 MB O_DIRECT writes, preallocated (Linux)
+    legacy_fsync  the old path with an fsync per file
+    file_fsync    buffered, fsync per file
+    batch_fsync   buffered, fsyncs grouped per page
+
+    python -m benchmarks.disk_bench --posts 400 --size-dist lognormal:2000000:0.8 --dir /mnt/hdd/bench
+"""
+import io
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from danbooru_api import DanbooruClient
+from downloader import DownloadManager
+from sync_engine import SyncEngine
+from disk_writer import DiskWriter
+from benchmarks.fake_danbooru import FakeDanbooru, ServerConfig
+from benchmarks.harness import measure, save_results, print_table, compare
+from benchmarks.run_bench import folder_bytes, TAGS
+
+MODES = {
+    "legacy": {"chunk": 65536, "buffer_size": io.DEFAULT_BUFFER_SIZE, "preallocate": False},
+    "buffered": {"chunk": 65536, "buffer_size": 1048576, "preallocate": True},
+    "large": {"chunk": 262144, "buffer_size": 4194304, "preallocate": True},
+    "direct": {"chunk": 65536, "buffer_size": 1048576, "preallocate": True, "direct": True},
+    "legacy_fsync": {"chunk": 65536, "buffer_size": io.DEFAULT_BUFFER_SIZE, "preallocate": False, "fsync": "file"},
+    "file_fsync": {"chunk": 65536, "buffer_size": 1048576, "preallocate": True, "fsync": "file"},
+    "batch_fsync": {"chunk": 65536, "buffer_size": 1048576, "preallocate": True, "fsync": "batch"},
+}
+
+def run_mode(name, posts, args, work_dir):
+    spec = dict(MODES[name])
+    chunk = spec.pop("chunk")
+    downloader = DownloadManager(max_workers=args.workers)
+    downloader.chunk_size = chunk
+    downloader.disk = DiskWriter(**spec)
+
+    def run():
+        # One flush per page of posts, as the bulk engine does
+        for start in range(0, len(posts), args.page_size):
+            futures = downloader.start_download_batch(posts[start:start + args.page_size], work_dir, {})
+            for f in futures:
+                f.result()
+            downloader.flush()
+        files, size = folder_bytes(work_dir)
+        return {"files": files, "bytes": size}
+
+    row = measure(name, run)
+    report = downloader.disk.report()
+    row["direct"] = report["direct"]
+    row["fsyncs"] = report["fsyncs"]
+    row["fsync_seconds"] = report["fsync_seconds"]
+    downloader.close()
+    return row
+
+def run_all(args):
+    config = ServerConfig(posts=args.posts, size_dist=args.size_dist)
+    rows = []
+    work_root = tempfile.mkdtemp(prefix="danbooru_disk_bench_", dir=args.dir)
+    try:
+        with FakeDanbooru(config) as server:
+            api = DanbooruClient(base_url=server.base_url)
+            posts = []
+            lister = DownloadManager(max_workers=1)
+            for page in SyncEngine(api, lister, work_root, None).walk_down(TAGS):
+                posts.extend(page)
+            lister.close()
+            for name in args.modes.split(","):
+                work_dir = os.path.join(work_root, name)
+                os.makedirs(work_dir)
+                rows.append(run_mode(name, posts, args, work_dir))
+                shutil.rmtree(work_dir, ignore_errors=True)
+    finally:
+        shutil.rmtree(work_root, ignore_errors=True)
+
+    run_config = config.to_dict()
+    run_config.update({"workers": args.workers, "page_size": args.page_size, "dir": args.dir or tempfile.gettempdir()})
+    return run_config, rows
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Compare download write paths")
+    parser.add_argument("--posts", type=int, default=400)
+    parser.add_argument("--size-dist", default="lognormal:1500000:0.8", help="fixed:<b> | uniform:<min>:<max> | lognormal:<median>:<sigma>")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--page-size", type=int, default=100, help="Posts between flushes (bulk engine pages)")
+    parser.add_argument("--dir", help="Where to write (default: the temp folder)")
+    parser.add_argument("--modes", default=",".join(MODES), help="Comma-separated: " + ", ".join(MODES))
+    parser.add_argument("--output", default=os.path.join("bench_results", "disk-" + time.strftime("%Y%m%d-%H%M%S") + ".json"))
+    parser.add_argument("--compare", help="Earlier results JSON to compare against")
+    args = parser.parse_args()
+
+    run_config, rows = run_all(args)
+    print_table(rows)
+    for r in rows:
+        print(f"{r['scenario']}: {r['fsyncs']} fsyncs, {r['fsync_seconds']}s in fsync{', O_DIRECT' if r['direct'] else ''}")
+    save_results(args.output, run_config, rows)
+    print(f"\nSaved to {args.output}")
+    if args.compare:
+        compare(args.compare, rows)
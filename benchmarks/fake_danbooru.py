@@ -0,0 +1,447 @@
+import json
+import time
+import random
+import socket
+import struct
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from throttle import TokenBucket
+
+class ServerConfig:
+    """
+    Shape of the stand-in server.
+
+    size_dist: "fixed:<bytes>", "uniform:<min>:<max>" or "lognormal:<median>:<sigma>"
+    bandwidth: bytes/s per connection for file bodies (0 = unlimited)
+    total_bandwidth: bytes/s shared by all file bodies, like the client's link (0 = unlimited)
+    max_file_connections: concurrent file transfers beyond which the CDN answers 429 (0 = no limit)
+    latency_ms / api_latency_ms: delay before the first byte of file / API responses
+    connect_latency_ms: delay before a new connection is served, standing in for the TCP + TLS handshake
+    """
+
+    def __init__(self, posts=1000, size_dist="fixed:262144", bandwidth=0, latency_ms=0, api_latency_ms=None, preview_size=8192, seed=0,
+                 total_bandwidth=0, max_file_connections=0, connect_latency_ms=0):
+        self.posts = posts
+        self.size_dist = size_dist
+        self.bandwidth = bandwidth
+        self.total_bandwidth = total_bandwidth
+        self.max_file_connections = max_file_connections
+        self.latency_ms = latency_ms
+        self.api_latency_ms = latency_ms if api_latency_ms is None else api_latency_ms
+        self.preview_size = preview_size
+        self.connect_latency_ms = connect_latency_ms
+        self.seed = seed
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+class FaultConfig:
+    """
+    Faults the stand-in server injects, each a probability per request (0..1).
+
+    rate_limit:   429 with Retry-After: retry_after
+    server_error: starts a burst of burst_length 503 responses
+    reset:        connection reset (files: after half the body)
+    stall:        response pauses for stall_seconds (files: halfway through the body)
+    truncate:     body ends early while the full Content-Length was declared
+    wrong_length: Content-Length smaller than the real body
+    trickle:      files only: after the first chunk the body dribbles out at
+                  trickle_rate bytes/s, never quiet long enough to hit a read timeout
+    targets:      "files", "api" or "all"
+    max_faults_per_url: a URL that already failed this often is served cleanly,
+                        so a client with enough retries can always finish
+    """
+
+    def __init__(self, rate_limit=0.0, retry_after=1, server_error=0.0, burst_length=3, reset=0.0,
+                 stall=0.0, stall_seconds=5.0, truncate=0.0, wrong_length=0.0, trickle=0.0,
+                 trickle_rate=512, targets="all", max_faults_per_url=2, seed=0):
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.server_error = server_error
+        self.burst_length = burst_length
+        self.reset = reset
+        self.stall = stall
+        self.stall_seconds = stall_seconds
+        self.truncate = truncate
+        self.wrong_length = wrong_length
+        self.trickle = trickle
+        self.trickle_rate = trickle_rate
+        self.targets = targets
+        self.max_faults_per_url = max_faults_per_url
+        self.seed = seed
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+# Faults that only make sense while a body is being streamed
+BODY_FAULTS = ("truncate", "wrong_length", "trickle")
+
+def _parse_size_dist(spec):
+    kind, _, rest = spec.partition(":")
+    args = [float(x) for x in rest.split(":") if x]
+    if kind == "fixed":
+        return lambda rng: int(args[0])
+    if kind == "uniform":
+        return lambda rng: rng.randint(int(args[0]), int(args[1]))
+    if kind == "lognormal":
+        import math
+        return lambda rng: max(1, int(rng.lognormvariate(math.log(args[0]), args[1])))
+    raise ValueError(f"Unknown size distribution: {spec}")
+
+class FakeDanbooru:
+    """
+    Local HTTP server emulating /posts.json, /counts/posts.json and the CDN.
+
+    Every post matches every tag; only the id: metatags (id:N, id:1,2,3,
+    id:>N, id:<N, id:a..b), order:id and the a<id>/b<id> page cursors
+    narrow the result. File bodies are deterministic per post id, so md5 and
+    size can be checked after a run.
+    """
+
+    def __init__(self, config=None, faults=None):
+        self.config = config or ServerConfig()
+        self.faults = faults
+        self._size_for = _parse_size_dist(self.config.size_dist)
+        self._md5_cache = {}
+        self.lock = threading.Lock()
+        self.stats = {"api_calls": 0, "count_calls": 0, "file_requests": 0, "preview_requests": 0, "bytes_sent": 0,
+                      "rejected_connections": 0, "connections": 0}
+        self.fault_counts = {}
+        self.target_fault_counts = {"api": {}, "files": {}} # the same faults split by target
+        self._fault_rng = random.Random(faults.seed if faults else 0)
+        self._faults_per_url = {}
+        self._burst_remaining = 0
+        self.link = TokenBucket(self.config.total_bandwidth, 65536)
+        self.active_files = 0
+        self.httpd = None
+        self.thread = None
+
+    # --- Content ---
+
+    def file_size(self, post_id):
+        return self._size_for(random.Random(self.config.seed * 1000003 + post_id))
+
+    def file_ext(self, post_id):
+        return "png" if post_id % 5 == 0 else "jpg"
+
+    def file_block(self, post_id):
+        return hashlib.sha256(f"{self.config.seed}:{post_id}".encode()).digest() * 2048 # 64 KB
+
+    def iter_file(self, post_id, size, chunk_size=65536):
+        block = self.file_block(post_id)
+        sent = 0
+        while sent < size:
+            n = min(chunk_size, size - sent)
+            yield block[:n]
+            sent += n
+
+    def file_md5(self, post_id):
+        md5 = self._md5_cache.get(post_id)
+        if md5 is None:
+            h = hashlib.md5()
+            for chunk in self.iter_file(post_id, self.file_size(post_id)):
+                h.update(chunk)
+            md5 = self._md5_cache[post_id] = h.hexdigest()
+        return md5
+
+    def post_json(self, post_id):
+        ext = self.file_ext(post_id)
+        base = self.base_url
+        return {
+            "id": post_id,
+            "created_at": "2024-01-01T00:00:00.000-00:00",
+            "rating": "gsqe"[post_id % 4],
+            "score": post_id % 100,
+            "fav_count": post_id % 50,
+            "md5": self.file_md5(post_id),
+            "file_ext": ext,
+            "file_size": self.file_size(post_id),
+            "file_url": f"{base}/data/{post_id}.{ext}",
+            "large_file_url": f"{base}/data/{post_id}.{ext}",
+            "preview_file_url": f"{base}/preview/{post_id}.jpg",
+            "tag_string": f"tag_{post_id % 7} tag_{post_id % 11} artist_{post_id % 13}",
+            "tag_string_artist": f"artist_{post_id % 13}",
+            "tag_string_copyright": "original",
+            "tag_string_character": "",
+            "tag_string_general": f"tag_{post_id % 7} tag_{post_id % 11}",
+            "source": "",
+        }
+
+    # --- Query emulation ---
+
+    def _filter(self, tags):
+        lo, hi = 1, self.config.posts
+        explicit = None
+        ascending = False
+        for token in (tags or "").split():
+            if token in ("order:id", "order:id_asc"):
+                ascending = True
+            if not token.startswith("id:"):
+                continue
+            value = token[3:]
+            if value.startswith(">="):
+                lo = max(lo, int(value[2:]))
+            elif value.startswith(">"):
+                lo = max(lo, int(value[1:]) + 1)
+            elif value.startswith("<="):
+                hi = min(hi, int(value[2:]))
+            elif value.startswith("<"):
+                hi = min(hi, int(value[1:]) - 1)
+            elif ".." in value:
+                a, b = value.split("..", 1)
+                if a: lo = max(lo, int(a))
+                if b: hi = min(hi, int(b))
+            else:
+                explicit = {int(x) for x in value.split(",") if x}
+        return lo, hi, explicit, ascending
+
+    def _ids(self, lo, hi, explicit, ascending):
+        if explicit is not None:
+            return sorted((i for i in explicit if lo <= i <= hi), reverse=not ascending)
+        if hi < lo:
+            return range(0)
+        return range(lo, hi + 1) if ascending else range(hi, lo - 1, -1)
+
+    def query(self, tags, page, limit):
+        lo, hi, explicit, ascending = self._filter(tags)
+        page = str(page or "1")
+        if page.startswith("b"):
+            hi = min(hi, int(page[1:]) - 1)
+            return list(self._ids(lo, hi, explicit, False)[:limit])
+        if page.startswith("a"):
+            lo = max(lo, int(page[1:]) + 1)
+            return list(self._ids(lo, hi, explicit, True)[:limit])[::-1]
+        offset = (max(1, int(page)) - 1) * limit
+        return list(self._ids(lo, hi, explicit, ascending)[offset:offset + limit])
+
+    def count(self, tags):
+        lo, hi, explicit, ascending = self._filter(tags)
+        return len(self._ids(lo, hi, explicit, ascending))
+
+    # --- Fault injection ---
+
+    def pick_fault(self, target, path):
+        """Decide which fault (if any) this request gets. target is "api" or "files"."""
+        faults = self.faults
+        if not faults or faults.targets not in (target, "all"):
+            return None
+        with self.lock:
+            if self._faults_per_url.get(path, 0) >= faults.max_faults_per_url:
+                return None
+            fault = None
+            if self._burst_remaining > 0:
+                self._burst_remaining -= 1
+                fault = "server_error"
+            else:
+                for name in ("rate_limit", "server_error", "reset", "stall", "truncate", "wrong_length", "trickle"):
+                    if target == "api" and name in BODY_FAULTS:
+                        continue
+                    if self._fault_rng.random() < getattr(faults, name):
+                        fault = name
+                        if name == "server_error":
+                            self._burst_remaining = faults.burst_length - 1
+                        break
+            if fault:
+                self._faults_per_url[path] = self._faults_per_url.get(path, 0) + 1
+                self.fault_counts[fault] = self.fault_counts.get(fault, 0) + 1
+                counts = self.target_fault_counts[target]
+                counts[fault] = counts.get(fault, 0) + 1
+            return fault
+
+    # --- Server lifecycle ---
+
+    def count_stat(self, name, amount=1):
+        with self.lock:
+            self.stats[name] += amount
+
+    def start(self):
+        handler = type("Handler", (FakeDanbooruHandler,), {"fake": self})
+        # A real CDN accepts bursts of connections; the default backlog of 5 would add SYN retries
+        server_class = type("Server", (ThreadingHTTPServer,), {"request_queue_size": 128})
+        self.httpd = server_class(("127.0.0.1", 0), handler)
+        self.httpd.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+class FakeDanbooruHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive, like the real servers
+    fake = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.fake.count_stat("connections")
+        time.sleep(self.fake.config.connect_latency_ms / 1000)
+
+    def handle(self):
+        try:
+            super().handle()
+        except ConnectionError:
+            pass # Client dropped an idle keep-alive connection
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.fake.count_stat("bytes_sent", len(body))
+
+    def _reset(self):
+        """Abort the connection with a TCP RST."""
+        self.wfile.flush()
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        self.connection.close()
+        self.close_connection = True
+
+    def _send_fault_status(self, fault):
+        if fault == "rate_limit":
+            body = b'{"error": "rate limited"}'
+            self.send_response(429)
+            self.send_header("Retry-After", str(self.fake.faults.retry_after))
+        else:
+            body = b'{"error": "unavailable"}'
+            self.send_response(503)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_body(self, post_id, size, content_type, fault=None):
+        config = self.fake.config
+        declared = size
+        cut_at = None
+        if fault == "wrong_length":
+            declared = max(1, size - 1000)
+        if fault in ("reset", "stall", "truncate"):
+            cut_at = size // 2
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(declared))
+        if fault in ("truncate", "wrong_length"):
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+        sent = 0
+        for chunk in self.fake.iter_file(post_id, size):
+            if cut_at is not None and sent + len(chunk) > cut_at:
+                head = chunk[:cut_at - sent]
+                self.wfile.write(head)
+                sent += len(head)
+                if fault == "reset":
+                    self._reset()
+                    return
+                if fault == "truncate":
+                    self.wfile.flush()
+                    self.connection.shutdown(socket.SHUT_WR)
+                    return
+                # stall, then carry on with the rest of the body
+                self.wfile.flush()
+                time.sleep(self.fake.faults.stall_seconds)
+                cut_at = None
+                chunk = chunk[len(head):]
+            if fault == "trickle" and sent:
+                self._trickle(chunk)
+                sent += len(chunk)
+                continue
+            self.fake.link.acquire(len(chunk))
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            self.fake.count_stat("bytes_sent", len(chunk))
+            if config.bandwidth:
+                time.sleep(len(chunk) / config.bandwidth)
+
+    def _trickle(self, data, piece=64):
+        delay = piece / self.fake.faults.trickle_rate
+        for i in range(0, len(data), piece):
+            self.wfile.write(data[i:i + piece])
+            self.wfile.flush()
+            self.fake.count_stat("bytes_sent", len(data[i:i + piece]))
+            time.sleep(delay)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        try:
+            self._route()
+        except (ConnectionError, OSError, ValueError):
+            # Client went away or we reset the connection on purpose
+            self.close_connection = True
+
+    def _route(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        config = self.fake.config
+
+        target = "files" if url.path.startswith(("/data/", "/preview/")) else "api"
+        fault = self.fake.pick_fault(target, self.path)
+        if fault in ("rate_limit", "server_error"):
+            self._send_fault_status(fault)
+            return
+        if target == "api" and fault == "reset":
+            self._reset()
+            return
+        if target == "api" and fault == "stall":
+            time.sleep(self.fake.faults.stall_seconds)
+
+        if url.path == "/posts.json":
+            self.fake.count_stat("api_calls")
+            time.sleep(config.api_latency_ms / 1000)
+            limit = min(int(query.get("limit", 20)), 200)
+            posts = [self.fake.post_json(i) for i in self.fake.query(query.get("tags", ""), query.get("page"), limit)]
+            only = query.get("only")
+            if only:
+                fields = only.split(",")
+                posts = [{k: p.get(k) for k in fields} for p in posts]
+            self._send_json(posts)
+        elif url.path == "/counts/posts.json":
+            self.fake.count_stat("count_calls")
+            time.sleep(config.api_latency_ms / 1000)
+            self._send_json({"counts": {"posts": self.fake.count(query.get("tags", ""))}})
+        elif url.path.startswith("/data/"):
+            self.fake.count_stat("file_requests")
+            with self.fake.lock:
+                over_limit = config.max_file_connections and self.fake.active_files >= config.max_file_connections
+                if not over_limit:
+                    self.fake.active_files += 1
+            if over_limit:
+                self.fake.count_stat("rejected_connections")
+                self._send_json({"error": "too many connections"}, status=429)
+                return
+            try:
+                time.sleep(config.latency_ms / 1000)
+                post_id = int(url.path.rsplit("/", 1)[1].split(".")[0])
+                self._send_body(post_id, self.fake.file_size(post_id), "application/octet-stream", fault)
+            finally:
+                with self.fake.lock:
+                    self.fake.active_files -= 1
+        elif url.path.startswith("/preview/"):
+            self.fake.count_stat("preview_requests")
+            time.sleep(config.latency_ms / 1000)
+            post_id = int(url.path.rsplit("/", 1)[1].split(".")[0])
+            self._send_body(post_id, config.preview_size, "image/jpeg", fault)
+        else:
+            self._send_json({"error": "not found"}, status=404)
@@ -0,0 +1,135 @@
+"""
+HTTP/2 front end for FakeDanbooru (cleartext, prior knowledge), so the
+HTTP/2 transport can be measured against the same content locally.
+Serves /posts.json, /preview/ and /data/ with the same latencies; no fault
+injection. Needs the h2 package (pip install httpx[http2]).
+"""
+import json
+import time
+import socket
+import threading
+from urllib.parse import urlparse, parse_qs
+import h2.config
+import h2.events
+import h2.connection
+import h2.exceptions
+
+class FakeH2Server:
+    def __init__(self, fake):
+        self.fake = fake
+        self.sock = None
+        self.base_url = None
+        self.running = False
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(128)
+        self.base_url = f"http://127.0.0.1:{self.sock.getsockname()[1]}"
+        self.running = True
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.running = False
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _accept_loop(self):
+        while self.running:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        self.fake.count_stat("connections")
+        time.sleep(self.fake.config.connect_latency_ms / 1000)
+        h2conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False, header_encoding="utf-8"))
+        cond = threading.Condition() # guards h2conn and writes to conn; notified on window updates
+        closed = set()
+        with cond:
+            h2conn.initiate_connection()
+            conn.sendall(h2conn.data_to_send())
+        try:
+            while self.running:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                with cond:
+                    events = h2conn.receive_data(data)
+                    conn.sendall(h2conn.data_to_send())
+                    for event in events:
+                        if isinstance(event, h2.events.RequestReceived):
+                            threading.Thread(target=self._respond, daemon=True,
+                                             args=(conn, h2conn, cond, closed, event.stream_id, dict(event.headers))).start()
+                        elif isinstance(event, h2.events.StreamReset):
+                            closed.add(event.stream_id)
+                        elif isinstance(event, h2.events.ConnectionTerminated):
+                            return
+                    cond.notify_all()
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def _route(self, path):
+        """(status, content type, body) for path, with the stand-in's latencies applied."""
+        fake = self.fake
+        config = fake.config
+        url = urlparse(path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path == "/posts.json":
+            fake.count_stat("api_calls")
+            time.sleep(config.api_latency_ms / 1000)
+            limit = min(int(query.get("limit", 20)), 200)
+            posts = [fake.post_json(i) for i in fake.query(query.get("tags", ""), query.get("page"), limit)]
+            only = query.get("only")
+            if only:
+                fields = only.split(",")
+                posts = [{k: p.get(k) for k in fields} for p in posts]
+            # Point file and preview URLs at this server instead of the HTTP/1.1 one
+            body = json.dumps(posts).replace(fake.base_url, self.base_url).encode()
+            return 200, "application/json", body
+        if url.path.startswith(("/preview/", "/data/")):
+            preview = url.path.startswith("/preview/")
+            fake.count_stat("preview_requests" if preview else "file_requests")
+            time.sleep(config.latency_ms / 1000)
+            post_id = int(url.path.rsplit("/", 1)[1].split(".")[0])
+            size = config.preview_size if preview else fake.file_size(post_id)
+            return 200, "image/jpeg" if preview else "application/octet-stream", b"".join(fake.iter_file(post_id, size))
+        return 404, "application/json", b'{"error": "not found"}'
+
+    def _respond(self, conn, h2conn, cond, closed, stream_id, headers):
+        status, content_type, body = self._route(headers.get(":path", "/"))
+        try:
+            with cond:
+                h2conn.send_headers(stream_id, [(":status", str(status)), ("content-type", content_type),
+                                                ("content-length", str(len(body)))],
+                                    end_stream=headers.get(":method") == "HEAD")
+                conn.sendall(h2conn.data_to_send())
+                if headers.get(":method") == "HEAD":
+                    return
+                sent = 0
+                while sent < len(body):
+                    while stream_id not in closed and h2conn.local_flow_control_window(stream_id) <= 0:
+                        cond.wait(1)
+                    if stream_id in closed:
+                        return
+                    n = min(h2conn.local_flow_control_window(stream_id), h2conn.max_outbound_frame_size, len(body) - sent)
+                    h2conn.send_data(stream_id, body[sent:sent + n], end_stream=sent + n == len(body))
+                    conn.sendall(h2conn.data_to_send())
+                    sent += n
+                    self.fake.count_stat("bytes_sent", n)
+        except (OSError, h2.exceptions.ProtocolError):
+            pass
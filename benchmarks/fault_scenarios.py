@@ -0,0 +1,249 @@
+"""
+Resilience scenarios: run the bulk engine against the stand-in server while it
+injects faults, then check that every file on disk is complete and unique and
+that the run took no longer than the clean run plus what the injected faults
+can cost spread over the workers (fault_budget), so a slow machine doesn't
+report false regressions but a client that recovers slowly does.
+
+    python -m benchmarks.fault_scenarios
+    python -m benchmarks.fault_scenarios --only rate_limit,cancel
+
+Exits with status 1 if any scenario fails.
+"""
+import os
+import re
+import sys
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from danbooru_api import DanbooruClient
+from downloader import DownloadManager
+from transport import POOLS
+from resume_manager import ResumeManager
+from sync_engine import SyncEngine
+from benchmarks.fake_danbooru import FakeDanbooru, ServerConfig, FaultConfig
+from benchmarks.harness import PlainSecurity, measure, save_results
+
+TAGS = "fault_tag"
+
+# name -> (faults, max seconds)
+SCENARIOS = {
+    "clean": (FaultConfig(), 30),
+    "rate_limit": (FaultConfig(rate_limit=0.1, retry_after=1), 60),
+    "server_error_bursts": (FaultConfig(server_error=0.03, burst_length=4), 60),
+    "connection_resets": (FaultConfig(reset=0.1), 60),
+    "stalled_bodies": (FaultConfig(stall=0.05, stall_seconds=4, targets="files"), 60),
+    "trickle_bodies": (FaultConfig(trickle=0.05, trickle_rate=512, targets="files"), 60),
+    "truncated_bodies": (FaultConfig(truncate=0.1, targets="files"), 60),
+    "wrong_content_length": (FaultConfig(wrong_length=0.1, targets="files"), 60),
+    "mixed": (FaultConfig(rate_limit=0.03, server_error=0.02, reset=0.03, stall=0.02, stall_seconds=4,
+                          truncate=0.03, wrong_length=0.03), 90),
+}
+
+# make_engine's client settings, which decide how long recovering from a fault takes
+READ_TIMEOUT = 2
+STALL_WINDOW = 2
+RETRY_BACKOFF = 0.1
+
+# fault_budget: allowed slowdown of the fault-free part of a run, and fixed slack
+CLEAN_TOLERANCE = 0.5
+SLACK_SECONDS = 2
+
+def fault_seconds(faults, target):
+    """Upper estimate of the delay one injected fault of each kind adds to a request to target ("api" or "files")."""
+    # A URL gets at most max_faults_per_url faults, so its retries back off at most backoff * 2 ** (n - 1)
+    backoff = POOLS[target]["backoff"] * 2 ** (faults.max_faults_per_url - 1)
+    return {
+        "rate_limit": faults.retry_after + 1,
+        "server_error": backoff + 1,
+        "reset": 1 + RETRY_BACKOFF,
+        # API responses wait the stall out; file bodies hit the read timeout first
+        "stall": max(faults.stall_seconds, READ_TIMEOUT) + 1,
+        "trickle": STALL_WINDOW + 2, # until the stall detector gives up on the body
+        "truncate": 1 + RETRY_BACKOFF,
+        "wrong_length": 1 + RETRY_BACKOFF,
+    }
+
+def fault_budget(faults, counts, clean_seconds, workers):
+    """
+    Longest a run may take: the clean run plus CLEAN_TOLERANCE, plus the
+    injected faults' delays. API pages are fetched one after another, so
+    their faults add up in full. File faults are shared by the workers,
+    except that a page waits for its unluckiest file, which can hit its
+    max_faults_per_url one after another. counts is the server's
+    target_fault_counts.
+    """
+    api_costs, file_costs = fault_seconds(faults, "api"), fault_seconds(faults, "files")
+    api = sum(api_costs.get(fault, 1) * n for fault, n in counts["api"].items())
+    files = sum(file_costs.get(fault, 1) * n for fault, n in counts["files"].items())
+    if counts["files"]:
+        files = files / workers + faults.max_faults_per_url * max(file_costs.get(fault, 1) for fault in counts["files"])
+    return clean_seconds * (1 + CLEAN_TOLERANCE) + api + files + SLACK_SECONDS
+
+FILE_PATTERN = re.compile(r"^(\d+)\.(\w+)$")
+
+def verify_folder(server, folder, expect_all=True):
+    """Return a list of problems: leftovers, unexpected names, duplicates, bad content, missing posts."""
+    problems = []
+    seen = {}
+    for root, dirs, names in os.walk(folder): # any layout
+        for file_name in names:
+            name = os.path.relpath(os.path.join(root, file_name), folder)
+            if file_name.startswith(".danbooru_"):
+                continue
+            if file_name.endswith(".part"):
+                problems.append(f"leftover partial file {name}")
+                continue
+            match = FILE_PATTERN.match(file_name)
+            if not match:
+                problems.append(f"unexpected file {name}")
+                continue
+            post_id = int(match.group(1))
+            if post_id in seen:
+                problems.append(f"duplicate files for post {post_id}: {seen[post_id]}, {name}")
+            seen[post_id] = name
+            if match.group(2) != server.file_ext(post_id):
+                problems.append(f"wrong extension {name}")
+            with open(os.path.join(root, file_name), 'rb') as f:
+                if hashlib.md5(f.read()).hexdigest() != server.file_md5(post_id):
+                    problems.append(f"corrupt file {name}")
+    if expect_all:
+        missing = server.config.posts - len(seen)
+        if missing:
+            problems.append(f"{missing} posts missing")
+    return problems
+
+def make_engine(server, folder, workers):
+    api = DanbooruClient(base_url=server.base_url)
+    downloader = DownloadManager(max_workers=workers)
+    downloader.timeout = READ_TIMEOUT # so stalled bodies trip the read timeout quickly
+    downloader.retry_backoff = RETRY_BACKOFF
+    downloader.stall_window = STALL_WINDOW # trickling bodies never hit the timeout; the stall detector has to catch them
+    engine = SyncEngine(api, downloader, folder, ResumeManager(folder, PlainSecurity()))
+    return api, downloader, engine
+
+def run_fault_scenario(name, faults, args, folder):
+    config = ServerConfig(posts=args.posts, size_dist=args.size_dist)
+    with FakeDanbooru(config, faults) as server:
+        api, downloader, engine = make_engine(server, folder, args.workers)
+        errors = []
+
+        def run():
+            ok = engine.run(TAGS, callbacks={'on_error': errors.append})
+            return {"files": downloader.files_downloaded, "bytes": downloader.bytes_downloaded,
+                    "api_calls": api.request_count, "completed": ok}
+
+        row = measure(name, run)
+        row["faults_injected"] = dict(server.fault_counts)
+        row["faults_by_target"] = {target: dict(c) for target, c in server.target_fault_counts.items()}
+        row["download_errors"] = len(errors)
+        row["problems"] = verify_folder(server, folder)
+        if not row["completed"]:
+            row["problems"].append("sync did not reach the end of the query")
+        downloader.close()
+    return row
+
+def run_cancel_scenario(args, folder):
+    """Cancel in the middle of a throttled run: stop must be quick and leave no partial files."""
+    config = ServerConfig(posts=args.posts, size_dist=args.size_dist, bandwidth=256 * 1024)
+    with FakeDanbooru(config) as server:
+        api, downloader, engine = make_engine(server, folder, args.workers)
+        thread = threading.Thread(target=engine.run, args=(TAGS,), daemon=True)
+        thread.start()
+        time.sleep(1.5)
+        stop_at = time.perf_counter()
+        downloader.stop_all()
+        thread.join(timeout=30)
+        # Workers still draining a chunk need a moment to clean up their .part files
+        downloader.executor.shutdown(wait=True)
+        stop_seconds = time.perf_counter() - stop_at
+        problems = verify_folder(server, folder, expect_all=False)
+        if thread.is_alive():
+            problems.append("engine did not stop")
+        if stop_seconds > 5:
+            problems.append(f"stop took {stop_seconds:.1f}s")
+        downloader.close()
+    return {"scenario": "cancel", "seconds": round(stop_seconds, 3), "files": downloader.files_downloaded,
+            "bytes": downloader.bytes_downloaded, "files_per_s": 0, "mb_per_s": 0, "api_calls": api.request_count,
+            "peak_rss_mb": None, "peak_threads": threading.active_count(), "problems": problems}
+
+def run_pause_scenario(args, folder):
+    """Pause mid-run: no file may complete beyond those already in their last chunk, then resume to the end."""
+    config = ServerConfig(posts=args.posts, size_dist=args.size_dist, bandwidth=512 * 1024)
+    with FakeDanbooru(config) as server:
+        api, downloader, engine = make_engine(server, folder, args.workers)
+        result = {}
+        thread = threading.Thread(target=lambda: result.update(ok=engine.run(TAGS)), daemon=True)
+        start = time.perf_counter()
+        thread.start()
+        time.sleep(1.0)
+        downloader.toggle_pause()
+        time.sleep(0.3) # let chunks already handed to workers land
+        paused_files = downloader.files_downloaded
+        time.sleep(1.5)
+        progressed = downloader.files_downloaded - paused_files
+        downloader.toggle_pause()
+        thread.join(timeout=120)
+        problems = verify_folder(server, folder)
+        if progressed > args.workers:
+            problems.append(f"{progressed} files completed while paused")
+        if not result.get("ok"):
+            problems.append("sync did not finish after resume")
+        downloader.close()
+    return {"scenario": "pause", "seconds": round(time.perf_counter() - start, 3), "files": downloader.files_downloaded,
+            "bytes": downloader.bytes_downloaded, "files_per_s": 0, "mb_per_s": 0, "api_calls": api.request_count,
+            "peak_rss_mb": None, "peak_threads": threading.active_count(), "problems": problems}
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Fault-injection scenarios")
+    parser.add_argument("--posts", type=int, default=200)
+    parser.add_argument("--size-dist", default="uniform:20000:200000")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--only", help="Comma-separated scenario names (default: all, plus cancel and pause)")
+    parser.add_argument("--output", default=os.path.join("bench_results", "faults-" + time.strftime("%Y%m%d-%H%M%S") + ".json"))
+    args = parser.parse_args()
+
+    names = args.only.split(",") if args.only else list(SCENARIOS) + ["cancel", "pause"]
+    if any(n in SCENARIOS for n in names) and "clean" not in names:
+        names.insert(0, "clean") # needed as the time reference
+
+    rows = []
+    work_root = tempfile.mkdtemp(prefix="danbooru_faults_")
+    try:
+        clean_seconds = None
+        for name in names:
+            folder = os.path.join(work_root, name)
+            os.makedirs(folder)
+            if name == "cancel":
+                row = run_cancel_scenario(args, folder)
+            elif name == "pause":
+                row = run_pause_scenario(args, folder)
+            else:
+                faults, max_seconds = SCENARIOS[name]
+                row = run_fault_scenario(name, faults, args, folder)
+                if name == "clean":
+                    clean_seconds = row["seconds"]
+                if row["seconds"] > max_seconds:
+                    row["problems"].append(f"took {row['seconds']}s (limit {max_seconds}s)")
+                if clean_seconds is not None and name != "clean":
+                    budget = round(fault_budget(faults, row["faults_by_target"], clean_seconds, args.workers), 1)
+                    row["budget_seconds"] = budget
+                    if row["seconds"] > budget:
+                        row["problems"].append(f"took {row['seconds']}s, more than the {budget}s the injected faults explain")
+            status = "PASS" if not row["problems"] else "FAIL"
+            budget = f" (budget {row['budget_seconds']}s)" if "budget_seconds" in row else ""
+            print(f"{status} {name:<22} {row['seconds']:>8}s{budget} {row['files_per_s']:>9} files/s  faults={row.get('faults_injected', {})}")
+            for problem in row["problems"][:10]:
+                print(f"     - {problem}")
+            rows.append(row)
+    finally:
+        shutil.rmtree(work_root, ignore_errors=True)
+
+    save_results(args.output, {"posts": args.posts, "size_dist": args.size_dist, "workers": args.workers}, rows)
+    sys.exit(1 if any(r["problems"] for r in rows) else 0)
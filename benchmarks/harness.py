@@ -0,0 +1,137 @@
+import os
+import sys
+import json
+import time
+import platform
+import threading
+import subprocess
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+class PlainSecurity:
+    """Stand-in for SecurityManager so benchmark runs don't touch the OS keyring."""
+
+    def encrypt(self, data):
+        return data or ""
+
+    def decrypt(self, token):
+        return token or ""
+
+def current_rss():
+    """Resident set size in bytes, or None if it can't be read on this platform."""
+    if psutil:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    except Exception:
+        return None
+
+class ResourceSampler:
+    """Samples RSS and thread count in the background and keeps the peaks."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_threads = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        rss = current_rss()
+        if rss:
+            self.peak_rss = max(self.peak_rss, rss)
+        self.peak_threads = max(self.peak_threads, threading.active_count())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self._sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+def measure(name, fn):
+    """
+    Run fn() and return a result row. fn returns a dict with any of
+    files, bytes, api_calls plus free-form extras.
+    """
+    with ResourceSampler() as sampler:
+        start = time.perf_counter()
+        extra = fn() or {}
+        elapsed = time.perf_counter() - start
+
+    files = extra.pop("files", 0)
+    size = extra.pop("bytes", 0)
+    row = {
+        "scenario": name,
+        "seconds": round(elapsed, 4),
+        "files": files,
+        "bytes": size,
+        "files_per_s": round(files / elapsed, 2) if elapsed else 0,
+        "mb_per_s": round(size / elapsed / 1048576, 2) if elapsed else 0,
+        "api_calls": extra.pop("api_calls", 0),
+        "peak_rss_mb": round(sampler.peak_rss / 1048576, 1) if sampler.peak_rss else None,
+        "peak_threads": sampler.peak_threads,
+    }
+    row.update(extra)
+    return row
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+def save_results(path, config, rows):
+    data = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": config,
+        "results": rows,
+    }
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
+    return data
+
+def print_table(rows):
+    print(f"{'scenario':<22}{'sec':>9}{'files/s':>10}{'MB/s':>9}{'api':>7}{'rss MB':>9}{'threads':>9}")
+    for r in rows:
+        print(f"{r['scenario']:<22}{r['seconds']:>9}{r['files_per_s']:>10}{r['mb_per_s']:>9}{r['api_calls']:>7}"
+              f"{str(r['peak_rss_mb']):>9}{r['peak_threads']:>9}")
+
+def compare(baseline_path, rows):
+    """Print throughput and time ratios against an earlier results file."""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = {r["scenario"]: r for r in json.load(f)["results"]}
+    print(f"\nvs {baseline_path}")
+    for r in rows:
+        old = baseline.get(r["scenario"])
+        if not old:
+            continue
+        parts = []
+        for key in ("seconds", "files_per_s", "mb_per_s", "api_calls", "peak_rss_mb"):
+            if old.get(key) and r.get(key) is not None:
+                parts.append(f"{key} x{r[key] / old[key]:.2f}")
+        print(f"  {r['scenario']:<20} " + ", ".join(parts))
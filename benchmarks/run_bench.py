@@ -0,0 +1,147 @@
+"""
+Benchmark DanbooruClient, DownloadManager and the bulk engine against a local
+stand-in server.
+
+    python -m benchmarks.run_bench --posts 2000 --size-dist lognormal:300000:0.8 --workers 8
+    python -m benchmarks.run_bench --compare bench_results/old.json
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from danbooru_api import DanbooruClient
+from downloader import DownloadManager
+from resume_manager import ResumeManager
+from sync_engine import SyncEngine
+from sharded_sync import ShardedSync
+from transport import TRANSPORT
+from benchmarks.fake_danbooru import FakeDanbooru, ServerConfig
+from benchmarks.harness import PlainSecurity, measure, save_results, print_table, compare
+
+TAGS = "bench_tag"
+
+def folder_bytes(folder):
+    total = 0
+    files = 0
+    for root, dirs, names in os.walk(folder):
+        for name in names:
+            if name.startswith("."):
+                continue
+            total += os.path.getsize(os.path.join(root, name))
+            files += 1
+    return files, total
+
+def scenario_enumerate(server, args):
+    api = DanbooruClient(base_url=server.base_url)
+    downloader = DownloadManager(max_workers=1)
+    engine = SyncEngine(api, downloader, tempfile.gettempdir(), None, partitions=args.partitions)
+    posts = 0
+    for page in engine.walk_down(TAGS):
+        posts += len(page)
+    downloader.close()
+    return {"files": 0, "bytes": api.bytes_received, "api_calls": api.request_count, "posts": posts}
+
+def scenario_download(server, args, work_dir):
+    api = DanbooruClient(base_url=server.base_url)
+    posts = []
+    lister = DownloadManager(max_workers=1)
+    for page in SyncEngine(api, lister, work_dir, None).walk_down(TAGS):
+        posts.extend(page)
+    lister.close()
+
+    downloader = DownloadManager(max_workers=args.workers, auto_concurrency=args.auto_concurrency)
+
+    def run():
+        futures = downloader.start_download_batch(posts, work_dir, {})
+        for f in futures:
+            f.result()
+        files, size = folder_bytes(work_dir)
+        downloader.close()
+        return {"files": files, "bytes": size}
+
+    return run
+
+def scenario_bulk(server, args, work_dir, count_files=True):
+    api = DanbooruClient(base_url=server.base_url)
+    downloader = DownloadManager(max_workers=args.workers, auto_concurrency=args.auto_concurrency)
+    resume_mgr = ResumeManager(work_dir, PlainSecurity())
+    engine = SyncEngine(api, downloader, work_dir, resume_mgr, partitions=args.partitions)
+    engine.run(TAGS)
+    files, size = folder_bytes(work_dir) if count_files else (0, 0)
+    downloader.close()
+    return {"files": files, "bytes": size, "api_calls": api.request_count, "final_concurrency": downloader.gate.limit}
+
+def scenario_sharded(server, args, work_dir):
+    settings = {"username": None, "apikey": None, "email": None, "max_workers": args.workers, "base_url": server.base_url}
+    sync = ShardedSync(settings, work_dir, processes=args.processes, security_factory=PlainSecurity)
+    summary = sync.run(TAGS)
+    files, size = folder_bytes(work_dir)
+    return {"files": files, "bytes": size, "shards": summary["shards"], "completed": summary["complete"]}
+
+def run_all(args):
+    config = ServerConfig(posts=args.posts, size_dist=args.size_dist, bandwidth=args.bandwidth,
+                          latency_ms=args.latency_ms, api_latency_ms=args.api_latency_ms,
+                          total_bandwidth=args.total_bandwidth, max_file_connections=args.max_connections)
+    rows = []
+    work_root = tempfile.mkdtemp(prefix="danbooru_bench_")
+    try:
+        with FakeDanbooru(config) as server:
+            scenarios = args.scenarios.split(",")
+            if "enumerate" in scenarios:
+                rows.append(measure("enumerate", lambda: scenario_enumerate(server, args)))
+            if "download" in scenarios:
+                work_dir = os.path.join(work_root, "download")
+                os.makedirs(work_dir)
+                rows.append(measure("download", scenario_download(server, args, work_dir)))
+            if "bulk" in scenarios or "resync" in scenarios:
+                work_dir = os.path.join(work_root, "bulk")
+                os.makedirs(work_dir)
+                rows.append(measure("bulk", lambda: scenario_bulk(server, args, work_dir)))
+                if "resync" in scenarios:
+                    # Same folder again: only the (empty) delta should be fetched
+                    rows.append(measure("resync", lambda: scenario_bulk(server, args, work_dir, count_files=False)))
+            if "sharded" in scenarios:
+                work_dir = os.path.join(work_root, "sharded")
+                os.makedirs(work_dir)
+                rows.append(measure("sharded", lambda: scenario_sharded(server, args, work_dir)))
+    finally:
+        shutil.rmtree(work_root, ignore_errors=True)
+
+    run_config = config.to_dict()
+    run_config["workers"] = args.workers
+    run_config["processes"] = args.processes
+    run_config["partitions"] = args.partitions
+    run_config["auto_concurrency"] = args.auto_concurrency
+    run_config["transport"] = TRANSPORT.report() # pool sizes and keep-alive reuse
+    return run_config, rows
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Danbooru Downloader benchmark")
+    parser.add_argument("--posts", type=int, default=1000)
+    parser.add_argument("--size-dist", default="fixed:262144", help="fixed:<b> | uniform:<min>:<max> | lognormal:<median>:<sigma>")
+    parser.add_argument("--bandwidth", type=int, default=0, help="Per-connection bytes/s for files (0 = unlimited)")
+    parser.add_argument("--total-bandwidth", type=int, default=0, help="Bytes/s shared by all file transfers (0 = unlimited)")
+    parser.add_argument("--max-connections", type=int, default=0, help="Concurrent file transfers before the server answers 429 (0 = no limit)")
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--api-latency-ms", type=float, default=None)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--auto-concurrency", action="store_true", help="Let the AIMD tuner pick the number of transfers (starting at --workers)")
+    parser.add_argument("--partitions", type=int, default=1, help="Id-range partitions fetched at once during enumeration")
+    parser.add_argument("--processes", type=int, default=4, help="Worker processes for the sharded scenario")
+    parser.add_argument("--scenarios", default="enumerate,download,bulk,resync",
+                        help="Comma-separated: enumerate, download, bulk, resync, sharded")
+    parser.add_argument("--output", default=os.path.join("bench_results", time.strftime("%Y%m%d-%H%M%S") + ".json"))
+    parser.add_argument("--compare", help="Earlier results JSON to compare against")
+    args = parser.parse_args()
+
+    run_config, rows = run_all(args)
+    print_table(rows)
+    save_results(args.output, run_config, rows)
+    print(f"\nSaved to {args.output}")
+    if args.compare:
+        compare(args.compare, rows)
@@ -0,0 +1,119 @@
+"""
+Time to all thumbnails of one browse page over HTTP/1.1 and HTTP/2.
+
+Each round does what the browse view does when a page opens: one
+/posts.json call for page_size posts, then every preview fetched in
+parallel. Every round starts on a fresh Transport, so connection setup is
+included (as when the app has just started), unless --warm is given.
+--connect-latency-ms makes the stand-in charge for each new connection
+like a TCP + TLS handshake would.
+
+    python -m benchmarks.thumbnail_bench --connect-latency-ms 60 --latency-ms 30
+"""
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transport import Transport
+from danbooru_api import resolve_fields
+from benchmarks.fake_danbooru import FakeDanbooru, ServerConfig
+from benchmarks.harness import measure, save_results, print_table, compare
+
+TAGS = "bench_tag"
+
+def load_page(transport, base_url, page_size):
+    """Fetch one page and all its previews; returns the number of preview bytes."""
+    response = transport.get("api", f"{base_url}/posts.json",
+                             params={"tags": TAGS, "limit": page_size, "page": 1, "only": resolve_fields("browse")})
+    response.raise_for_status()
+    posts = response.json()
+    sizes = []
+    errors = []
+
+    def fetch(url):
+        try:
+            sizes.append(len(transport.get("previews", url).content))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=fetch, args=(p["preview_file_url"],)) for p in posts]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    return len(posts), sum(sizes)
+
+def run_mode(name, server, base_url, args, http2):
+    rows = []
+    for _ in range(args.rounds):
+        transport = Transport()
+        if http2 and not transport.enable_http2(("api", "previews"), prior_knowledge=True):
+            return None
+        transport.ensure_pool_size("previews", args.page_size)
+        if args.warm:
+            transport.get("api", f"{base_url}/posts.json", params={"tags": TAGS, "limit": 1})
+        connections_before = server.stats["connections"]
+
+        def run():
+            files, size = load_page(transport, base_url, args.page_size)
+            return {"files": files, "bytes": size, "api_calls": 1}
+
+        row = measure(name, run)
+        row["connections"] = server.stats["connections"] - connections_before
+        rows.append(row)
+        for session in transport.sessions.values():
+            session.close()
+
+    # Report the median round
+    rows.sort(key=lambda r: r["seconds"])
+    row = rows[len(rows) // 2]
+    row["p90_seconds"] = rows[min(len(rows) - 1, int(len(rows) * 0.9))]["seconds"]
+    row["rounds"] = len(rows)
+    return row
+
+def run_all(args):
+    config = ServerConfig(posts=max(args.page_size, 100), latency_ms=args.latency_ms, api_latency_ms=args.api_latency_ms,
+                          preview_size=args.preview_size, connect_latency_ms=args.connect_latency_ms)
+    rows = []
+    with FakeDanbooru(config) as server:
+        rows.append(run_mode("thumbnails_http1", server, server.base_url, args, http2=False))
+        try:
+            from benchmarks.fake_h2 import FakeH2Server
+        except ImportError:
+            print("h2 isn't installed (pip install httpx[http2]); skipping HTTP/2")
+        else:
+            with FakeH2Server(server) as h2_server:
+                row = run_mode("thumbnails_http2", server, h2_server.base_url, args, http2=True)
+                if row:
+                    rows.append(row)
+    run_config = config.to_dict()
+    run_config.update({"page_size": args.page_size, "rounds": args.rounds, "warm": args.warm})
+    return run_config, rows
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Time to all thumbnails: HTTP/1.1 vs HTTP/2")
+    parser.add_argument("--page-size", type=int, default=30)
+    parser.add_argument("--rounds", type=int, default=7)
+    parser.add_argument("--preview-size", type=int, default=20000)
+    parser.add_argument("--latency-ms", type=float, default=30, help="Server time per preview request")
+    parser.add_argument("--api-latency-ms", type=float, default=None)
+    parser.add_argument("--connect-latency-ms", type=float, default=60, help="Cost of each new connection (handshakes)")
+    parser.add_argument("--warm", action="store_true", help="Open a connection before timing")
+    parser.add_argument("--output", default=os.path.join("bench_results", "thumbnails-" + time.strftime("%Y%m%d-%H%M%S") + ".json"))
+    parser.add_argument("--compare", help="Earlier results JSON to compare against")
+    args = parser.parse_args()
+
+    run_config, rows = run_all(args)
+    print_table(rows)
+    for r in rows:
+        print(f"{r['scenario']}: {r['seconds']}s median, {r['p90_seconds']}s p90, {r['connections']} connections per page")
+    save_results(args.output, run_config, rows)
+    print(f"\nSaved to {args.output}")
+    if args.compare:
+        compare(args.compare, rows)
@@ -5,6 +5,8 @@ import ctypes
 import hashlib
 from io import BytesIO
 from PIL import Image
+from profiling import timed
+from metrics import CACHE_HITS, CACHE_MISSES, CACHE_SIZE
 
 class ThumbnailCache:
     def __init__(self, cache_dir=".danbooru_cache", max_days=7, max_size_mb=500):
@@ -30,6 +32,7 @@ class ThumbnailCache:
         hash_name = hashlib.md5(str(post_id).encode()).hexdigest()
         return os.path.join(self.cache_dir, f"{hash_name}.dat")
 
+    @timed("cache.load")
     def load(self, post_id):
         if self.max_days == 0:
             return None
@@ -47,12 +50,16 @@ class ThumbnailCache:
                 for i in range(min(4, len(data))):
                     data[i] ^= 0xFF
                     
-                return Image.open(BytesIO(data))
+                image = Image.open(BytesIO(data))
+                CACHE_HITS.inc()
+                return image
             except Exception as e:
                 # print(f"Cache load error: {e}")
                 pass
+        CACHE_MISSES.inc()
         return None
 
+    @timed("cache.save")
     def save(self, post_id, image_data):
         if self.max_days == 0:
             return
@@ -69,9 +76,11 @@ class ThumbnailCache:
                 
             with open(file_path, "wb") as f:
                 f.write(data)
+            CACHE_SIZE.inc(len(data))
         except Exception as e:
             print(f"Failed to save cache: {e}")
 
+    @timed("cache.cleanup")
     def cleanup(self):
         if self.max_days == 0:
             # If disabled, maybe we should clear everything? 
@@ -123,11 +132,14 @@ class ThumbnailCache:
                 except:
                     pass
 
+        CACHE_SIZE.set(total_size)
+
     def clear_all(self):
         if os.path.exists(self.cache_dir):
             try:
                 shutil.rmtree(self.cache_dir)
                 self._ensure_cache_dir()
+                CACHE_SIZE.set(0)
             except Exception as e:
                 print(f"Failed to clear cache: {e}")
 
@@ -136,5 +148,6 @@ class ThumbnailCache:
             try:
                 shutil.rmtree(self.cache_dir)
                 self._ensure_cache_dir()
+                CACHE_SIZE.set(0)
             except Exception as e:
                 print(f"Failed to clear cache: {e}")
@@ -0,0 +1,71 @@
+import os
+from dotenv import load_dotenv
+
+def _int_env(name, default):
+    try:
+        return int(os.getenv(name, str(default)))
+    except:
+        return default
+
+def _float_env(name, default):
+    try:
+        return float(os.getenv(name, str(default)))
+    except:
+        return default
+
+def load_settings(security):
+    """
+    Read settings from .env (decrypting the encrypted values).
+    Shared by the GUI and the headless modes (watch, import, ...).
+    """
+    load_dotenv()
+
+    username = security.decrypt(os.getenv("DANBOORU_USERNAME")) or ""
+    apikey = security.decrypt(os.getenv("DANBOORU_APIKEY")) or ""
+    email = security.decrypt(os.getenv("DANBOORU_EMAIL")) or "unknown@example.com"
+
+    # Encrypted Path
+    decrypted_path = security.decrypt(os.getenv("DANBOORU_DOWNLOAD_PATH"))
+    download_path = decrypted_path if decrypted_path else os.path.join(os.getcwd(), "downloads")
+
+    # Encrypted Safe Search
+    decrypted_safe_search = security.decrypt(os.getenv("DANBOORU_SAFE_SEARCH"))
+    # Handle default (decrypted_safe_search might be empty if env missing)
+    safe_search_str = decrypted_safe_search if decrypted_safe_search else "False"
+
+    return {
+        "username": username,
+        "apikey": apikey,
+        "email": email,
+        "download_path": download_path,
+        "preview_limit": _int_env("DANBOORU_PREVIEW_LIMIT", 20),
+        "safe_search": safe_search_str.lower() == "true",
+        "cache_days": _int_env("DANBOORU_CACHE_DAYS", 7),
+        "cache_size": _int_env("DANBOORU_CACHE_SIZE", 500),
+        "max_workers": _int_env("DANBOORU_MAX_WORKERS", 8),
+        "api_rate": _float_env("DANBOORU_API_RATE", 0), # requests/s, 0 = unlimited
+        "enum_partitions": _int_env("DANBOORU_ENUM_PARTITIONS", 1),
+        "auto_concurrency": os.getenv("DANBOORU_AUTO_CONCURRENCY", "False").lower() == "true",
+        "bandwidth_limit": _int_env("DANBOORU_BANDWIDTH_LIMIT", 0), # KB/s, 0 = unlimited
+        "stall_min_rate": _int_env("DANBOORU_STALL_MIN_RATE", 4096), # bytes/s, 0 = no stall detection
+        "stall_window": _float_env("DANBOORU_STALL_WINDOW", 15.0),
+        "layout": os.getenv("DANBOORU_LAYOUT", "flat"), # flat, id or md5 (see layout.py)
+        "dedup": os.getenv("DANBOORU_DEDUP", "False").lower() == "true", # link files already in another folder
+        "content_index": os.getenv("DANBOORU_CONTENT_INDEX", os.path.join(download_path, ".danbooru_content_index.db")),
+        "archive_format": os.getenv("DANBOORU_ARCHIVE_FORMAT", ""), # zip or tar: bulk downloads go into shards (see archive.py)
+        "archive_shard_mb": _int_env("DANBOORU_ARCHIVE_SHARD_MB", 1024),
+        "write_chunk_kb": _int_env("DANBOORU_WRITE_CHUNK_KB", 64), # network read size
+        "write_buffer_kb": _int_env("DANBOORU_WRITE_BUFFER_KB", 1024), # disk writes are coalesced to this size
+        "preallocate": os.getenv("DANBOORU_PREALLOCATE", "True").lower() == "true",
+        "direct_io": os.getenv("DANBOORU_DIRECT_IO", "False").lower() == "true", # O_DIRECT, Linux only
+        "fsync": os.getenv("DANBOORU_FSYNC", "none"), # none, file or batch (see disk_writer.py)
+        "postprocess": os.getenv("DANBOORU_POSTPROCESS", ""), # e.g. webp,strip,preview (see postprocess.py)
+        "postprocess_workers": _int_env("DANBOORU_POSTPROCESS_WORKERS", 0), # 0 = one per CPU but one
+        "metadata_sidecar": os.getenv("DANBOORU_METADATA_SIDECAR", "False").lower() == "true", # metadata.jsonl per folder
+        "http2": os.getenv("DANBOORU_HTTP2", "False").lower() == "true", # needs httpx[http2]
+        "hedge_percentile": _float_env("DANBOORU_HEDGE_PERCENTILE", 95.0), # 0 = no hedged requests
+        "skip_download_confirmation": os.getenv("DANBOORU_SKIP_CONFIRMATION", "False").lower() == "true",
+        "profiling": os.getenv("DANBOORU_PROFILE", "False").lower() == "true",
+        "ui_watchdog_ms": _int_env("DANBOORU_UI_WATCHDOG_MS", 0),
+        "metrics_port": _int_env("DANBOORU_METRICS_PORT", 0),
+    }
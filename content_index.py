@@ -0,0 +1,169 @@
+"""
+Global index of downloaded files by md5, shared by every download folder.
+
+Before fetching a post, DownloadManager asks the index whether the same
+content (md5 + size) is already on disk somewhere, in any folder, and
+materializes it from there instead: a hardlink where the filesystem allows
+it, a reflink (copy-on-write clone) on filesystems that support them, or a
+plain copy. Every finished or already present download is added.
+
+Build the index for folders downloaded before it existed:
+
+    python content_index.py scan D:\\Mirror\\miku D:\\Mirror\\rin
+"""
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import hashlib
+import threading
+from layout import iter_post_files
+from manifest import Manifest
+
+FICLONE = 0x40049409 # Linux ioctl: clone src's extents into dst (btrfs, XFS, ...)
+
+def _reflink(src, dst):
+    if not sys.platform.startswith("linux"):
+        raise OSError("reflinks are only tried on Linux")
+    import fcntl
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+def materialize(src, dst):
+    """
+    Create dst with src's content without downloading it. Returns the
+    method used: "hardlink", "reflink" or "copy". dst appears atomically.
+    """
+    folder, name = os.path.split(dst)
+    os.makedirs(folder, exist_ok=True)
+    part_path = os.path.join(folder, f".{name}.link")
+    try:
+        try:
+            os.link(src, part_path)
+            method = "hardlink"
+        except OSError:
+            try:
+                _reflink(src, part_path)
+                method = "reflink"
+            except OSError:
+                shutil.copyfile(src, part_path)
+                method = "copy"
+        os.replace(part_path, dst)
+        return method
+    except Exception:
+        try:
+            os.remove(part_path)
+        except OSError:
+            pass
+        raise
+
+class ContentIndex:
+    """sqlite md5 -> paths table; safe to share between threads and processes."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                md5 TEXT NOT NULL,
+                path TEXT NOT NULL,
+                size INTEGER,
+                added_at REAL,
+                PRIMARY KEY (md5, path)
+            )
+        """)
+        self.conn.commit()
+
+    def add(self, md5, path, size):
+        self.add_many([(md5, path, size)])
+
+    def add_many(self, rows):
+        """rows: iterable of (md5, path, size)."""
+        now = time.time()
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO files (md5, path, size, added_at) VALUES (?, ?, ?, ?)",
+                                  [(md5, os.path.abspath(path), size, now) for md5, path, size in rows])
+            self.conn.commit()
+
+    def find(self, md5, size=None, exclude=None):
+        """
+        A path holding this content, or None. Entries whose file is gone or
+        has another size are dropped on the way.
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT path, size FROM files WHERE md5 = ?", (md5,)).fetchall()
+        stale = []
+        found = None
+        for path, indexed_size in rows:
+            if exclude and path == os.path.abspath(exclude):
+                continue
+            try:
+                actual = os.path.getsize(path)
+            except OSError:
+                stale.append(path)
+                continue
+            if actual != indexed_size or (size and actual != size):
+                stale.append(path)
+                continue
+            found = path
+            break
+        if stale:
+            with self.lock:
+                self.conn.executemany("DELETE FROM files WHERE md5 = ? AND path = ?", [(md5, p) for p in stale])
+                self.conn.commit()
+        return found
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def scan(self, folder):
+        """Index every post file in folder (md5 from the manifest, else by hashing). Returns the number added."""
+        md5s = {}
+        if os.path.exists(os.path.join(folder, Manifest.FILE_NAME)):
+            manifest = Manifest(folder)
+            md5s = manifest.md5s()
+            manifest.close()
+        rows = []
+        count = 0
+        for post_id, rel in iter_post_files(folder):
+            path = os.path.join(folder, rel)
+            md5 = md5s.get(post_id)
+            if not md5:
+                h = hashlib.md5()
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1048576), b""):
+                        h.update(chunk)
+                md5 = h.hexdigest()
+            rows.append((md5, path, os.path.getsize(path)))
+            count += 1
+            if len(rows) >= 1000:
+                self.add_many(rows)
+                rows = []
+        self.add_many(rows)
+        return count
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+if __name__ == "__main__":
+    import argparse
+    from security import SecurityManager
+    from config import load_settings
+
+    parser = argparse.ArgumentParser(description="Global md5 index used to avoid downloading a file twice")
+    sub = parser.add_subparsers(dest="command", required=True)
+    scan = sub.add_parser("scan", help="Add the files of existing download folders")
+    scan.add_argument("folders", nargs="+")
+    parser.add_argument("--index", help="Index file (default: from settings)")
+    args = parser.parse_args()
+
+    index = ContentIndex(args.index or load_settings(SecurityManager())["content_index"])
+    for folder in args.folders:
+        print(f"{folder}: {index.scan(folder)} files indexed")
+    print(f"{index.count()} files in the index")
+    index.close()
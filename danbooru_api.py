@@ -1,15 +1,48 @@
 
 import requests
 import os
+import time
 from urllib.parse import urlencode
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+from profiling import timed
+from throttle import TokenBucket
+from transport import TRANSPORT
+from metrics import API_REQUESTS, API_LATENCY, API_RATE_LIMITED, count_retried_status
+
+# Field projections for Danbooru's only= parameter.
+# "browse" is what PostFrame renders, "bulk" is what DownloadManager needs,
+# "metadata" adds what the metadata sidecar records.
+FIELD_PROFILES = {
+    "id": "id",
+    "browse": ",".join([
+        "id", "created_at", "rating", "score", "fav_count", "file_ext", "file_size", "md5",
+        "file_url", "large_file_url", "preview_file_url", "tag_string",
+        "tag_string_artist", "tag_string_copyright", "tag_string_character", "tag_string_general",
+    ]),
+    "bulk": "id,file_url,file_ext,md5,file_size",
+    "metadata": ",".join([
+        "id", "file_url", "file_ext", "md5", "file_size", "created_at", "rating", "score", "fav_count",
+        "source", "image_width", "image_height", "parent_id", "tag_string", "tag_string_general",
+        "tag_string_artist", "tag_string_copyright", "tag_string_character", "tag_string_meta",
+    ]),
+}
+
+def resolve_fields(only):
+    """Turn a profile name or an explicit comma-separated field list into an only= value."""
+    if not only:
+        return None
+    return FIELD_PROFILES.get(only, only)
 
 class DanbooruClient:
     BASE_URL = "https://danbooru.donmai.us"
+    CDN_URL = "https://cdn.donmai.us"
+    MAX_IDS_PER_REQUEST = 100
+    COUNT_CACHE_TTL = 300 # seconds
 
-    def __init__(self, username=None, api_key=None, nickname=None, email=None):
+    def __init__(self, username=None, api_key=None, nickname=None, email=None, base_url=None, rate_limit=None):
         self.auth = (username, api_key) if username and api_key else None
+        if base_url:
+            # Point at a mirror or a local stand-in server (see benchmarks/)
+            self.BASE_URL = base_url.rstrip("/")
         
         self.nickname = nickname or "DanbooruDownloader"
         self.email = email or "unknown@example.com"
@@ -18,45 +51,129 @@ class DanbooruClient:
             "User-Agent": f"{self.nickname}/1.0 ({self.email})"
         }
         
-        self.session = requests.Session()
-        retries = Retry(total=5, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
-        adapter = HTTPAdapter(max_retries=retries)
-        self.session.mount("https://", adapter)
-        self.session.mount("http://", adapter)
+        self.session = TRANSPORT.session("api")
+        self.timeout = TRANSPORT.timeout("api")
+
+        # Cost accounting (read by watch mode to record what each poll cost)
+        self.request_count = 0
+        self.bytes_received = 0
+
+        # tags -> (count, fetched_at)
+        self.count_cache = {}
+
+        # Requests per second shared by every thread using this client (None/0 = unlimited)
+        self.rate_limiter = TokenBucket(rate_limit)
 
-    def fetch_posts(self, tags, limit=20, page=1):
+    @timed("api.request")
+    def _get(self, url, params, endpoint, headers=None):
+        """endpoint is the fixed metrics label of the call ("posts", "ids", "counts", "probe"), never the query."""
+        self.rate_limiter.acquire()
+        start = time.perf_counter()
+        try:
+            response = self.session.get(url, params=params, auth=self.auth, headers=headers or self.headers, timeout=self.timeout)
+        except requests.exceptions.RequestException:
+            API_REQUESTS.inc(endpoint=endpoint, status="error")
+            raise
+        finally:
+            API_LATENCY.observe(time.perf_counter() - start, endpoint=endpoint)
+        self.request_count += 1
+        self.bytes_received += len(response.content)
+        API_REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+        throttled = count_retried_status(response, 429) + (response.status_code == 429)
+        if throttled:
+            API_RATE_LIMITED.inc(throttled)
+        return response
+
+    def fetch_posts(self, tags, limit=20, page=1, raise_errors=False, only=None):
         """
         Fetch posts from Danbooru API.
+        page may be a page number or an id cursor ("b<id>" for posts below id,
+        "a<id>" for posts above id).
+        With raise_errors=True request failures are raised instead of being
+        reported as an empty page, so callers can tell "no more posts" apart.
+        only restricts the returned fields: a FIELD_PROFILES name or a field list.
         """
+        return self._fetch_posts(tags, limit, page, raise_errors, only, "posts")
+
+    def _fetch_posts(self, tags, limit, page, raise_errors, only, endpoint):
         params = {
             "tags": tags,
             "limit": limit,
             "page": page
         }
+        fields = resolve_fields(only)
+        if fields:
+            params["only"] = fields
         
         url = f"{self.BASE_URL}/posts.json"
         try:
-            response = self.session.get(url, params=params, auth=self.auth, headers=self.headers, timeout=10)
+            response = self._get(url, params, endpoint)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
+            if raise_errors:
+                raise
             print(f"Error fetching posts: {e}")
             return []
 
-    def get_post_counts(self, tags):
+    def fetch_posts_by_ids(self, post_ids, extra_tags="", raise_errors=False, only=None):
+        """
+        Fetch up to MAX_IDS_PER_REQUEST posts in one request with an id:1,2,3 query.
+        Ids that are deleted or not visible to this account are simply absent.
+        """
+        post_ids = list(post_ids)
+        if len(post_ids) > self.MAX_IDS_PER_REQUEST:
+            raise ValueError(f"At most {self.MAX_IDS_PER_REQUEST} ids per request")
+        tags = f"id:{','.join(str(i) for i in post_ids)} {extra_tags}".strip()
+        return self._fetch_posts(tags, self.MAX_IDS_PER_REQUEST, 1, raise_errors, only, "ids")
+
+    def get_post_counts(self, tags, use_cache=True):
         """
         Fetch the count of posts for the given tags.
+        Successful counts are cached per tag string for COUNT_CACHE_TTL seconds.
         """
+        key = " ".join(tags.split())
+        if use_cache:
+            cached = self.count_cache.get(key)
+            if cached and time.time() - cached[1] < self.COUNT_CACHE_TTL:
+                return cached[0]
+
         params = {"tags": tags}
         url = f"{self.BASE_URL}/counts/posts.json"
         try:
-            response = self.session.get(url, params=params, auth=self.auth, headers=self.headers, timeout=10)
+            response = self._get(url, params, "counts")
             response.raise_for_status()
             data = response.json()
-            return data.get("counts", {}).get("posts", 0)
+            count = data.get("counts", {}).get("posts", 0)
+            self.count_cache[key] = (count, time.time())
+            return count
         except Exception as e:
             print(f"Error fetching counts: {e}")
             return 0
 
+    def probe_newest_id(self, tags, etag=None):
+        """
+        Cheap "anything new?" check: fetch only the newest post for tags.
+        If etag is given it is sent as If-None-Match, so an unchanged result
+        costs a 304 with no body.
+        Returns (newest_id, etag, not_modified). newest_id is None on error or not_modified.
+        """
+        params = {"tags": tags, "limit": 1, "only": FIELD_PROFILES["id"]}
+        headers = dict(self.headers)
+        if etag:
+            headers["If-None-Match"] = etag
+        url = f"{self.BASE_URL}/posts.json"
+        try:
+            response = self._get(url, params, "probe", headers=headers)
+            if response.status_code == 304:
+                return None, etag, True
+            response.raise_for_status()
+            posts = response.json()
+            newest_id = posts[0]["id"] if posts else 0
+            return newest_id, response.headers.get("ETag"), False
+        except Exception as e:
+            print(f"Error probing newest post: {e}")
+            return None, etag, False
+
     # get_post_count was duplicate of get_post_counts
     # Removed for cleanup
@@ -0,0 +1,249 @@
+"""
+How downloads are written to disk.
+
+One DiskWriter holds the write policy for all transfers of a
+DownloadManager:
+
+    buffer_size   writes are coalesced into blocks of this size (default 1 MB)
+                  instead of one write per 64 KB network chunk
+    preallocate   reserve the whole file up front when its size is known, so
+                  it isn't fragmented across a disk that many workers fill at once
+    direct        O_DIRECT large aligned writes that bypass the page cache
+                  (Linux; ignored where unsupported)
+    fsync         "none"  leave flushing to the OS (the old behaviour)
+                  "file"  fsync every file before it is moved into place
+                  "batch" fsync finished files together, every fsync_interval
+                          seconds and whenever flush() is called, which the
+                          bulk engine does before it records a page as done.
+                          Files keep their .part names until then, so a crash
+                          never leaves an unsynced file under its final name
+                  Archive shards (archive.py) follow the same policy.
+
+    python -m benchmarks.disk_bench --posts 400
+"""
+import os
+import sys
+import mmap
+import time
+import threading
+from metrics import DISK_FSYNC_SECONDS
+
+FSYNC_POLICIES = ("none", "file", "batch")
+ALIGNMENT = 4096
+
+class _BufferedSink:
+    """File object for one download; Python's BufferedWriter does the coalescing."""
+
+    def __init__(self, path, size, writer):
+        self.path = path
+        self.writer = writer
+        self.f = open(path, 'wb', buffering=writer.buffer_size)
+        self.preallocated = writer.preallocate and size and _preallocate(self.f.fileno(), size)
+        self.written = 0
+
+    def write(self, data):
+        self.f.write(data)
+        self.written += len(data)
+
+    def close(self):
+        try:
+            self.f.flush()
+            if self.preallocated:
+                self.f.truncate(self.written) # the body may have ended short, or been stopped
+            if self.writer.fsync == "file":
+                self.writer.sync_fd(self.f.fileno())
+        finally:
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class _DirectSink:
+    """
+    O_DIRECT writes from a page-aligned buffer. The last, partial block is
+    written padded and the file cut back to its real length afterwards.
+    """
+
+    def __init__(self, path, size, writer):
+        self.path = path
+        self.writer = writer
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_DIRECT, 0o644)
+        self.buffer = mmap.mmap(-1, writer.buffer_size) # anonymous maps are page aligned
+        self.view = memoryview(self.buffer)
+        self.used = 0
+        self.written = 0
+        if writer.preallocate and size:
+            _preallocate(self.fd, size)
+
+    def write(self, data):
+        data = memoryview(data)
+        self.written += len(data)
+        while data:
+            n = min(len(data), len(self.buffer) - self.used)
+            self.view[self.used:self.used + n] = data[:n]
+            self.used += n
+            data = data[n:]
+            if self.used == len(self.buffer):
+                self._write_out(self.used)
+
+    def _write_out(self, length):
+        done = 0
+        while done < length:
+            done += os.write(self.fd, self.view[done:length])
+        self.used = 0
+
+    def close(self):
+        try:
+            if self.used:
+                self._write_out((self.used + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT)
+            os.ftruncate(self.fd, self.written)
+            if self.writer.fsync == "file":
+                self.writer.sync_fd(self.fd)
+        finally:
+            self.view.release()
+            self.buffer.close()
+            os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _preallocate(fd, size):
+    """Reserve size bytes for fd. Returns False where the OS or filesystem can't."""
+    try:
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(fd, 0, size)
+        elif sys.platform == "win32":
+            os.ftruncate(fd, size) # NTFS allocates the clusters when the end of file moves
+        else:
+            return False
+        return True
+    except OSError:
+        return False
+
+class DiskWriter:
+    def __init__(self, buffer_size=1048576, preallocate=True, direct=False, fsync="none", fsync_interval=5.0):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy {fsync!r}, expected one of {', '.join(FSYNC_POLICIES)}")
+        self.buffer_size = max(ALIGNMENT, (int(buffer_size) + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT)
+        self.preallocate = preallocate
+        self.direct = direct and hasattr(os, "O_DIRECT")
+        if direct and not self.direct:
+            print("O_DIRECT isn't available on this platform; using buffered writes")
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.pending = [] # (path, final path or None, on_placed) awaiting a batched fsync
+        self.closed = False
+        self.last_sync = time.monotonic()
+        self.fsync_count = 0
+        self.fsync_seconds = 0.0
+
+    def open(self, path, size=None):
+        """A sink with write() and close() (also a context manager) for path; size enables preallocation."""
+        if self.direct:
+            try:
+                return _DirectSink(path, size, self)
+            except OSError as e:
+                # tmpfs and some network filesystems refuse O_DIRECT
+                print(f"O_DIRECT unavailable for {os.path.dirname(path) or '.'} ({e}); using buffered writes")
+                self.direct = False
+        return _BufferedSink(path, size, self)
+
+    def sync_fd(self, fd):
+        start = time.perf_counter()
+        os.fsync(fd)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.fsync_count += 1
+            self.fsync_seconds += elapsed
+        DISK_FSYNC_SECONDS.observe(elapsed)
+
+    def place(self, part_path, path, on_placed=None):
+        """
+        Move the finished part_path to path and call on_placed once it is
+        there. Under "batch" the move waits for the batch's fsync.
+        """
+        if self.fsync == "batch" and not self.closed:
+            self._queue(part_path, path, on_placed)
+            return
+        if self.fsync == "batch":
+            self._sync_path(part_path) # a retired writer syncs right away
+        os.replace(part_path, path)
+        if self.fsync != "none":
+            self._sync_dirs([os.path.dirname(path)])
+        if on_placed:
+            on_placed()
+
+    def finished(self, path):
+        """path is in its final place. Makes it (and its directory entry) durable per the fsync policy."""
+        if self.fsync == "file":
+            self._sync_dirs([os.path.dirname(path)])
+        elif self.fsync == "batch":
+            self._queue(path, None, None)
+
+    def _queue(self, path, final_path, on_placed):
+        with self.lock:
+            self.pending.append((path, final_path, on_placed))
+            due = time.monotonic() - self.last_sync >= self.fsync_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        """fsync every finished file that is still waiting for the batch, then move it into place."""
+        with self.lock:
+            items, self.pending = self.pending, []
+            self.last_sync = time.monotonic()
+        placed = []
+        for path, final_path, on_placed in items:
+            if not self._sync_path(path):
+                continue # moved or deleted since
+            if final_path:
+                try:
+                    os.replace(path, final_path)
+                except OSError as e:
+                    print(f"Could not move {path} into place: {e}")
+                    continue
+            placed.append((final_path or path, on_placed))
+        self._sync_dirs({os.path.dirname(p) for p, _ in placed})
+        for _, on_placed in placed:
+            if on_placed:
+                on_placed()
+
+    def close(self):
+        """Flush, and move files handed over later into place right away."""
+        self.closed = True
+        self.flush()
+
+    def _sync_path(self, path):
+        try:
+            fd = os.open(path, os.O_RDWR) # Windows only flushes handles opened for writing
+        except OSError:
+            return False
+        try:
+            self.sync_fd(fd)
+        finally:
+            os.close(fd)
+        return True
+
+    def _sync_dirs(self, folders):
+        if sys.platform == "win32":
+            return # directories can't be opened for fsync; NTFS journals the rename
+        for folder in folders:
+            try:
+                fd = os.open(folder or ".", os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                self.sync_fd(fd)
+            finally:
+                os.close(fd)
+
+    def report(self):
+        return {"buffer_size": self.buffer_size, "preallocate": self.preallocate, "direct": self.direct,
+                "fsync": self.fsync, "fsyncs": self.fsync_count, "fsync_seconds": round(self.fsync_seconds, 3)}
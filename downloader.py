@@ -1,23 +1,165 @@
 import os
+import time
+import socket
+import hashlib
+import sqlite3
 import requests
 import threading
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+from profiling import timed
+from transport import TRANSPORT
+from layout import folder_layout, locate
+from content_index import ContentIndex, materialize
+from archive import ArchiveWriter, DEFAULT_SHARD_SIZE
+from disk_writer import DiskWriter
+from postprocess import PostProcessor
+from metadata_sidecar import MetadataSidecar, SIDECAR_FILE
+from throttle import TokenBucket, ConcurrencyGate
+from autotune import ConcurrencyTuner
+from metrics import (DOWNLOAD_BYTES, DOWNLOAD_FILES, DOWNLOAD_ERRORS, DOWNLOADS_IN_FLIGHT, DOWNLOAD_RATE_LIMITED,
+                     DOWNLOAD_BYTES_SAVED, DOWNLOAD_CONCURRENCY_LIMIT, DOWNLOAD_STALLS, DOWNLOAD_HEDGES, count_retried_status)
+
+class IncompleteDownloadError(Exception):
+    """The body ended early or didn't match the size/md5 the API reported."""
+
+class StalledTransferError(IncompleteDownloadError):
+    """The stall detector aborted a transfer that was receiving too few bytes."""
+
+class _Stream:
+    """One HTTP request of a transfer, as seen by the monitor thread."""
+
+    def __init__(self, url):
+        self.url = url
+        self.response = None
+        self.bytes = 0
+        self.check_time = None
+        self.check_bytes = 0
+        self.abort_reason = None
+
+    def attach(self, response):
+        self.response = response
+        self.check_time = time.monotonic()
+
+class _Transfer:
+    """A file being fetched: the primary request and, if it runs slow, a hedged one."""
+
+    def __init__(self, url, save_path, expected_size, expected_md5, archive=None):
+        self.url = url
+        self.save_path = save_path
+        self.archive = archive
+        self.expected_size = expected_size
+        self.expected_md5 = expected_md5
+        self.started = time.monotonic()
+        self.primary = _Stream(url)
+        self.hedge = None
+        self.hedge_done = threading.Event()
+        self.lock = threading.Lock()
+        self.winner = None
+        self.size = None
+        self.part_path = None # the winner's verified copy, for the caller to place
+
+    def streams(self):
+        return [self.primary] + ([self.hedge] if self.hedge else [])
+
+    def finish(self, role, part_path, size):
+        """Claim a verified copy unless the other request already did; archived copies are stored right away."""
+        with self.lock:
+            if self.winner:
+                return False
+            if self.archive:
+                self.archive.add_file(part_path, os.path.basename(self.save_path), self.expected_md5)
+                os.remove(part_path)
+            else:
+                self.part_path = part_path
+            self.winner = role
+            self.size = size
+            return True
 
 class DownloadManager:
-    def __init__(self, max_workers=8):
-        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+    CHUNK_SIZE = 65536
+    MAX_AUTO_WORKERS = 32
+    MONITOR_INTERVAL = 0.5
+    HEDGE_MIN_SAMPLES = 20
+
+    def __init__(self, max_workers=8, bandwidth_limit=0, auto_concurrency=False, autotune_log=None):
+        # Transfers are admitted through a gate, so the number running at once
+        # can change without rebuilding the pool. In auto mode the pool is
+        # sized for the tuner's upper bound and max_workers is the start value.
+        pool_size = self.MAX_AUTO_WORKERS if auto_concurrency else max_workers
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+        self.gate = ConcurrencyGate(max_workers)
         self.active_downloads = []
         self.stop_event = threading.Event()
         self.pause_event = threading.Event()
         self.pause_event.set() # Start unpaused (set means go)
-        self.session = requests.Session()
-        
-        retries = Retry(total=5, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])
-        adapter = HTTPAdapter(max_retries=retries)
-        self.session.mount("https://", adapter)
-        self.session.mount("http://", adapter)
+        self.session = TRANSPORT.session("files")
+        self.stats_lock = threading.Lock()
+        self.bytes_downloaded = 0
+        self.files_downloaded = 0
+        self.in_flight = {} # save_path -> on_stored callbacks of the batches that skipped it meanwhile
+        # Raw signals for the concurrency tuner
+        self.bytes_transferred = 0 # every chunk received, including failed attempts
+        self.attempt_count = 0
+        self.error_count = 0
+        self.throttled_count = 0
+        self.ttfb_samples = deque(maxlen=500)
+        # Stall detection: abort a transfer receiving less than stall_min_rate
+        # bytes/s over stall_window seconds, so it is retried on a new connection
+        self.stall_window = 15
+        self.stall_min_rate = 4096
+        self.stall_count = 0
+        # Hedging: once a transfer has run longer than hedge_percentile of recent
+        # ones (scaled by size), race it with a second request (0 = off)
+        self.hedge_percentile = 95
+        self.hedge_min_delay = 5
+        self.max_hedges = 2
+        self.hedges_running = 0
+        self.hedge_executor = ThreadPoolExecutor(max_workers=self.max_hedges, thread_name_prefix="hedge")
+        self.seconds_per_byte = deque(maxlen=200)
+        self.transfers = set()
+        self._monitor_thread = None
+        self.closed = threading.Event() # ends the monitor thread
+        self.timeout = TRANSPORT.timeout("files")
+        # Folder layout for new files (see layout.py); a folder's own marker wins
+        self.layout = "flat"
+        # md5 index over all folders: content already on disk is linked, not downloaded
+        self.content_index = None
+        self.files_linked = 0
+        self.bytes_saved = 0
+        # Archive output (see archive.py): bulk batches go into zip/tar shards, not loose files
+        self.archive_format = None
+        self.archive_shard_size = DEFAULT_SHARD_SIZE
+        self.archive_prefix = "posts"
+        self.archives = {}
+        # Buffering, preallocation and fsync policy for the files being written
+        self.chunk_size = self.CHUNK_SIZE
+        self.disk = DiskWriter()
+        # Stages run on each saved file in a process pool (see postprocess.py)
+        self.postprocess = None
+        # Metadata of every post saved by a batch, appended to <folder>/metadata.jsonl
+        self.metadata_sidecar = False
+        self.metadata_file = SIDECAR_FILE
+        self.sidecars = {}
+        self.max_attempts = 3
+        self.retry_backoff = 0.5
+        # Global cap in bytes/s shared by all workers (0 = unlimited)
+        self.bandwidth = TokenBucket(0)
+        self.set_bandwidth_limit(bandwidth_limit)
+        # One keep-alive connection per transfer, hedges included
+        TRANSPORT.ensure_pool_size("files", pool_size + self.max_hedges)
+
+        DOWNLOAD_CONCURRENCY_LIMIT.set(max_workers)
+        self.tuner = None
+        if auto_concurrency:
+            self.tuner = ConcurrencyTuner(self, max_limit=self.MAX_AUTO_WORKERS, log_path=autotune_log).start()
+
+    def set_bandwidth_limit(self, bytes_per_second):
+        """Change the cap at any time; transfers in progress follow the new rate."""
+        bytes_per_second = max(0, int(bytes_per_second or 0))
+        # Allow a quarter second of burst, but at least one chunk
+        self.bandwidth.set_rate(bytes_per_second, max(self.chunk_size, bytes_per_second / 4))
+        self.bandwidth_limit = bytes_per_second
 
     def toggle_pause(self):
         if self.pause_event.is_set():
@@ -27,30 +169,248 @@ class DownloadManager:
             self.pause_event.set() # Resume
             return False # Resumed
 
-    def download_image(self, url, save_path, callback_progress=None, callback_complete=None, callback_error=None):
+    def download_image(self, url, save_path, callback_progress=None, callback_complete=None, callback_error=None, expected_size=None, expected_md5=None, archive=None, on_stored=None):
+        """
+        archive: an ArchiveWriter to store the file in instead; save_path
+        then only names the member (and where the .part file is staged).
+        on_stored: called with the file's final path once it is known, i.e.
+        after post-processing, which may rename it.
+        """
         if self.stop_event.is_set():
             return
 
+        owner = False
         try:
-            if os.path.exists(save_path):
+            with self.stats_lock:
+                # Being fetched (or post-processed) by another batch, or already on disk
+                waiters = self.in_flight.get(save_path)
+                if waiters is not None:
+                    skipped = True
+                    if on_stored:
+                        waiters.append(on_stored) # recorded once the owner knows the final path
+                    on_stored = None
+                else:
+                    skipped = archive.has(os.path.basename(save_path)) if archive else os.path.exists(save_path)
+                    if not skipped:
+                        self.in_flight[save_path] = []
+                        owner = True
+            if skipped:
+                DOWNLOAD_FILES.inc(result="skipped")
+                self._index(save_path, expected_md5, expected_size)
                 if callback_complete:
                     callback_complete(save_path, skipped=True)
+                if on_stored:
+                    on_stored(save_path)
                 return
 
-            response = self.session.get(url, stream=True, timeout=30)
+            if self._link_existing(save_path, expected_md5, expected_size, archive):
+                if callback_complete:
+                    callback_complete(save_path, skipped=False)
+                self._postprocess(save_path, archive, on_stored)
+                return
+
+            DOWNLOADS_IN_FLIGHT.inc()
+            try:
+                result = None
+                for attempt in range(1, self.max_attempts + 1):
+                    if not self.gate.acquire(self.stop_event):
+                        break # Stopped while waiting for a slot
+                    try:
+                        result = self._transfer(url, save_path, callback_progress, expected_size, expected_md5, archive)
+                        break
+                    except (requests.exceptions.RequestException, IncompleteDownloadError) as e:
+                        with self.stats_lock:
+                            self.error_count += 1
+                        # Errors in the middle of a body aren't covered by the adapter's Retry
+                        if attempt == self.max_attempts or self.stop_event.is_set():
+                            raise
+                        print(f"Retrying {url} ({attempt}/{self.max_attempts}): {e}")
+                    finally:
+                        self.gate.release()
+                    self.stop_event.wait(self.retry_backoff * attempt)
+            finally:
+                DOWNLOADS_IN_FLIGHT.dec()
+
+            if result is None:
+                self._release(save_path)
+                return # Stopped
+            downloaded_size, part_path = result
+
+            with self.stats_lock:
+                self.bytes_downloaded += downloaded_size
+                self.files_downloaded += 1
+            DOWNLOAD_BYTES.inc(downloaded_size)
+            DOWNLOAD_FILES.inc(result="downloaded")
+
+            def placed():
+                try:
+                    self._index(save_path, expected_md5, downloaded_size)
+                    if callback_complete:
+                        callback_complete(save_path, skipped=False)
+                    self._postprocess(save_path, archive, on_stored)
+                except Exception as e:
+                    self._release(save_path)
+                    DOWNLOAD_ERRORS.inc(type=type(e).__name__)
+                    if callback_error:
+                        callback_error(str(e))
+
+            if archive:
+                placed()
+            else:
+                # Under the "batch" fsync policy this waits for the batch (see disk_writer.py)
+                self.disk.place(part_path, save_path, placed)
+
+        except Exception as e:
+            if owner:
+                self._release(save_path)
+            DOWNLOAD_ERRORS.inc(type=type(e).__name__)
+            if callback_error:
+                callback_error(str(e))
+
+    def _postprocess(self, save_path, archive, on_stored):
+        def stored(path):
+            if on_stored:
+                on_stored(path)
+            self._release(save_path, path)
+        if self.postprocess and not archive:
+            # Blocks while the stages are behind, which slows this worker down with them
+            if self.postprocess.submit(save_path, self.stop_event, stored):
+                return
+        stored(save_path)
+
+    def _release(self, save_path, final_path=None):
+        """save_path is done (final_path is where it ended up) or abandoned (None); records it for the batches that skipped it."""
+        with self.stats_lock:
+            waiters = self.in_flight.pop(save_path, [])
+        if final_path:
+            for on_stored in waiters:
+                on_stored(final_path)
+
+    def _link_existing(self, save_path, expected_md5, expected_size, archive=None):
+        """
+        If the content index knows a file with this md5 anywhere, put it at
+        save_path (or into archive) without touching the network. Returns
+        True if it did.
+        """
+        if not (self.content_index and expected_md5):
+            return False
+        try:
+            source = self.content_index.find(expected_md5, expected_size, exclude=save_path)
+            if not source:
+                return False
+            if archive:
+                archive.add_file(source, os.path.basename(save_path), expected_md5)
+                method = "archive"
+                size = os.path.getsize(source)
+            else:
+                method = materialize(source, save_path)
+                size = os.path.getsize(save_path)
+                self.content_index.add(expected_md5, save_path, size)
+        except (OSError, sqlite3.Error) as e:
+            print(f"Couldn't reuse existing copy for {save_path}, downloading it: {e}")
+            return False
+        with self.stats_lock:
+            self.files_linked += 1
+            self.bytes_saved += size
+        DOWNLOAD_BYTES_SAVED.inc(size, method=method)
+        DOWNLOAD_FILES.inc(result="linked")
+        return True
+
+    def _index(self, save_path, md5, size):
+        """Record a file that is in place so other folders can link to it."""
+        if not (self.content_index and md5):
+            return
+        try:
+            actual = os.path.getsize(save_path)
+            if size is None or actual == size:
+                self.content_index.add(md5, save_path, actual)
+        except (OSError, sqlite3.Error):
+            pass # Not there (yet); it's indexed when it lands
+
+    @timed("download.transfer")
+    def _transfer(self, url, save_path, callback_progress, expected_size, expected_md5, archive=None):
+        """
+        Stream url into a hidden .part file next to save_path; the caller
+        moves it into place only once it is complete and verified, so an
+        interrupted or corrupt transfer never looks like a finished file.
+        While it runs, the monitor thread may abort it as stalled or race it
+        with a hedged request; whichever verified copy lands first wins.
+        Returns (bytes written, the verified .part file or None if it went
+        into archive), or None if stopped.
+        """
+        folder, name = os.path.split(save_path)
+        os.makedirs(folder, exist_ok=True) # shard directories are created on first use
+        part_path = os.path.join(folder, f".{name}.part")
+        transfer = _Transfer(url, save_path, expected_size, expected_md5, archive)
+        self._register(transfer)
+        try:
+            try:
+                size = self._stream(transfer.primary, part_path, callback_progress, expected_size, expected_md5)
+            except Exception:
+                self._remove(part_path)
+                if self.stop_event.is_set():
+                    return None
+                if transfer.hedge:
+                    # Our connection failed or was stalled, but the hedge may still deliver
+                    transfer.hedge_done.wait()
+                if transfer.winner == "hedge":
+                    return transfer.size, transfer.part_path
+                raise
+
+            if size is None: # Stopped
+                self._remove(part_path)
+                return None
+            if transfer.finish("primary", part_path, size):
+                elapsed = time.monotonic() - transfer.started
+                if size:
+                    with self.stats_lock:
+                        self.seconds_per_byte.append(elapsed / size)
+                return size, transfer.part_path
+            self._remove(part_path) # The hedge got there first
+            return transfer.size, transfer.part_path
+        finally:
+            self._unregister(transfer)
+            if transfer.hedge:
+                self._abort(transfer.hedge, "primary finished")
+
+    def _stream(self, stream, part_path, callback_progress, expected_size, expected_md5):
+        """
+        One request for stream.url into part_path, verified against the
+        declared and expected size/md5. Returns the size, or None if stopped.
+        """
+        with self.stats_lock:
+            self.attempt_count += 1
+        response = self.session.get(stream.url, stream=True, timeout=self.timeout)
+        throttled = count_retried_status(response, 429) + (response.status_code == 429)
+        with self.stats_lock:
+            self.throttled_count += throttled
+            self.ttfb_samples.append(response.elapsed.total_seconds())
+        if throttled:
+            DOWNLOAD_RATE_LIMITED.inc(throttled)
+        stream.attach(response)
+        try:
             response.raise_for_status()
-            
+
             total_size = int(response.headers.get('content-length', 0))
             downloaded_size = 0
+            md5 = hashlib.md5() if expected_md5 else None
 
-            with open(save_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=65536):
+            with self.disk.open(part_path, expected_size or total_size) as f:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
                     if self.stop_event.is_set():
                         # We need to break to close the file via 'with' context
                         break
+                    if stream.abort_reason:
+                        raise IncompleteDownloadError(f"Aborted: {stream.abort_reason}")
                     
-                    # Wait if paused
-                    self.pause_event.wait()
+                    # Wait if paused, then for our share of the bandwidth.
+                    # A pause or cancel during that wait is picked up straight away.
+                    while True:
+                        self.pause_event.wait()
+                        if self.stop_event.is_set():
+                            break
+                        if self.bandwidth.acquire(len(chunk), self.stop_event, self.pause_event):
+                            break
                     
                     # Check stop again in case we were paused and then cancelled
                     if self.stop_event.is_set():
@@ -58,26 +418,155 @@ class DownloadManager:
 
                     if chunk:
                         f.write(chunk)
+                        if md5:
+                            md5.update(chunk)
                         downloaded_size += len(chunk)
+                        stream.bytes = downloaded_size
+                        with self.stats_lock:
+                            self.bytes_transferred += len(chunk)
                         if callback_progress and total_size > 0:
                             progress = downloaded_size / total_size
                             callback_progress(progress)
-            
-            # Outside 'with' block, file is closed. Check if we stopped.
+            encoded = 'content-encoding' in response.headers
+        except Exception as e:
+            if stream.abort_reason == "stalled":
+                raise StalledTransferError(f"Stalled below {self.stall_min_rate} B/s, aborted") from e
+            raise
+        finally:
+            response.close()
+
+        # Outside 'with' block, file is closed. Check if we stopped.
+        if self.stop_event.is_set():
+            return None
+
+        if total_size and not encoded and downloaded_size != total_size:
+            raise IncompleteDownloadError(f"Got {downloaded_size} of {total_size} bytes")
+        if expected_size and downloaded_size != expected_size:
+            raise IncompleteDownloadError(f"Size mismatch: got {downloaded_size}, expected {expected_size}")
+        if md5 and md5.hexdigest() != expected_md5:
+            raise IncompleteDownloadError("MD5 mismatch")
+        return downloaded_size
+
+    # --- Stall detection and hedging ---
+
+    def _register(self, transfer):
+        with self.stats_lock:
+            self.transfers.add(transfer)
+            if self._monitor_thread is None:
+                self._monitor_thread = threading.Thread(target=self._monitor, name="transfer-monitor", daemon=True)
+                self._monitor_thread.start()
+
+    def _unregister(self, transfer):
+        with self.stats_lock:
+            self.transfers.discard(transfer)
+
+    def _abort(self, stream, reason):
+        """Unblock a read in progress on another thread by shutting the socket down."""
+        if stream.abort_reason:
+            return
+        stream.abort_reason = reason
+        try:
+            if hasattr(stream.response, "abort"):
+                stream.response.abort() # HTTP/2: reset the stream, the connection is shared
+            else:
+                stream.response.raw.connection.sock.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass # Not connected yet, or already finished
+
+    def _monitor(self):
+        while not self.closed.wait(self.MONITOR_INTERVAL):
+            with self.stats_lock:
+                transfers = list(self.transfers)
+            if not transfers:
+                continue
+            now = time.monotonic()
             if self.stop_event.is_set():
-                if os.path.exists(save_path):
-                    try:
-                        os.remove(save_path)
-                    except:
-                        pass
-                return
+                # A connection that is trickling wouldn't notice the stop until its next chunk
+                for transfer in transfers:
+                    for stream in transfer.streams():
+                        self._abort(stream, "stopped")
+                continue
+
+            paused = not self.pause_event.is_set()
+            streams = [s for t in transfers for s in t.streams() if s.response is not None and not s.abort_reason]
+            min_rate = self.stall_min_rate
+            if self.bandwidth_limit and streams:
+                # Don't mistake our own throttling for a stall
+                min_rate = min(min_rate, self.bandwidth_limit / len(streams) / 2)
+            for stream in streams:
+                if paused:
+                    stream.check_time, stream.check_bytes = now, stream.bytes
+                    continue
+                if now - stream.check_time < self.stall_window:
+                    continue
+                rate = (stream.bytes - stream.check_bytes) / (now - stream.check_time)
+                stream.check_time, stream.check_bytes = now, stream.bytes
+                if min_rate and rate < min_rate:
+                    print(f"Stalled transfer ({rate:.0f} B/s over {self.stall_window}s), aborting: {stream.url}")
+                    DOWNLOAD_STALLS.inc()
+                    with self.stats_lock:
+                        self.stall_count += 1
+                    self._abort(stream, "stalled")
+
+            if not paused:
+                for transfer in transfers:
+                    if self._should_hedge(transfer, now):
+                        self._start_hedge(transfer)
 
-            if callback_complete:
-                callback_complete(save_path, skipped=False)
+    def _hedge_threshold(self, transfer):
+        """Seconds after which transfer is slower than hedge_percentile of recent transfers, or None."""
+        size = transfer.expected_size
+        if not size and transfer.primary.response is not None:
+            size = int(transfer.primary.response.headers.get('content-length', 0))
+        with self.stats_lock:
+            samples = sorted(self.seconds_per_byte)
+        if not size or len(samples) < self.HEDGE_MIN_SAMPLES:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * self.hedge_percentile / 100))
+        return max(self.hedge_min_delay, samples[index] * size)
+
+    def _should_hedge(self, transfer, now):
+        if not self.hedge_percentile or transfer.hedge or transfer.winner or self.hedges_running >= self.max_hedges:
+            return False
+        threshold = self._hedge_threshold(transfer)
+        return threshold is not None and now - transfer.started > threshold
+
+    def _start_hedge(self, transfer):
+        with self.stats_lock:
+            if self.hedges_running >= self.max_hedges:
+                return
+            self.hedges_running += 1
+        transfer.hedge = _Stream(transfer.url)
+        print(f"Hedging slow transfer: {transfer.url}")
+        self.hedge_executor.submit(self._run_hedge, transfer)
 
+    def _run_hedge(self, transfer):
+        folder, name = os.path.split(transfer.save_path)
+        part_path = os.path.join(folder, f".{name}.hedge.part")
+        result = "lost"
+        try:
+            size = self._stream(transfer.hedge, part_path, None, transfer.expected_size, transfer.expected_md5)
+            if size is not None and transfer.finish("hedge", part_path, size):
+                result = "won"
+                self._abort(transfer.primary, "hedge won")
         except Exception as e:
-            if callback_error:
-                callback_error(str(e))
+            if not transfer.hedge.abort_reason:
+                result = "failed"
+                print(f"Hedged request failed for {transfer.url}: {e}")
+        finally:
+            if result != "won":
+                self._remove(part_path)
+            DOWNLOAD_HEDGES.inc(result=result)
+            with self.stats_lock:
+                self.hedges_running -= 1
+            transfer.hedge_done.set()
+
+    def _remove(self, path):
+        if os.path.exists(path):
+            try:
+                os.remove(path)
+            except:
+                pass
 
     def start_download_batch(self, posts, output_dir, callbacks):
         """
@@ -88,6 +577,9 @@ class DownloadManager:
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
 
+        layout = folder_layout(output_dir, self.layout)
+        archive = self._archive(output_dir) if self.archive_format else None
+        sidecar = self._sidecar(output_dir) if self.metadata_sidecar else None
         futures = []
         for post in posts:
             if self.stop_event.is_set():
@@ -97,26 +589,134 @@ class DownloadManager:
             if not file_url:
                 continue
                 
-            file_ext = post.get('file_ext', 'jpg')
-            file_name = f"{post['id']}.{file_ext}"
-            save_path = os.path.join(output_dir, file_name)
+            if archive:
+                # Only names the member; the file never lands loose in the folder
+                save_path = os.path.join(output_dir, f"{post['id']}.{post.get('file_ext', 'jpg')}")
+            else:
+                # Existing files are found in any layout, so they are skipped
+                save_path = locate(output_dir, post, layout)
 
-            # Create a closure to capture specific post info if needed, 
-            # but for now passing generic callbacks
             future = self.executor.submit(
                 self.download_image, 
                 file_url, 
                 save_path, 
                 callbacks.get('on_progress'), 
                 callbacks.get('on_complete'),
-                callbacks.get('on_error')
+                callbacks.get('on_error'),
+                post.get('file_size'),
+                post.get('md5'),
+                archive,
+                self._recording(sidecar, post, output_dir) if sidecar else None
             )
             futures.append(future)
         
         return futures
 
+    @property
+    def bulk_fields(self):
+        """The only= profile bulk callers should fetch posts with."""
+        return "metadata" if self.metadata_sidecar else "bulk"
+
+    def _recording(self, sidecar, post, folder):
+        def on_stored(path):
+            sidecar.add(post, os.path.relpath(path, folder))
+        return on_stored
+
+    def _sidecar(self, folder):
+        with self.stats_lock:
+            sidecar = self.sidecars.get(folder)
+            if sidecar is None:
+                sidecar = MetadataSidecar(folder, self.metadata_file)
+                self.sidecars[folder] = sidecar
+            return sidecar
+
+    def apply_settings(self, settings):
+        """Take the transfer, storage and post-processing options from a load_settings() dict."""
+        self.stall_window = settings.get("stall_window", self.stall_window)
+        self.stall_min_rate = settings.get("stall_min_rate", self.stall_min_rate)
+        self.hedge_percentile = settings.get("hedge_percentile", self.hedge_percentile)
+        self.layout = settings.get("layout", self.layout)
+        index_path = settings.get("content_index") if settings.get("dedup", False) else None
+        if self.content_index and self.content_index.path != index_path:
+            self.content_index.close()
+            self.content_index = None
+        if index_path and not self.content_index:
+            self.content_index = ContentIndex(index_path)
+        self.archive_format = settings.get("archive_format") or None
+        self.metadata_sidecar = settings.get("metadata_sidecar", self.metadata_sidecar)
+        if settings.get("archive_shard_mb"):
+            self.archive_shard_size = settings["archive_shard_mb"] * 1024 * 1024
+        if settings.get("write_chunk_kb"):
+            self.chunk_size = settings["write_chunk_kb"] * 1024
+            self.set_bandwidth_limit(self.bandwidth_limit)
+        if "write_buffer_kb" in settings:
+            self.disk.close() # transfers still running place their files without it
+            self.disk = DiskWriter(buffer_size=settings["write_buffer_kb"] * 1024,
+                                   preallocate=settings.get("preallocate", True),
+                                   direct=settings.get("direct_io", False),
+                                   fsync=settings.get("fsync", "none"))
+        stages = [s.strip() for s in settings.get("postprocess", "").split(",") if s.strip()]
+        if stages != (self.postprocess.stages if self.postprocess else []):
+            if self.postprocess:
+                self.postprocess.shutdown()
+            self.postprocess = PostProcessor(stages, settings.get("postprocess_workers", 0)) if stages else None
+
+    def _archive(self, folder):
+        with self.stats_lock:
+            writer = self.archives.get(folder)
+            if writer is None or writer.format != self.archive_format or writer.disk is not self.disk:
+                if writer:
+                    writer.close()
+                writer = ArchiveWriter(folder, self.archive_format, self.archive_shard_size, self.archive_prefix, disk=self.disk)
+                self.archives[folder] = writer
+            return writer
+
+    def flush(self):
+        """
+        Make what was written so far durable: finalize the open archive shards,
+        write buffered metadata rows (waiting for the post-processing they
+        depend on) and run the batched fsync. Called once a page or batch
+        is done.
+        """
+        with self.stats_lock:
+            writers = list(self.archives.values()) + list(self.sidecars.values())
+            recording = bool(self.sidecars)
+        self.disk.flush() # files waiting for the batch are moved into place and handed on
+        if self.postprocess and recording:
+            self.postprocess.wait() # the page's metadata rows are added once its files are processed
+        for writer in writers:
+            writer.flush()
+        self.disk.flush() # the shards just finalized
+
+    def close(self):
+        """
+        Finish queued post-processing, flush writes and let the worker threads
+        go. Call before the process exits or the manager is replaced.
+        """
+        if self.postprocess:
+            self.postprocess.shutdown() # first: finished files still add their metadata rows
+            for stage, s in self.postprocess.report().items():
+                print(f"Post-processing {stage}: {s['files']} files, {s['avg_ms']} ms avg, {s['errors']} errors")
+            self.postprocess = None
+        self.flush()
+        with self.stats_lock:
+            sidecars, self.sidecars = list(self.sidecars.values()), {}
+        for sidecar in sidecars:
+            sidecar.close()
+        self.disk.close()
+        self.closed.set()
+        if self.tuner:
+            self.tuner.stop()
+        self.executor.shutdown(wait=False)
+        self.hedge_executor.shutdown(wait=False)
+
     def stop_all(self):
         self.stop_event.set()
         self.pause_event.set() # Unpause so waiting threads can check stop_event and exit
+        with self.stats_lock:
+            transfers = list(self.transfers)
+        for transfer in transfers:
+            for stream in transfer.streams():
+                self._abort(stream, "stopped")
         # Do not shutdown executor, so it can be reused.
         # self.executor.shutdown(wait=False)
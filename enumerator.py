@@ -0,0 +1,106 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+def find_id_bounds(api, tags):
+    """(lowest id, highest id) of the posts matching tags, or None if there are none. Two requests."""
+    newest = api.fetch_posts(tags, limit=1, page=1, raise_errors=True, only="id")
+    if not newest:
+        return None
+    oldest = api.fetch_posts(tags, limit=1, page="a0", raise_errors=True, only="id")
+    return oldest[0]['id'], newest[0]['id']
+
+class RangeEnumerator:
+    """
+    Walks a query newest to oldest with several id-range chunks in flight.
+
+    After a first page (which shows how densely the query's posts are spread
+    over ids), the span down to the lowest id is cut into chunks sized to hold
+    about PAGES_PER_CHUNK pages each. Up to `partitions` chunks are fetched at
+    once, each by walking b<id> cursors inside its range, and pages are
+    yielded strictly in id order. That keeps SyncEngine's "everything above
+    lowest_id is done" resume state valid while the metadata stage runs in
+    parallel. Request rate is bounded by the API client's rate limiter.
+    """
+
+    PAGES_PER_CHUNK = 4
+
+    def __init__(self, fetch, partitions=4, page_limit=100, stop_event=None):
+        # fetch(tags, page) -> list of posts (raises on errors)
+        self.fetch = fetch
+        self.partitions = partitions
+        self.page_limit = page_limit
+        self.stop_event = stop_event or threading.Event()
+
+    def _fetch_chunk(self, tags, low_id, high_id, closed):
+        pages = []
+        cursor = high_id + 1
+        while not self.stop_event.is_set() and not closed.is_set():
+            posts = self.fetch(tags, f"b{cursor}")
+            in_range = [p for p in posts if p['id'] >= low_id]
+            if in_range:
+                pages.append(in_range)
+            cursor = min(p['id'] for p in posts) if posts else low_id
+            if len(posts) < self.page_limit or cursor <= low_id:
+                break
+        return pages
+
+    def _chunk_width(self, posts, width):
+        if len(posts) < 2:
+            return width * 2
+        span = max(p['id'] for p in posts) - min(p['id'] for p in posts) + 1
+        per_page = span * self.page_limit / len(posts)
+        return max(self.page_limit, int(per_page * self.PAGES_PER_CHUNK))
+
+    def walk_down(self, tags, below_id=None, floor_id=None, low_bound=None):
+        """
+        Yield pages of posts with floor_id <= id < below_id (open ends if None),
+        newest page first. low_bound (the query's lowest id, if known) saves a request.
+        """
+        first = self.fetch(tags, f"b{below_id}" if below_id else 1)
+        if floor_id:
+            first = [p for p in first if p['id'] >= floor_id]
+        if not first:
+            return
+        yield first
+        cursor = min(p['id'] for p in first)
+        if len(first) < self.page_limit or self.stop_event.is_set():
+            return
+
+        if floor_id:
+            low = floor_id
+        elif low_bound is not None:
+            low = low_bound
+        else:
+            # "a0" selects the posts just above id 0, i.e. the oldest ones
+            oldest = self.fetch(tags, "a0", only="id", limit=1)
+            low = oldest[0]['id'] if oldest else cursor
+        if cursor <= low:
+            return
+
+        width = self._chunk_width(first, self.page_limit)
+        closed = threading.Event()
+        pending = deque()
+        executor = ThreadPoolExecutor(max_workers=self.partitions, thread_name_prefix="enumerate")
+        next_high = cursor - 1
+        try:
+            while True:
+                while next_high >= low and len(pending) < self.partitions:
+                    chunk_low = max(low, next_high - width + 1)
+                    pending.append(executor.submit(self._fetch_chunk, tags, chunk_low, next_high, closed))
+                    next_high = chunk_low - 1
+                if not pending:
+                    return
+                pages = pending.popleft().result()
+                for posts in pages:
+                    if self.stop_event.is_set():
+                        return
+                    yield posts
+                # Re-estimate density from what this chunk returned
+                posts = [p for page in pages for p in page]
+                width = self._chunk_width(posts, width) if posts else width * 2
+        finally:
+            closed.set()
+            for f in pending:
+                f.cancel()
+            executor.shutdown(wait=False)
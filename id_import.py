@@ -0,0 +1,142 @@
+import re
+import csv
+from layout import iter_post_files
+from archive import archived_post_ids
+
+POST_URL_PATTERN = re.compile(r"/posts/(\d+)")
+
+def _parse_id(token):
+    token = token.strip()
+    if token.isdigit():
+        return int(token)
+    match = POST_URL_PATTERN.search(token)
+    if match:
+        return int(match.group(1))
+    return None
+
+def load_post_ids(path):
+    """
+    Read post ids from a text or CSV file, keeping the file's order and dropping duplicates.
+    Text files may hold ids or post URLs separated by whitespace or commas.
+    CSV files use the "id" / "post_id" column if there is a header, else the first column.
+    """
+    ids = []
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        if path.lower().endswith(".csv"):
+            rows = list(csv.reader(f))
+            column = 0
+            if rows:
+                header = [h.strip().lower() for h in rows[0]]
+                for name in ("id", "post_id"):
+                    if name in header:
+                        column = header.index(name)
+                        rows = rows[1:]
+                        break
+            for row in rows:
+                if len(row) > column:
+                    post_id = _parse_id(row[column])
+                    if post_id is not None:
+                        ids.append(post_id)
+        else:
+            for line in f:
+                for token in re.split(r"[\s,;]+", line):
+                    if token:
+                        post_id = _parse_id(token)
+                        if post_id is not None:
+                            ids.append(post_id)
+    return list(dict.fromkeys(ids))
+
+def existing_post_ids(folder):
+    """Ids of posts already saved as <id>.<ext> in folder, in any layout or in its archive shards."""
+    return {post_id for post_id, _ in iter_post_files(folder)} | archived_post_ids(folder)
+
+class IdImporter:
+    """
+    Mirrors an explicit list of post ids: skips ids already on disk, resolves
+    the rest with batched id:1,2,3 queries and hands the posts to DownloadManager.
+    """
+
+    def __init__(self, api, downloader, download_path, extra_tags=""):
+        self.api = api
+        self.downloader = downloader
+        self.download_path = download_path
+        self.extra_tags = extra_tags
+        self.missing_ids = []
+
+    def run(self, post_ids, callbacks=None):
+        """
+        callbacks: dict of functions {'on_complete': fn, 'on_error': fn, 'on_status': fn}
+        Returns a stats dict.
+        """
+        callbacks = callbacks or {}
+        on_status = callbacks.get('on_status')
+        have = existing_post_ids(self.download_path)
+        todo = [i for i in post_ids if i not in have]
+        stats = {"requested": len(post_ids), "already_present": len(post_ids) - len(todo),
+                 "api_calls": 0, "queued": 0, "missing": 0}
+        self.missing_ids = []
+
+        batch_size = self.api.MAX_IDS_PER_REQUEST
+        for start in range(0, len(todo), batch_size):
+            if self.downloader.stop_event.is_set(): break
+            self.downloader.pause_event.wait()
+
+            batch = todo[start:start + batch_size]
+            if on_status:
+                on_status(f"IDs: {start + len(batch)}/{len(todo)}")
+            try:
+                posts = self.api.fetch_posts_by_ids(batch, self.extra_tags, raise_errors=True, only=self.downloader.bulk_fields)
+            except Exception as e:
+                print(f"Error resolving ids {batch[0]}..{batch[-1]}: {e}")
+                if callbacks.get('on_error'):
+                    callbacks['on_error'](str(e))
+                continue
+            stats["api_calls"] += 1
+
+            returned = {p['id'] for p in posts}
+            self.missing_ids.extend(i for i in batch if i not in returned)
+            stats["queued"] += len(posts)
+
+            batch_futures = self.downloader.start_download_batch(posts, self.download_path, callbacks)
+            for f in batch_futures:
+                if self.downloader.stop_event.is_set(): break
+                f.result()
+            self.downloader.flush()
+
+        stats["missing"] = len(self.missing_ids)
+        return stats
+
+if __name__ == "__main__":
+    import argparse
+    from danbooru_api import DanbooruClient
+    from downloader import DownloadManager
+    from security import SecurityManager
+    from config import load_settings
+    from transport import TRANSPORT
+
+    parser = argparse.ArgumentParser(description="Download posts from a list of post ids")
+    parser.add_argument("id_file", help="Text or CSV file with post ids")
+    parser.add_argument("--output", help="Target folder (default: download path from settings)")
+    parser.add_argument("--bandwidth-limit", type=int, metavar="KBPS", help="Cap total download speed in KB/s (0 = off)")
+    args = parser.parse_args()
+
+    security = SecurityManager()
+    settings = load_settings(security)
+    TRANSPORT.apply_settings(settings)
+    api = DanbooruClient(settings["username"], settings["apikey"], settings["username"], settings["email"],
+                         rate_limit=settings["api_rate"])
+    bandwidth_limit = args.bandwidth_limit if args.bandwidth_limit is not None else settings["bandwidth_limit"]
+    downloader = DownloadManager(max_workers=settings["max_workers"], bandwidth_limit=bandwidth_limit * 1024,
+                                 auto_concurrency=settings["auto_concurrency"])
+    downloader.apply_settings(settings)
+
+    importer = IdImporter(api, downloader, args.output or settings["download_path"],
+                          "is:sfw" if settings["safe_search"] else "")
+    post_ids = load_post_ids(args.id_file)
+    try:
+        stats = importer.run(post_ids, {'on_status': print, 'on_error': lambda err: print(f"Error: {err}")})
+        print(f"Done: {stats}")
+    except KeyboardInterrupt:
+        downloader.stop_all()
+    finally:
+        downloader.close()
@@ -0,0 +1,237 @@
+"""
+Where a post's file lives inside a download folder.
+
+    flat  <folder>/<id>.<ext>                      (the original layout)
+    id    <folder>/<id // 1e6>/<id // 1e4 % 100>/<id>.<ext>, e.g. 07/23/7231234.jpg
+          at most 10,000 files per directory, neighbouring ids together
+    md5   <folder>/<md5[0:2]>/<md5[2:4]>/<id>.<ext>, evenly spread
+
+A folder's layout is recorded in its .danbooru_layout file (written by the
+migration below); folders without one use the configured default. Lookups
+check every layout, so a folder that is half migrated, or was written with
+another setting, never gets files downloaded twice.
+
+Re-shard a folder in place (safe to interrupt and run again):
+
+    python layout.py D:\\Mirror\\miku --to id
+"""
+import os
+import re
+import json
+import hashlib
+from manifest import Manifest
+
+LAYOUTS = ("flat", "id", "md5")
+MARKER_FILE = ".danbooru_layout"
+STATE_FILE = ".danbooru_layout_migration.json"
+
+# Post-processing (postprocess.py) may convert a file; the converted file still counts as the post
+CONVERTED_EXTS = {"png": ("webp",)}
+
+POST_FILE_PATTERN = re.compile(r"^(\d+)\.(\w+)$")
+SHARD_DIR_PATTERN = re.compile(r"^[0-9a-f]{2,3}$")
+
+def relative_path(layout, post_id, ext, md5=None):
+    name = f"{post_id}.{ext}"
+    if layout == "id":
+        return os.path.join(f"{post_id // 1000000:02d}", f"{post_id // 10000 % 100:02d}", name)
+    if layout == "md5" and md5:
+        return os.path.join(md5[:2], md5[2:4], name)
+    return name # flat, or md5 without a known md5
+
+def folder_layout(folder, default="flat"):
+    try:
+        with open(os.path.join(folder, MARKER_FILE), 'r', encoding='utf-8') as f:
+            layout = f.read().strip()
+        if layout in LAYOUTS:
+            return layout
+    except OSError:
+        pass
+    return default if default in LAYOUTS else "flat"
+
+def set_folder_layout(folder, layout):
+    with open(os.path.join(folder, MARKER_FILE), 'w', encoding='utf-8') as f:
+        f.write(layout)
+
+def locate(folder, post, layout):
+    """
+    Path of post's file in folder: wherever it already is (any layout, or
+    converted by post-processing), or where it should go under layout.
+    """
+    post_id = post['id']
+    ext = post.get('file_ext', 'jpg')
+    md5 = post.get('md5')
+    target = os.path.join(folder, relative_path(layout, post_id, ext, md5))
+    if os.path.exists(target):
+        return target
+    for other in LAYOUTS:
+        if other == layout:
+            continue
+        path = os.path.join(folder, relative_path(other, post_id, ext, md5))
+        if path != target and os.path.exists(path):
+            return path
+    for converted in CONVERTED_EXTS.get(ext, ()):
+        for other in LAYOUTS:
+            path = os.path.join(folder, relative_path(other, post_id, converted, md5))
+            if os.path.exists(path):
+                return path
+    return target
+
+def iter_post_files(folder):
+    """Yield (post_id, path relative to folder) for every post file, in any layout."""
+    if not os.path.exists(folder):
+        return
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_file():
+                match = POST_FILE_PATTERN.match(entry.name)
+                if match:
+                    yield int(match.group(1)), entry.name
+            elif entry.is_dir() and SHARD_DIR_PATTERN.match(entry.name):
+                with os.scandir(entry.path) as subdirs:
+                    for sub in subdirs:
+                        if not (sub.is_dir() and SHARD_DIR_PATTERN.match(sub.name)):
+                            continue
+                        with os.scandir(sub.path) as files:
+                            for f in files:
+                                match = POST_FILE_PATTERN.match(f.name)
+                                if match and f.is_file():
+                                    yield int(match.group(1)), os.path.join(entry.name, sub.name, f.name)
+
+def _file_md5(path):
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _remove_empty_dirs(folder):
+    for name in os.listdir(folder):
+        top = os.path.join(folder, name)
+        if not (os.path.isdir(top) and SHARD_DIR_PATTERN.match(name)):
+            continue
+        for sub in os.listdir(top):
+            try:
+                os.rmdir(os.path.join(top, sub))
+            except OSError:
+                pass # not empty
+        try:
+            os.rmdir(top)
+        except OSError:
+            pass
+
+class LayoutMigration:
+    """
+    Moves every post file in a folder to where target layout puts it.
+
+    Each move is a single os.replace within the folder, so an interrupted
+    run leaves every file either at its old or its new path; running again
+    picks up the rest. Progress is kept in .danbooru_layout_migration.json
+    until the run completes, then .danbooru_layout records the new layout.
+    md5 paths take the md5 from the folder's manifest when it has one and
+    hash the file otherwise. The manifest's file names are updated too.
+    Don't download into the folder while it is being migrated.
+    """
+
+    def __init__(self, folder, target, progress_every=1000):
+        if target not in LAYOUTS:
+            raise ValueError(f"Unknown layout {target!r}, expected one of {', '.join(LAYOUTS)}")
+        self.folder = folder
+        self.target = target
+        self.progress_every = progress_every
+        self.state_path = os.path.join(folder, STATE_FILE)
+        self.stop_requested = False
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            if state.get("target") == self.target:
+                return state
+        except (OSError, ValueError):
+            pass
+        return {"target": self.target, "moved": 0, "conflicts": []}
+
+    def _save_state(self, state):
+        tmp = self.state_path + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.state_path)
+
+    def run(self):
+        """Returns a summary dict; "complete" is False if stopped early."""
+        state = self._load_state()
+        if state["moved"]:
+            print(f"Resuming migration to '{self.target}' ({state['moved']} files moved so far)")
+        self._save_state(state)
+
+        manifest = None
+        md5s = {}
+        if os.path.exists(os.path.join(self.folder, Manifest.FILE_NAME)):
+            manifest = Manifest(self.folder)
+            md5s = manifest.md5s()
+
+        checked = 0
+        renames = []
+        try:
+            # Materialise the listing first: we're about to move files around under it
+            for post_id, rel in list(iter_post_files(self.folder)):
+                if self.stop_requested:
+                    break
+                checked += 1
+                ext = rel.rsplit(".", 1)[1]
+                md5 = None
+                if self.target == "md5":
+                    md5 = md5s.get(post_id) or _file_md5(os.path.join(self.folder, rel))
+                new_rel = relative_path(self.target, post_id, ext, md5)
+                if new_rel == rel:
+                    continue
+                dst = os.path.join(self.folder, new_rel)
+                if os.path.exists(dst):
+                    if rel not in state["conflicts"]:
+                        state["conflicts"].append(rel) # Same post at both places; leave it to the user
+                    continue
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                os.replace(os.path.join(self.folder, rel), dst)
+                renames.append((post_id, new_rel))
+                state["moved"] += 1
+                if len(renames) >= self.progress_every:
+                    self._checkpoint(state, manifest, renames, checked)
+                    renames = []
+        except KeyboardInterrupt:
+            self.stop_requested = True
+        finally:
+            # Also on Ctrl+C, so the manifest matches the files that did move
+            self._checkpoint(state, manifest, renames, checked)
+            if manifest:
+                manifest.close()
+
+        complete = not self.stop_requested
+        if complete:
+            _remove_empty_dirs(self.folder)
+            set_folder_layout(self.folder, self.target)
+            os.remove(self.state_path)
+        return {"complete": complete, "layout": self.target, "checked": checked,
+                "moved": state["moved"], "conflicts": state["conflicts"]}
+
+    def stop(self):
+        self.stop_requested = True
+
+    def _checkpoint(self, state, manifest, renames, checked):
+        if manifest and renames:
+            manifest.rename(renames)
+        self._save_state(state)
+        print(f"Checked {checked} files, moved {state['moved']}")
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Re-shard a download folder in place")
+    parser.add_argument("folder")
+    parser.add_argument("--to", required=True, choices=LAYOUTS, help="Target layout")
+    args = parser.parse_args()
+
+    summary = LayoutMigration(args.folder, args.to).run()
+    if not summary["complete"]:
+        print("Interrupted; run the same command again to continue")
+    print(summary)
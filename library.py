@@ -0,0 +1,311 @@
+"""
+Local library: tag search over downloaded posts, without the network.
+
+The library (.danbooru_library.db, sqlite) is built from the folders'
+metadata sidecars (metadata_sidecar.py), so it covers posts downloaded with
+DANBOORU_METADATA_SIDECAR=true. Each post is indexed in an FTS5 table as
+its tag ids plus its rating (tags are full of punctuation the tokenizer
+would split on; ids are single tokens), and queries run as FTS5 MATCH
+expressions newest first. Updates are incremental: each sidecar file is
+read from where the last update stopped.
+
+Query syntax, all terms ANDed:
+
+    hatsune_miku         posts with the tag
+    -sketch              posts without it
+    long_hair*           any tag starting with long_hair (also -long_hair*)
+    rating:g / rating:s,q / -rating:e
+                         general, sensitive, questionable, explicit
+
+    python library.py build D:\\Mirror\\miku D:\\Mirror\\rin
+    python library.py search "hatsune_miku -rating:e" --folder D:\\Mirror\\miku
+"""
+import os
+import json
+import sqlite3
+import threading
+from io import BytesIO
+from metadata_sidecar import sidecar_files
+from layout import locate, folder_layout
+from archive import ArchiveIndex, INDEX_FILE as ARCHIVE_INDEX_FILE
+from postprocess import preview_path
+
+LIBRARY_FILE = ".danbooru_library.db"
+RATINGS = {"g": "g", "general": "g", "s": "s", "sensitive": "s", "q": "q", "questionable": "q",
+           "e": "e", "explicit": "e"}
+BATCH_ROWS = 5000
+
+class QueryError(ValueError):
+    pass
+
+def parse_query(query):
+    """{"tags", "exclude", "prefixes", "exclude_prefixes", "ratings", "exclude_ratings"} from a query string."""
+    terms = {"tags": [], "exclude": [], "prefixes": [], "exclude_prefixes": [], "ratings": set(), "exclude_ratings": set()}
+    for term in query.lower().split():
+        negated = term.startswith("-") and len(term) > 1
+        if negated:
+            term = term[1:]
+        if term.startswith("rating:"):
+            values = set()
+            for value in term[7:].split(","):
+                if value not in RATINGS:
+                    raise QueryError(f"Unknown rating {value!r}, expected one of g, s, q, e")
+                values.add(RATINGS[value])
+            terms["exclude_ratings" if negated else "ratings"] |= values
+        elif term.endswith("*"):
+            if len(term) == 1:
+                raise QueryError("A wildcard needs at least one character before the *")
+            terms["exclude_prefixes" if negated else "prefixes"].append(term[:-1])
+        else:
+            terms["exclude" if negated else "tags"].append(term)
+    if terms["ratings"]:
+        terms["ratings"] -= terms["exclude_ratings"]
+        terms["exclude_ratings"] = set()
+        if not terms["ratings"]:
+            terms["ratings"] = {None} # every allowed rating is also excluded: match nothing
+    return terms
+
+def _any(terms):
+    return "(" + " OR ".join(f'"{term}"' for term in terms) + ")"
+
+def _tag_terms(terms):
+    return [int(term) for term in terms.split() if term.isdigit()]
+
+def _like(prefix):
+    return prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+class Library:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS posts (
+                id INTEGER PRIMARY KEY,
+                folder TEXT NOT NULL,
+                file TEXT,
+                terms TEXT NOT NULL,
+                data TEXT NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS tags (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL, count INTEGER NOT NULL DEFAULT 0)")
+        # Full-text index over posts.terms: the post's tag ids, its rating (r<g|s|q|e>) and "all"
+        self.conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS post_index USING fts5(terms, content='posts', content_rowid='id', detail=none)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, offset INTEGER NOT NULL)")
+        self.conn.commit()
+        self.tag_ids = {}
+
+    # --- Building ---
+
+    def update(self, folder):
+        """Import the rows added to folder's sidecar files since the last update. Returns the number imported."""
+        folder = os.path.abspath(folder)
+        imported = 0
+        for path in sidecar_files(folder):
+            imported += self._import_file(folder, path)
+        return imported
+
+    def _import_file(self, folder, path):
+        with self.lock:
+            row = self.conn.execute("SELECT offset FROM sources WHERE path = ?", (path,)).fetchone()
+        offset = row[0] if row else 0
+        size = os.path.getsize(path)
+        if size == offset:
+            return 0
+        if size < offset:
+            # Cut back by crash repair: the rows before the cut are unchanged, so re-reading them is harmless
+            offset = 0
+        imported = 0
+        batch = []
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break # a write in progress; read it next time
+                offset += len(line)
+                batch.append(json.loads(line))
+                if len(batch) >= BATCH_ROWS:
+                    imported += self._add_rows(folder, batch, path, offset)
+                    batch = []
+        return imported + self._add_rows(folder, batch, path, offset)
+
+    def _add_rows(self, folder, rows, source, offset):
+        counts = {} # tag id -> change in its post count
+        rows = list({row["id"]: row for row in rows}.values())
+        with self.lock:
+            old = []
+            ids = [row["id"] for row in rows]
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                old += self.conn.execute(f"SELECT id, terms FROM posts WHERE id IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+            # Posts downloaded again (another folder, or repair mode) may have new tags: drop their old entries
+            self.conn.executemany("INSERT INTO post_index (post_index, rowid, terms) VALUES ('delete', ?, ?)", old)
+            for _, terms in old:
+                for tag_id in _tag_terms(terms):
+                    counts[tag_id] = counts.get(tag_id, 0) - 1
+            posts = []
+            for row in rows:
+                tag_ids = {self._tag_id(name) for name in (row.get("tag_string") or "").split()}
+                for tag_id in tag_ids:
+                    counts[tag_id] = counts.get(tag_id, 0) + 1
+                terms = " ".join(["all", f"r{row.get('rating') or 'x'}"] + [str(tag_id) for tag_id in sorted(tag_ids)])
+                file_name = row.pop("file", None)
+                posts.append((row["id"], folder, file_name, terms, json.dumps(row, ensure_ascii=False)))
+            self.conn.executemany("INSERT OR REPLACE INTO posts (id, folder, file, terms, data) VALUES (?, ?, ?, ?, ?)", posts)
+            self.conn.executemany("INSERT INTO post_index (rowid, terms) VALUES (?, ?)", [(p[0], p[3]) for p in posts])
+            self.conn.executemany("UPDATE tags SET count = count + ? WHERE id = ?",
+                                  [(change, tag_id) for tag_id, change in counts.items() if change])
+            self.conn.execute("INSERT OR REPLACE INTO sources (path, offset) VALUES (?, ?)", (source, offset))
+            self.conn.commit()
+        return len(rows)
+
+    def _tag_id(self, name):
+        tag_id = self.tag_ids.get(name)
+        if tag_id is None:
+            self.conn.execute("INSERT OR IGNORE INTO tags (name) VALUES (?)", (name,))
+            tag_id = self.conn.execute("SELECT id FROM tags WHERE name = ?", (name,)).fetchone()[0]
+            self.tag_ids[name] = tag_id
+        return tag_id
+
+    # --- Searching ---
+
+    def _match(self, query, exclude_ratings=()):
+        """The FTS5 MATCH expression for query, or None if it can't match anything."""
+        terms = parse_query(query)
+        exclude_ratings = {RATINGS[rating] for rating in exclude_ratings}
+        if terms["ratings"]:
+            terms["ratings"] -= exclude_ratings
+            if terms["ratings"] in (set(), {None}): # every rating asked for is excluded
+                return None
+        else:
+            terms["exclude_ratings"] |= exclude_ratings
+        required = []
+        for name in terms["tags"]:
+            row = self.conn.execute("SELECT id FROM tags WHERE name = ? AND count > 0", (name,)).fetchone()
+            if not row:
+                return None
+            required.append(str(row[0]))
+        for prefix in terms["prefixes"]:
+            ids = [str(row[0]) for row in self.conn.execute(
+                "SELECT id FROM tags WHERE name LIKE ? ESCAPE '\\' AND count > 0", (_like(prefix),))]
+            if not ids:
+                return None
+            required.append(_any(ids))
+        if terms["ratings"]:
+            required.append(_any(f"r{rating}" for rating in sorted(terms["ratings"])))
+        excluded = [f"r{rating}" for rating in sorted(terms["exclude_ratings"])]
+        for name in terms["exclude"]:
+            excluded += [str(row[0]) for row in self.conn.execute("SELECT id FROM tags WHERE name = ?", (name,))]
+        for prefix in terms["exclude_prefixes"]:
+            excluded += [str(row[0]) for row in self.conn.execute("SELECT id FROM tags WHERE name LIKE ? ESCAPE '\\'", (_like(prefix),))]
+        match = " AND ".join(required) or "all" # NOT needs something on its left
+        if excluded:
+            match += " NOT " + _any(excluded)
+        return match
+
+    def search(self, query, limit=20, offset=0, exclude_ratings=()):
+        """
+        Matching posts, newest first, as sidecar rows plus "local_folder" and
+        "local_file". exclude_ratings (e.g. "qe") filters on top of the query.
+        Raises QueryError for a query it can't parse.
+        """
+        with self.lock:
+            match = self._match(query, exclude_ratings)
+            if not match:
+                return []
+            rows = self.conn.execute("""
+                SELECT p.folder, p.file, p.data FROM post_index JOIN posts p ON p.id = post_index.rowid
+                WHERE post_index MATCH ? ORDER BY post_index.rowid DESC LIMIT ? OFFSET ?
+            """, (match, limit, offset)).fetchall()
+        posts = []
+        for folder, file_name, data in rows:
+            post = json.loads(data)
+            post["local_folder"] = folder
+            post["local_file"] = file_name
+            posts.append(post)
+        return posts
+
+    def count(self, query="", exclude_ratings=()):
+        with self.lock:
+            match = self._match(query, exclude_ratings)
+            if not match:
+                return 0
+            return self.conn.execute("SELECT COUNT(*) FROM post_index WHERE post_index MATCH ?", (match,)).fetchone()[0]
+
+    def top_tags(self, limit=20):
+        with self.lock:
+            return self.conn.execute("SELECT name, count FROM tags WHERE count > 0 ORDER BY count DESC LIMIT ?", (limit,)).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def local_path(post):
+    """Where a search result's file is on disk now, or None (archived, or gone)."""
+    folder = post["local_folder"]
+    if post.get("local_file"):
+        path = os.path.join(folder, post["local_file"].replace("/", os.sep))
+        if os.path.exists(path):
+            return path
+    # Moved since: re-sharded, or converted by post-processing
+    path = locate(folder, post, folder_layout(folder))
+    return path if os.path.exists(path) else None
+
+def open_image(post, preview=False):
+    """A path or file object with the post's image (its preview if asked and there is one), or None."""
+    path = local_path(post)
+    if path:
+        if preview and os.path.exists(preview_path(path)):
+            return preview_path(path)
+        return path
+    if os.path.exists(os.path.join(post["local_folder"], ARCHIVE_INDEX_FILE)):
+        index = ArchiveIndex(post["local_folder"])
+        try:
+            data = index.read(post["id"])
+        finally:
+            index.close()
+        if data is not None:
+            return BytesIO(data)
+    return None
+
+def open_library(folder):
+    """The library kept in folder, brought up to date with folder's sidecars."""
+    library = Library(os.path.join(folder, LIBRARY_FILE))
+    library.update(folder)
+    return library
+
+if __name__ == "__main__":
+    import time
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Search downloaded posts by tag, offline")
+    parser.add_argument("--db", help=f"Library file (default: {LIBRARY_FILE} in the first folder)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="Add or update folders from their metadata sidecars")
+    build.add_argument("folders", nargs="+")
+    search = sub.add_parser("search", help="Run a tag query")
+    search.add_argument("query")
+    search.add_argument("--folder", default=".", help="Folder holding the library (default: current)")
+    search.add_argument("--limit", type=int, default=20)
+    search.add_argument("--page", type=int, default=1)
+    args = parser.parse_args()
+
+    first = args.folders[0] if args.command == "build" else args.folder
+    library = Library(args.db or os.path.join(first, LIBRARY_FILE))
+    if args.command == "build":
+        for folder in args.folders:
+            print(f"{folder}: {library.update(folder)} posts imported")
+        print("Top tags: " + ", ".join(f"{name} ({count})" for name, count in library.top_tags(10)))
+    else:
+        try:
+            start = time.perf_counter()
+            posts = library.search(args.query, args.limit, (args.page - 1) * args.limit)
+            total = library.count(args.query)
+            elapsed = (time.perf_counter() - start) * 1000
+        except QueryError as e:
+            raise SystemExit(str(e))
+        for post in posts:
+            print(f"{post['id']}  {post.get('rating', '?')}  {local_path(post) or '(archived)'}")
+        print(f"{total} posts match ({elapsed:.1f} ms)")
+    library.close()
@@ -0,0 +1,101 @@
+import os
+import time
+import sqlite3
+import threading
+
+class Manifest:
+    """
+    sqlite index of the posts downloaded into a folder (.danbooru_manifest.db).
+
+    One row per post with the file name (relative to the folder, see layout.py)
+    and the size/md5 the API reported, plus a table of perceptual hashes
+    (perceptual_hash.py) keyed by post id.
+    Meant to have a single writer (e.g. the sharded download coordinator);
+    readers can open it at any time thanks to WAL mode.
+    """
+
+    FILE_NAME = ".danbooru_manifest.db"
+
+    def __init__(self, folder, file_name=FILE_NAME):
+        self.path = os.path.join(folder, file_name)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS posts (
+                id INTEGER PRIMARY KEY,
+                file_name TEXT NOT NULL,
+                md5 TEXT,
+                file_size INTEGER,
+                query TEXT,
+                shard INTEGER,
+                downloaded_at REAL
+            )
+        """)
+        # source: "file", "archive" or "preview" (hashed from Danbooru's preview before the download)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS phashes (
+                id INTEGER PRIMARY KEY,
+                phash INTEGER NOT NULL,
+                source TEXT NOT NULL,
+                file_name TEXT,
+                file_size INTEGER,
+                mtime REAL
+            )
+        """)
+        self.conn.commit()
+
+    def add_posts(self, rows, query=None, shard=None):
+        """rows: iterable of (post_id, file_name, md5, file_size)."""
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO posts (id, file_name, md5, file_size, query, shard, downloaded_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(post_id, name, md5, size, query, shard, now) for post_id, name, md5, size in rows])
+            self.conn.commit()
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
+
+    def post_ids(self):
+        with self.lock:
+            return {row[0] for row in self.conn.execute("SELECT id FROM posts")}
+
+    def md5s(self):
+        """post id -> md5 as the API reported it."""
+        with self.lock:
+            return {row[0]: row[1] for row in self.conn.execute("SELECT id, md5 FROM posts WHERE md5 IS NOT NULL")}
+
+    def rename(self, rows):
+        """rows: iterable of (post_id, new file name relative to the folder)."""
+        with self.lock:
+            self.conn.executemany("UPDATE posts SET file_name = ? WHERE id = ?", [(name, post_id) for post_id, name in rows])
+            self.conn.commit()
+
+    def phash_sources(self):
+        """post id -> (source, file name, size, mtime) the stored hash was computed from."""
+        with self.lock:
+            return {row[0]: row[1:] for row in self.conn.execute("SELECT id, source, file_name, file_size, mtime FROM phashes")}
+
+    def phashes(self):
+        """[(post id, hash as a signed 64-bit int, source)]"""
+        with self.lock:
+            return self.conn.execute("SELECT id, phash, source FROM phashes ORDER BY id").fetchall()
+
+    def add_phashes(self, rows):
+        """rows: iterable of (post_id, hash, source, file name, size, mtime)."""
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO phashes (id, phash, source, file_name, file_size, mtime) "
+                                  "VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.conn.commit()
+
+    def remove_phashes(self, post_ids):
+        with self.lock:
+            self.conn.executemany("DELETE FROM phashes WHERE id = ?", [(post_id,) for post_id in post_ids])
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,146 @@
+"""
+Metadata sidecar: one JSON line per downloaded post (tags, rating, score,
+source, ...) in metadata.jsonl next to the files, written while bulk
+downloads run, so datasets can be built without asking the API again.
+A row's "file" is where the file ended up: with post-processing on, the
+row is added once the stages (which may rename it) are done.
+
+Rows are buffered and appended in batches: every batch_size rows, every
+flush_interval seconds, and when the bulk engine finishes a page (before
+it saves its progress). A post already in the folder's sidecar files is
+not written again. A line cut off by a crash is dropped on the next open.
+
+Convert to Parquet (needs pyarrow) for columnar tools:
+
+    python metadata_sidecar.py D:\\Mirror\\miku --parquet metadata.parquet
+"""
+import os
+import re
+import json
+import glob
+import time
+import threading
+
+SIDECAR_FILE = "metadata.jsonl"
+SIDECAR_PATTERN = "metadata*.jsonl" # sharded downloads write one file per process
+
+# URLs are left out: they point at the CDN and say nothing about the post
+SKIPPED_FIELDS = ("file_url", "large_file_url", "preview_file_url")
+
+ID_PREFIX = re.compile(r'^\{"id": (\d+)')
+
+def sidecar_files(folder):
+    return sorted(glob.glob(os.path.join(glob.escape(folder), SIDECAR_PATTERN)))
+
+def iter_rows(folder):
+    """Yield every row of folder's sidecar files."""
+    for path in sidecar_files(folder):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.endswith("\n"):
+                    yield json.loads(line)
+
+def _repair_tail(path):
+    """Cut off a last line without its newline (a write interrupted by a crash)."""
+    with open(path, 'rb+') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if not size:
+            return
+        f.seek(max(0, size - 1))
+        if f.read(1) == b"\n":
+            return
+        # Walk back to the previous newline
+        pos = size
+        while pos > 0:
+            step = min(65536, pos)
+            f.seek(pos - step)
+            block = f.read(step)
+            cut = block.rfind(b"\n")
+            if cut >= 0:
+                f.truncate(pos - step + cut + 1)
+                return
+            pos -= step
+        f.truncate(0)
+
+class MetadataSidecar:
+    def __init__(self, folder, file_name=SIDECAR_FILE, batch_size=500, flush_interval=5.0):
+        self.folder = folder
+        self.path = os.path.join(folder, file_name)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.rows_written = 0
+        if os.path.exists(self.path):
+            _repair_tail(self.path)
+        self.seen = self._load_ids()
+        self.file = open(self.path, 'a', encoding='utf-8', newline='\n')
+
+    def _load_ids(self):
+        ids = set()
+        for path in sidecar_files(self.folder):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    match = ID_PREFIX.match(line) # rows start with the id; skip parsing the rest
+                    if match:
+                        ids.add(int(match.group(1)))
+                    elif line.endswith("\n"):
+                        ids.add(json.loads(line)["id"])
+        return ids
+
+    def add(self, post, file_name=None):
+        """Buffer post's row (once per post id); file_name is where its file went, relative to the folder."""
+        row = {"id": post["id"]}
+        row.update((k, v) for k, v in post.items() if k != "id" and k not in SKIPPED_FIELDS)
+        if file_name:
+            row["file"] = file_name.replace(os.sep, "/")
+        line = json.dumps(row, ensure_ascii=False, separators=(", ", ": "))
+        with self.lock:
+            if post["id"] in self.seen:
+                return
+            self.seen.add(post["id"])
+            self.buffer.append(line)
+            due = len(self.buffer) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            lines, self.buffer = self.buffer, []
+            self.last_flush = time.monotonic()
+            if not lines:
+                return
+            self.file.write("\n".join(lines) + "\n") # one write per batch
+            self.file.flush()
+            self.rows_written += len(lines)
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.file.close()
+
+def to_parquet(folder, output):
+    """Write folder's sidecar rows to a Parquet file. Returns the number of rows."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit("Parquet export needs pyarrow (pip install pyarrow)")
+    rows = list(iter_rows(folder))
+    pq.write_table(pa.Table.from_pylist(rows), output)
+    return len(rows)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect or convert a folder's metadata sidecar")
+    parser.add_argument("folder")
+    parser.add_argument("--parquet", metavar="OUTPUT", help="Write all rows to a Parquet file")
+    args = parser.parse_args()
+
+    if args.parquet:
+        print(f"Wrote {to_parquet(args.folder, args.parquet)} rows to {args.parquet}")
+    else:
+        print(f"{sum(1 for _ in iter_rows(args.folder))} posts in {', '.join(sidecar_files(args.folder)) or 'no sidecar files'}")
@@ -0,0 +1,211 @@
+"""
+Minimal Prometheus-style metrics (text exposition format 0.0.4) with no
+extra dependency. Metrics are always collected (a few dict updates under a
+lock); they are only exposed when start_metrics_server() is called.
+"""
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        REGISTRY.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def labels(self, **labels):
+        return _Bound(self, self._key(labels))
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+class _Bound:
+    def __init__(self, metric, key):
+        self.metric = metric
+        self.key = key
+
+    def inc(self, amount=1):
+        self.metric._inc(self.key, amount)
+
+    def dec(self, amount=1):
+        self.metric._inc(self.key, -amount)
+
+    def set(self, value):
+        self.metric._set(self.key, value)
+
+    def observe(self, value):
+        self.metric._observe(self.key, value)
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        self._inc(self._key(labels), amount)
+
+    def _inc(self, key, amount):
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def collect(self):
+        lines = self.header()
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self._set(self._key(labels), value)
+
+    def dec(self, amount=1, **labels):
+        self._inc(self._key(labels), -amount)
+
+    def _set(self, key, value):
+        with self.lock:
+            self.values[key] = value
+
+class Histogram(_Metric):
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        self._observe(self._key(labels), value)
+
+    def _observe(self, key, value):
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    def collect(self):
+        lines = self.header()
+        with self.lock:
+            for key, (counts, count, total) in sorted(self.values.items()):
+                for bound, c in zip(self.buckets, counts):
+                    le = _format_labels(self.labelnames, key, 'le="%s"' % bound)
+                    lines.append(f"{self.name}_bucket{le} {c}")
+                le = _format_labels(self.labelnames, key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{le} {count}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+
+    def exposition(self):
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics)
+        for metric in metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+# --- Application metrics ---
+
+PROCESS_START = Gauge("danbooru_process_start_time_seconds", "Unix time the process started")
+PROCESS_START.set(time.time())
+
+DOWNLOAD_BYTES = Counter("danbooru_download_bytes_total", "Bytes of finished downloads")
+DOWNLOAD_FILES = Counter("danbooru_download_files_total", "Files handled by DownloadManager", ["result"])
+DOWNLOAD_ERRORS = Counter("danbooru_download_errors_total", "Failed downloads by error type", ["type"])
+DOWNLOADS_IN_FLIGHT = Gauge("danbooru_downloads_in_flight", "Transfers currently running")
+DOWNLOAD_RATE_LIMITED = Counter("danbooru_download_rate_limited_total", "429 responses from the file servers (including ones retried automatically)")
+DOWNLOAD_BYTES_SAVED = Counter("danbooru_download_bytes_saved_total", "Bytes not downloaded because the same file was already on disk", ["method"])
+DOWNLOAD_STALLS = Counter("danbooru_download_stalls_total", "Transfers aborted by the stall detector")
+DOWNLOAD_HEDGES = Counter("danbooru_download_hedges_total", "Hedged requests by outcome", ["result"])
+DISK_FSYNC_SECONDS = Histogram("danbooru_disk_fsync_seconds", "Time spent in fsync of downloaded files and their folders",
+                               buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 1, 5))
+POSTPROCESS_SECONDS = Histogram("danbooru_postprocess_seconds", "Time per post-processing stage (\"queue\": waiting for a worker)", ["stage"])
+POSTPROCESS_FILES = Counter("danbooru_postprocess_files_total", "Files through each post-processing stage", ["stage", "result"])
+POSTPROCESS_PENDING = Gauge("danbooru_postprocess_pending", "Files queued or being post-processed")
+DOWNLOAD_CONCURRENCY_LIMIT = Gauge("danbooru_download_concurrency_limit", "Transfers allowed at once (moves when auto-tuning)")
+
+API_REQUESTS = Counter("danbooru_api_requests_total", "Danbooru API requests", ["endpoint", "status"])
+API_LATENCY = Histogram("danbooru_api_request_seconds", "Danbooru API request latency", ["endpoint"])
+API_RATE_LIMITED = Counter("danbooru_api_rate_limited_total", "429 responses received (including ones retried automatically)")
+
+HTTP_REQUESTS = Counter("danbooru_http_requests_total", "HTTP requests sent, by transport pool", ["pool"])
+HTTP_CONNECTIONS = Counter("danbooru_http_connections_opened_total", "New connections opened (requests minus these were keep-alive reuses)", ["pool"])
+
+CACHE_HITS = Counter("danbooru_cache_hits_total", "Thumbnail cache hits")
+CACHE_MISSES = Counter("danbooru_cache_misses_total", "Thumbnail cache misses")
+CACHE_SIZE = Gauge("danbooru_cache_size_bytes", "Thumbnail cache size on disk (as of the last cleanup plus saves since)")
+
+# No query label: every query typed would add series for good. These follow the latest sync.
+SYNC_PAGES = Counter("danbooru_sync_pages_total", "Metadata pages processed by the bulk engine")
+SYNC_TOP_ID = Gauge("danbooru_sync_top_id", "Newest post id synced by the latest sync")
+SYNC_LOWEST_ID = Gauge("danbooru_sync_lowest_id", "Lowest post id reached by the latest backfill")
+SYNC_COMPLETE = Gauge("danbooru_sync_complete", "1 when the latest sync's query has been synced to the end")
+
+WATCH_POLLS = Counter("danbooru_watch_polls_total", "Watch mode polls by outcome", ["result"])
+WATCH_LAST_POLL = Gauge("danbooru_watch_last_poll_timestamp_seconds", "Unix time of the last poll of a watch list entry", ["slot"])
+
+def count_retried_status(response, status):
+    """How many responses with status urllib3's Retry already retried away before this one."""
+    try:
+        history = response.raw.retries.history if response.raw.retries else ()
+        return sum(1 for entry in history if entry.status == status)
+    except AttributeError:
+        return 0
+
+# --- HTTP endpoint ---
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = REGISTRY.exposition().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_metrics_server(port, host="127.0.0.1"):
+    """Serve /metrics on a daemon thread. Works without the GUI."""
+    httpd = ThreadingHTTPServer((host, port), _MetricsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"Metrics available at http://{host}:{httpd.server_address[1]}/metrics")
+    return httpd
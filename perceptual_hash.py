@@ -0,0 +1,322 @@
+"""
+Near-duplicate detection by perceptual hash (re-uploads, resized copies,
+re-encodes and small edits that md5 doesn't catch). Needs numpy.
+
+Every image gets a 64-bit pHash: the image shrunk to 32x32 greyscale, its
+2-D DCT, and one bit per low-frequency coefficient (above or below their
+median). Hashes are computed on a process pool and kept in the folder's
+manifest (.danbooru_manifest.db) with the file's size and mtime, so a scan
+only hashes files that are new or changed since the last one. Where the
+preview stage left a .previews/<id>.jpg, that is hashed instead of the
+full file. Posts stored in archive shards are read from the shards.
+
+Posts not downloaded yet can be hashed from Danbooru's preview images;
+they then show up in the clusters next to the files they duplicate.
+
+Clusters are groups of posts within --distance bits of each other (and
+chained through each other); all pairs are compared with numpy, a block
+of rows at a time.
+
+    python perceptual_hash.py scan D:\\Mirror\\miku                 # hash new files, list clusters
+    python perceptual_hash.py previews D:\\Mirror\\miku "hatsune_miku rating:g"
+    python perceptual_hash.py clusters D:\\Mirror\\miku --distance 6 --json dupes.json
+"""
+import os
+import json
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from layout import iter_post_files
+from manifest import Manifest
+from archive import ArchiveIndex, INDEX_FILE as ARCHIVE_INDEX_FILE, archived_post_ids
+from postprocess import IMAGE_EXTS, preview_path
+
+HASH_SIZE = 8     # 8x8 DCT coefficients -> 64 bits
+SAMPLE_SIZE = 32  # the image is shrunk to this before the DCT
+DEFAULT_DISTANCE = 8
+BLOCK_ELEMENTS = 1 << 22 # hash pairs compared per numpy step (8 bytes each)
+WRITE_BATCH = 1000
+PREVIEW_PAGE_LIMIT = 100 # posts per API page when hashing previews
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise SystemExit("Perceptual hashing needs numpy (pip install numpy)")
+    return numpy
+
+_dct_matrix = None
+
+def _dct():
+    global _dct_matrix
+    if _dct_matrix is None:
+        np = _numpy()
+        n = np.arange(SAMPLE_SIZE)
+        matrix = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * SAMPLE_SIZE)) * np.sqrt(2 / SAMPLE_SIZE)
+        matrix[0] /= np.sqrt(2)
+        _dct_matrix = matrix
+    return _dct_matrix
+
+def image_hash(source):
+    """pHash of the image at source (a path or file object) as a signed 64-bit int, the way sqlite stores it."""
+    np = _numpy()
+    from PIL import Image
+    with Image.open(source) as image:
+        image.draft("L", (SAMPLE_SIZE * 4, SAMPLE_SIZE * 4)) # JPEGs decode at a fraction of their size
+        pixels = np.asarray(image.convert("L").resize((SAMPLE_SIZE, SAMPLE_SIZE), Image.Resampling.LANCZOS), dtype=np.float64)
+    dct = _dct()
+    low = (dct @ pixels @ dct.T)[:HASH_SIZE, :HASH_SIZE].ravel()
+    bits = low > np.median(low[1:]) # the DC term only says how bright the image is
+    value = int.from_bytes(np.packbits(bits).tobytes(), "big")
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+def _hash_task(task):
+    """Worker side: (post id, path, offset, size) -> (post id, hash or None, error or None)."""
+    post_id, path, offset, size = task
+    try:
+        if offset is None:
+            return post_id, image_hash(path), None
+        with open(path, 'rb') as f: # a member of an archive shard
+            f.seek(offset)
+            return post_id, image_hash(BytesIO(f.read(size))), None
+    except Exception as e:
+        return post_id, None, f"{type(e).__name__}: {e}"
+
+def _is_image(name):
+    return name.rsplit(".", 1)[-1].lower() in IMAGE_EXTS
+
+def pending_tasks(folder, known):
+    """
+    ([(post id, path, offset, size)], {post id: manifest row}, ids present) for
+    the images in folder whose stored hash is missing or was computed from
+    something else.
+    """
+    tasks, rows, present = [], {}, set()
+    for post_id, name in iter_post_files(folder):
+        if not _is_image(name):
+            continue
+        present.add(post_id)
+        path = os.path.join(folder, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        row = ("file", name.replace(os.sep, "/"), stat.st_size, stat.st_mtime)
+        if known.get(post_id) == row:
+            continue
+        preview = preview_path(path)
+        tasks.append((post_id, preview if os.path.exists(preview) else path, None, None))
+        rows[post_id] = row
+    if os.path.exists(os.path.join(folder, ARCHIVE_INDEX_FILE)):
+        index = ArchiveIndex(folder)
+        try:
+            for shard, *_ in index.shards():
+                for post_id, name, offset, size, _ in index.members(shard):
+                    row = ("archive", f"{shard}/{name}", size, None)
+                    if post_id in present or not _is_image(name):
+                        continue
+                    present.add(post_id)
+                    if known.get(post_id) == row:
+                        continue
+                    tasks.append((post_id, os.path.join(folder, shard), offset, size))
+                    rows[post_id] = row
+        finally:
+            index.close()
+    return tasks, rows, present
+
+def scan(folder, workers=0, progress=print):
+    """Hash folder's new or changed images. Returns (hashed, failed)."""
+    manifest = Manifest(folder)
+    try:
+        known = manifest.phash_sources()
+        tasks, rows, present = pending_tasks(folder, known)
+        # Files deleted since they were hashed (hashes of previews stay until the post is downloaded)
+        manifest.remove_phashes([post_id for post_id, (source, *_) in known.items()
+                                 if source != "preview" and post_id not in present])
+        if not tasks:
+            return 0, 0
+        progress(f"Hashing {len(tasks)} images")
+        hashed = failed = 0
+        batch = []
+        workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for post_id, value, error in executor.map(_hash_task, tasks, chunksize=32):
+                if error:
+                    failed += 1
+                    progress(f"Couldn't hash post {post_id}: {error}")
+                    continue
+                batch.append((post_id, value) + rows[post_id])
+                if len(batch) >= WRITE_BATCH:
+                    manifest.add_phashes(batch) # an interrupted scan keeps what it hashed
+                    hashed += len(batch)
+                    batch = []
+                    progress(f"{hashed} hashed")
+        manifest.add_phashes(batch)
+        return hashed + len(batch), failed
+    finally:
+        manifest.close()
+
+def hash_previews(folder, api, tags, limit=None, workers=8, progress=print):
+    """
+    Hash the Danbooru previews of tags' posts that aren't in folder (as a
+    file or in an archive shard) and have no preview hash yet, so they can
+    be checked before they are downloaded. Returns (hashed, failed).
+    """
+    from transport import TRANSPORT
+
+    def fetch(post):
+        try:
+            response = TRANSPORT.get("previews", post["preview_file_url"])
+            response.raise_for_status()
+            return post["id"], image_hash(BytesIO(response.content)), None
+        except Exception as e:
+            return post["id"], None, f"{type(e).__name__}: {e}"
+
+    # Downloaded posts are hashed from their files by scan()
+    skip = {post_id for post_id, _ in iter_post_files(folder)} | archived_post_ids(folder)
+    manifest = Manifest(folder)
+    hashed = failed = seen = 0
+    try:
+        skip |= {post_id for post_id, (source, *_) in manifest.phash_sources().items() if source == "preview"}
+        TRANSPORT.ensure_pool_size("previews", workers)
+        cursor = None
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while not (limit and seen >= limit):
+                page = api.fetch_posts(tags, limit=PREVIEW_PAGE_LIMIT, page=f"b{cursor}" if cursor else 1,
+                                       raise_errors=True, only="browse")
+                if not page:
+                    break
+                cursor = min(p["id"] for p in page)
+                posts = [p for p in page if p.get("preview_file_url") and p["id"] not in skip]
+                if limit:
+                    posts = posts[:limit - seen]
+                seen += len(posts)
+                batch = []
+                for post_id, value, error in executor.map(fetch, posts):
+                    if error:
+                        failed += 1
+                        progress(f"Couldn't hash the preview of post {post_id}: {error}")
+                    else:
+                        batch.append((post_id, value, "preview", None, None, None))
+                manifest.add_phashes(batch)
+                hashed += len(batch)
+                progress(f"{hashed} previews hashed")
+    finally:
+        manifest.close()
+    return hashed, failed
+
+def _popcount(np, values):
+    if hasattr(np, "bitwise_count"): # numpy 2.0+
+        return np.bitwise_count(values)
+    table = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+    return table[values.view(np.uint8).reshape(values.shape + (8,))].sum(axis=-1, dtype=np.uint8)
+
+def find_clusters(hashes, max_distance=DEFAULT_DISTANCE):
+    """
+    hashes: [(post id, signed 64-bit hash)]. Returns clusters of post ids,
+    largest first, each with the closest pairs that put it together as
+    [(id, id, distance)].
+    """
+    np = _numpy()
+    if len(hashes) < 2:
+        return []
+    ids = np.array([post_id for post_id, _ in hashes], dtype=np.int64)
+    values = np.array([value for _, value in hashes], dtype=np.int64).view(np.uint64)
+    n = len(values)
+    rows = max(1, BLOCK_ELEMENTS // n)
+    parent = list(range(n))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    edges = []
+    for start in range(0, n - 1, rows):
+        stop = min(start + rows, n - 1)
+        # Row i against columns i+1..n: each pair once
+        distances = _popcount(np, values[start:stop, None] ^ values[None, start + 1:])
+        close = distances <= max_distance
+        close &= np.arange(start, stop)[:, None] < np.arange(start + 1, n)[None, :]
+        for i, j in zip(*np.nonzero(close)):
+            a, b = start + int(i), start + 1 + int(j)
+            edges.append((a, b, int(distances[i, j])))
+            ra, rb = root(a), root(b)
+            if ra != rb:
+                parent[rb] = ra
+
+    members = {}
+    for i in range(n):
+        members.setdefault(root(i), []).append(i)
+    pairs = {}
+    for a, b, distance in edges:
+        pairs.setdefault(root(a), []).append((int(ids[a]), int(ids[b]), distance))
+    clusters = [{"ids": sorted(int(ids[i]) for i in group), "pairs": sorted(pairs[key], key=lambda p: p[2])}
+                for key, group in members.items() if len(group) > 1]
+    clusters.sort(key=lambda c: (-len(c["ids"]), c["ids"][0]))
+    return clusters
+
+def folder_clusters(folder, max_distance=DEFAULT_DISTANCE):
+    """Clusters of folder's hashed posts; each cluster also maps post id -> source ("file", "archive", "preview")."""
+    manifest = Manifest(folder)
+    try:
+        rows = manifest.phashes()
+    finally:
+        manifest.close()
+    sources = {post_id: source for post_id, _, source in rows}
+    clusters = find_clusters([(post_id, value) for post_id, value, _ in rows], max_distance)
+    for cluster in clusters:
+        cluster["sources"] = {post_id: sources[post_id] for post_id in cluster["ids"]}
+    return clusters
+
+def print_clusters(clusters, limit=50):
+    for cluster in clusters[:limit]:
+        members = ", ".join(f"{post_id}{'' if source != 'preview' else ' (not downloaded)'}"
+                            for post_id, source in cluster["sources"].items())
+        closest = cluster["pairs"][0][2]
+        print(f"{len(cluster['ids'])} posts, closest {closest} bits apart: {members}")
+    if len(clusters) > limit:
+        print(f"... and {len(clusters) - limit} more")
+    print(f"{len(clusters)} clusters, {sum(len(c['ids']) for c in clusters)} posts")
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Find near-duplicate images by perceptual hash")
+    sub = parser.add_subparsers(dest="command", required=True)
+    scan_cmd = sub.add_parser("scan", help="Hash new and changed images in a folder, then list clusters")
+    scan_cmd.add_argument("folder")
+    scan_cmd.add_argument("--workers", type=int, default=0, help="Hashing processes (default: CPUs - 1)")
+    previews_cmd = sub.add_parser("previews", help="Hash the previews of a query's posts not in the folder yet")
+    previews_cmd.add_argument("folder")
+    previews_cmd.add_argument("tags")
+    previews_cmd.add_argument("--limit", type=int, help="Hash at most this many posts")
+    clusters_cmd = sub.add_parser("clusters", help="List clusters from the stored hashes")
+    clusters_cmd.add_argument("folder")
+    for cmd in (scan_cmd, previews_cmd, clusters_cmd):
+        cmd.add_argument("--distance", type=int, default=DEFAULT_DISTANCE, help="Max differing bits of 64 (default 8)")
+        cmd.add_argument("--json", metavar="OUTPUT", help="Also write the clusters to a JSON file")
+    args = parser.parse_args()
+
+    if args.command == "scan":
+        hashed, failed = scan(args.folder, args.workers)
+        print(f"{hashed} images hashed, {failed} failed")
+    elif args.command == "previews":
+        from danbooru_api import DanbooruClient
+        from security import SecurityManager
+        from config import load_settings
+        from transport import TRANSPORT
+
+        settings = load_settings(SecurityManager())
+        TRANSPORT.apply_settings(settings)
+        api = DanbooruClient(settings["username"], settings["apikey"], settings["username"], settings["email"],
+                             rate_limit=settings["api_rate"])
+        hashed, failed = hash_previews(args.folder, api, args.tags, args.limit)
+        print(f"{hashed} previews hashed, {failed} failed")
+
+    clusters = folder_clusters(args.folder, args.distance)
+    print_clusters(clusters)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(clusters, f, indent=2)
+        print(f"Wrote {len(clusters)} clusters to {args.json}")
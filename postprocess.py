@@ -0,0 +1,263 @@
+"""
+Post-processing of finished downloads on a process pool.
+
+DownloadManager hands each file it saved to a PostProcessor right after
+callback_complete. The file then goes through the configured stages in a
+worker process, so image work doesn't compete with the download threads
+for the GIL, and the file is read while it is still in the page cache.
+
+Built-in stages:
+
+    webp      PNG -> lossless WebP (<id>.webp replaces <id>.png)
+    strip     drop EXIF/XMP/IPTC/comments from JPEG and text chunks from PNG,
+              without re-encoding
+    preview   write a 512 px JPEG to .previews/<id>.jpg next to the file
+
+Any other stage is "module:function". The function gets the file's path
+in the worker process and returns the new path if it renamed the file,
+otherwise None. Stages replace files through a temporary file and
+os.replace, so a hardlinked copy in another folder is never changed.
+
+At most max_pending files wait or run at once. Past that, submit()
+blocks, which holds the download thread and slows downloads to the speed
+the stages can keep up with.
+"""
+import os
+import time
+import struct
+import importlib
+import functools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from metrics import POSTPROCESS_SECONDS, POSTPROCESS_FILES, POSTPROCESS_PENDING
+
+PREVIEW_DIR = ".previews"
+PREVIEW_SIZE = 512
+IMAGE_EXTS = ("jpg", "jpeg", "png", "webp", "gif", "bmp")
+
+def _ext(path):
+    return path.rsplit(".", 1)[-1].lower()
+
+def _replace(path, data, new_path=None):
+    """Write data to new_path (default: path) via a temporary file."""
+    new_path = new_path or path
+    folder, name = os.path.split(new_path)
+    tmp = os.path.join(folder, f".{name}.tmp")
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, new_path)
+
+def preview_path(path):
+    """Where the preview stage puts path's preview."""
+    folder, name = os.path.split(path)
+    return os.path.join(folder, PREVIEW_DIR, name.rsplit(".", 1)[0] + ".jpg")
+
+# --- Built-in stages (run in the worker processes) ---
+
+def to_webp(path):
+    if _ext(path) != "png":
+        return None
+    from io import BytesIO
+    from PIL import Image
+    buffer = BytesIO()
+    with Image.open(path) as image:
+        # 16-bit PNGs would lose depth, and WebP stops at 16383 px
+        if image.mode not in ("1", "L", "LA", "P", "RGB", "RGBA") or max(image.size) > 16383:
+            return None
+        image.save(buffer, "WEBP", lossless=True, method=4, exact=True)
+    new_path = path.rsplit(".", 1)[0] + ".webp"
+    _replace(path, buffer.getvalue(), new_path)
+    os.remove(path)
+    return new_path
+
+# APP0 (JFIF), APP2 (ICC profile) and APP14 (Adobe colour transform) affect how the image decodes
+_JPEG_DROP = set(range(0xE1, 0xF0)) - {0xE2, 0xEE} | {0xFE}
+
+def _strip_jpeg(data):
+    if data[:2] != b"\xff\xd8":
+        return None
+    out = [data[:2]]
+    pos = 2
+    dropped = False
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None # not a marker where one should be; leave the file alone
+        marker = data[pos + 1]
+        if marker == 0xDA: # start of scan: the rest is image data
+            out.append(data[pos:])
+            break
+        length = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+        segment = data[pos:pos + 2 + length]
+        keep = marker not in _JPEG_DROP
+        if marker == 0xE2 and not segment[4:16].startswith(b"ICC_PROFILE"):
+            keep = False
+        if keep:
+            out.append(segment)
+        else:
+            dropped = True
+        pos += 2 + length
+    return b"".join(out) if dropped else None
+
+_PNG_DROP = {b"tEXt", b"zTXt", b"iTXt", b"eXIf", b"tIME"}
+
+def _strip_png(data):
+    if data[:8] != b"\x89PNG\r\n\x1a\n":
+        return None
+    out = [data[:8]]
+    pos = 8
+    dropped = False
+    while pos + 8 <= len(data):
+        length, kind = struct.unpack(">I4s", data[pos:pos + 8])
+        end = pos + 12 + length
+        if kind in _PNG_DROP:
+            dropped = True
+        else:
+            out.append(data[pos:end])
+        pos = end
+        if kind == b"IEND":
+            break
+    return b"".join(out) if dropped else None
+
+def strip_metadata(path):
+    ext = _ext(path)
+    if ext not in ("jpg", "jpeg", "png"):
+        return None
+    with open(path, 'rb') as f:
+        data = f.read()
+    stripped = _strip_png(data) if ext == "png" else _strip_jpeg(data)
+    if stripped is not None:
+        _replace(path, stripped)
+    return None
+
+def make_preview(path):
+    if _ext(path) not in IMAGE_EXTS:
+        return None
+    from io import BytesIO
+    from PIL import Image
+    target = preview_path(path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    buffer = BytesIO()
+    with Image.open(path) as image:
+        image.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+        image.convert("RGB").save(buffer, "JPEG", quality=85)
+    _replace(target, buffer.getvalue())
+    return None
+
+STAGES = {
+    "webp": "postprocess:to_webp",
+    "strip": "postprocess:strip_metadata",
+    "preview": "postprocess:make_preview",
+}
+
+def _resolve(spec):
+    module, _, name = STAGES.get(spec, spec).partition(":")
+    if not name:
+        raise ValueError(f"Unknown post-processing stage {spec!r}: use {', '.join(STAGES)} or module:function")
+    return getattr(importlib.import_module(module), name)
+
+def _run_stages(path, stages, submitted):
+    """Worker side. Returns (final path, [(stage, seconds, error or None)]), the first entry being queue time."""
+    timings = [("queue", time.time() - submitted, None)]
+    for stage in stages:
+        start = time.perf_counter()
+        try:
+            new_path = _resolve(stage)(path)
+            if new_path:
+                path = new_path
+            timings.append((stage, time.perf_counter() - start, None))
+        except Exception as e:
+            timings.append((stage, time.perf_counter() - start, f"{type(e).__name__}: {e}"))
+            break # later stages may depend on this one
+    return path, timings
+
+class PostProcessor:
+    def __init__(self, stages, workers=0, max_pending=None):
+        self.stages = list(stages)
+        for stage in self.stages:
+            _resolve(stage) # fail now rather than in every worker
+        workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        if multiprocessing.current_process().daemon:
+            # Daemon processes (sharded download workers) can't start children; run the stages in a thread
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="postprocess")
+        else:
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.max_pending = max_pending or workers * 4
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.stats = {stage: {"files": 0, "errors": 0, "seconds": 0.0} for stage in ["queue"] + self.stages}
+
+    def submit(self, path, stop_event=None, on_done=None):
+        """
+        Queue path for processing; blocks while max_pending files are queued.
+        on_done is called with the file's final path (stages may rename it)
+        before wait() returns. Returns the future, or None if stopped.
+        """
+        while not self.slots.acquire(timeout=0.5):
+            if stop_event is not None and stop_event.is_set():
+                return None
+        try:
+            future = self.executor.submit(_run_stages, path, self.stages, time.time())
+        except Exception:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.pending.add(future)
+            POSTPROCESS_PENDING.set(len(self.pending))
+        future.add_done_callback(functools.partial(self._done, path, on_done))
+        return future
+
+    def _done(self, path, on_done, future):
+        try:
+            self._report(future)
+            if on_done:
+                on_done(future.result()[0] if not future.cancelled() and not future.exception() else path)
+        finally:
+            with self.lock:
+                self.pending.discard(future)
+                POSTPROCESS_PENDING.set(len(self.pending))
+            self.slots.release()
+
+    def _report(self, future):
+        try:
+            path, timings = future.result()
+        except Exception as e:
+            print(f"Post-processing failed: {e}")
+            return
+        for stage, seconds, error in timings:
+            with self.lock:
+                stats = self.stats.setdefault(stage, {"files": 0, "errors": 0, "seconds": 0.0})
+                stats["files"] += 1
+                stats["seconds"] += seconds
+                if error:
+                    stats["errors"] += 1
+            POSTPROCESS_SECONDS.observe(seconds, stage=stage)
+            if stage != "queue":
+                POSTPROCESS_FILES.inc(stage=stage, result="error" if error else "ok")
+            if error:
+                print(f"Post-processing stage {stage} failed for {path}: {error}")
+
+    def wait(self):
+        """Block until every queued file has been processed."""
+        while True:
+            with self.lock:
+                pending = list(self.pending)
+            if not pending:
+                return
+            for future in pending:
+                try:
+                    future.result()
+                except Exception:
+                    pass # reported by _done
+
+    def report(self):
+        """{stage: {"files", "errors", "seconds", "avg_ms"}}; "queue" is the wait before a worker picked the file up."""
+        with self.lock:
+            return {stage: dict(s, seconds=round(s["seconds"], 3),
+                                avg_ms=round(s["seconds"] / s["files"] * 1000, 1) if s["files"] else 0)
+                    for stage, s in self.stats.items()}
+
+    def shutdown(self):
+        self.wait()
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,167 @@
+import io
+import os
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import functools
+from contextlib import contextmanager
+
+class Profiler:
+    """
+    Session profiler behind the --profile flag.
+
+    Spans time named sections of the app (rendering, thumbnail decode, cache
+    cleanup, decryption, network). On top of that a session can capture
+    cProfile data for the Tk thread ("cprofile") or sample the stacks of all
+    threads ("sampling"). report() ranks everything by time spent.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.mode = None
+        self.started_at = None
+        self.lock = threading.Lock()
+        self.spans = {} # name -> [count, total, max]
+        self.cprofile = None
+        self.sample_interval = 0.01
+        self.samples = {} # collapsed stack -> count
+        self.sample_count = 0
+        self._sampler = None
+        self._stop = threading.Event()
+
+    def start(self, mode="spans"):
+        """mode: "spans", "cprofile" or "sampling" (spans are recorded in every mode)."""
+        self.enabled = True
+        self.mode = mode
+        self.started_at = time.perf_counter()
+        if mode == "cprofile":
+            # cProfile only sees the thread that enables it: the Tk main loop
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        elif mode == "sampling":
+            self._stop.clear()
+            self._sampler = threading.Thread(target=self._sample_loop, name="profiler-sampler", daemon=True)
+            self._sampler.start()
+        print(f"Profiling enabled ({mode})")
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        if self.cprofile:
+            self.cprofile.disable()
+        if self._sampler:
+            self._stop.set()
+            self._sampler.join()
+            self._sampler = None
+
+    def record(self, name, elapsed):
+        with self.lock:
+            entry = self.spans.get(name)
+            if entry is None:
+                self.spans[name] = [1, elapsed, elapsed]
+            else:
+                entry[0] += 1
+                entry[1] += elapsed
+                if elapsed > entry[2]:
+                    entry[2] = elapsed
+
+    def _sample_loop(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.sample_interval):
+            for t in threading.enumerate():
+                names[t.ident] = t.name
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                key = names.get(ident, str(ident)) + ";" + ";".join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+            self.sample_count += 1
+
+    def report(self, top=30):
+        out = io.StringIO()
+        duration = time.perf_counter() - self.started_at if self.started_at else 0
+        out.write(f"Profile report ({self.mode}), session {duration:.1f}s\n\n")
+
+        out.write("Spans by total time\n")
+        out.write(f"{'span':<32}{'calls':>8}{'total s':>10}{'mean ms':>10}{'max ms':>10}\n")
+        with self.lock:
+            spans = sorted(self.spans.items(), key=lambda kv: kv[1][1], reverse=True)
+        for name, (count, total, worst) in spans:
+            out.write(f"{name:<32}{count:>8}{total:>10.3f}{total / count * 1000:>10.2f}{worst * 1000:>10.2f}\n")
+
+        if self.cprofile:
+            out.write(f"\ncProfile (Tk thread), top {top} by cumulative time\n")
+            stats = pstats.Stats(self.cprofile, stream=out)
+            stats.sort_stats("cumulative").print_stats(top)
+
+        if self.samples:
+            own_time = {}
+            for stack, count in self.samples.items():
+                leaf = stack.rsplit(";", 1)[-1]
+                own_time[leaf] = own_time.get(leaf, 0) + count
+            out.write(f"\nSampling: {self.sample_count} samples every {self.sample_interval * 1000:.0f} ms, "
+                      f"top {top} functions by own samples\n")
+            for leaf, count in sorted(own_time.items(), key=lambda kv: kv[1], reverse=True)[:top]:
+                out.write(f"{count:>8}  {leaf}\n")
+        return out.getvalue()
+
+    def write_report(self, path=None):
+        path = path or time.strftime("profile_%Y%m%d-%H%M%S.txt")
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(self.report())
+            if self.samples:
+                # Collapsed stacks, readable by flamegraph.pl / speedscope
+                with open(path.rsplit(".", 1)[0] + ".stacks", 'w', encoding='utf-8') as f:
+                    for stack, count in self.samples.items():
+                        f.write(f"{stack} {count}\n")
+            print(f"Profile report written to {path}")
+        except Exception as e:
+            print(f"Failed to write profile report: {e}")
+        return path
+
+PROFILER = Profiler()
+
+@contextmanager
+def _timed_span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        PROFILER.record(name, time.perf_counter() - start)
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+def span(name):
+    """with span("thumbnail.decode"): ... (free when profiling is off)"""
+    if not PROFILER.enabled:
+        return _NO_SPAN
+    return _timed_span(name)
+
+def timed(name):
+    """Decorator form of span()."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return fn(*args, **kwargs)
+            with _timed_span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,55 @@
+import os
+import json
+from metrics import SYNC_TOP_ID, SYNC_LOWEST_ID, SYNC_COMPLETE
+
+class ResumeManager:
+    def __init__(self, download_path, security_manager, file_name=".danbooru_resume.json"):
+        self.file_path = os.path.join(download_path, file_name)
+        self.security = security_manager
+        self.state = self.load()
+
+    def load(self):
+        if os.path.exists(self.file_path):
+            try:
+                with open(self.file_path, 'r', encoding='utf-8') as f:
+                    encrypted_data = f.read()
+                    decrypted_data = self.security.decrypt(encrypted_data)
+                    return json.loads(decrypted_data)
+            except:
+                pass
+        return {}
+
+    def save(self, query, top_id, last_page, is_complete, lowest_id=None):
+        data = {
+            "query": query,
+            "top_id": top_id,
+            "lowest_id": lowest_id,
+            "last_page": last_page,
+            "is_complete": is_complete,
+            "updated_at": str(os.path.getmtime(self.file_path)) if os.path.exists(self.file_path) else None
+        }
+        try:
+            json_str = json.dumps(data, indent=2)
+            encrypted_data = self.security.encrypt(json_str)
+            with open(self.file_path, 'w', encoding='utf-8') as f:
+                f.write(encrypted_data)
+            self.state = data
+        except Exception as e:
+            print(f"Error saving resume state: {e}")
+
+        if top_id:
+            SYNC_TOP_ID.set(top_id)
+        if lowest_id:
+            SYNC_LOWEST_ID.set(lowest_id)
+        SYNC_COMPLETE.set(1 if is_complete else 0)
+
+    def get_query(self):
+        return self.state.get("query")
+
+    def get_state(self):
+        return {
+            "top_id": self.state.get("top_id"),
+            "lowest_id": self.state.get("lowest_id"),
+            "last_page": self.state.get("last_page", 1),
+            "is_complete": self.state.get("is_complete", False)
+        }
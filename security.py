@@ -1,6 +1,7 @@
 import os
 from cryptography.fernet import Fernet
 import keyring
+from profiling import timed
 
 class SecurityManager:
     def __init__(self, key_file=".secret.key"):
@@ -40,11 +41,13 @@ class SecurityManager:
                 f.write(key)
         return key
 
+    @timed("security.encrypt")
     def encrypt(self, data):
         if not data:
             return ""
         return self.cipher.encrypt(data.encode()).decode()
 
+    @timed("security.decrypt")
     def decrypt(self, token):
         if not token:
             return ""
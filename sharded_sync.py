@@ -0,0 +1,292 @@
+"""
+Sharded bulk download for very large tags.
+
+The id span of a query is cut into disjoint ranges (shards). Worker
+processes take shards from a shared queue, each with its own DanbooruClient,
+DownloadManager and per-shard resume file, so one slow process or the GIL
+doesn't cap the whole run. The coordinator merges their progress and is the
+only writer of the folder's manifest.
+
+    python sharded_sync.py "tag_name" --processes 4
+"""
+import os
+import json
+import time
+import queue
+import signal
+import threading
+import multiprocessing
+from danbooru_api import DanbooruClient
+from downloader import DownloadManager
+from resume_manager import ResumeManager
+from sync_engine import SyncEngine
+from manifest import Manifest
+from enumerator import find_id_bounds
+from security import SecurityManager
+from transport import TRANSPORT
+from layout import folder_layout, locate
+
+PLAN_FILE = ".danbooru_shards.json"
+
+def shard_resume_file(index):
+    return f".danbooru_resume.shard{index}.json"
+
+def plan_shards(api, tags, shard_count):
+    """Split the id span of tags into shard_count contiguous ranges, newest first."""
+    bounds = find_id_bounds(api, tags)
+    if not bounds:
+        return []
+    low, high = bounds
+    shard_count = max(1, min(shard_count, high - low + 1))
+    width = (high - low + 1) / shard_count
+    shards = []
+    for i in range(shard_count):
+        shard_high = high - round(i * width)
+        shard_low = high - round((i + 1) * width) + 1
+        shards.append({"index": i, "low_id": shard_low, "high_id": shard_high})
+    return shards
+
+def _mirror_controls(stop_event, go_event, downloader):
+    # multiprocessing events can't be handed to DownloadManager directly
+    while not stop_event.wait(0.2):
+        if go_event.is_set():
+            downloader.pause_event.set()
+        else:
+            downloader.pause_event.clear()
+    downloader.stop_all()
+
+def _shard_worker(worker, settings, tags, folder, task_queue, event_queue, stop_event, go_event, security_factory, api_rate, bandwidth):
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl+C is handled by the coordinator
+    pid = os.getpid()
+    security = security_factory()
+    TRANSPORT.apply_settings(settings)
+    api = DanbooruClient(settings["username"], settings["apikey"], settings["username"], settings["email"],
+                         base_url=settings.get("base_url"), rate_limit=api_rate)
+    downloader = DownloadManager(max_workers=settings["max_workers"], bandwidth_limit=bandwidth,
+                                 auto_concurrency=settings.get("auto_concurrency", False))
+    downloader.apply_settings(settings)
+    # Each process appends to its own shards and metadata file
+    downloader.archive_prefix = f"posts-w{worker}"
+    downloader.metadata_file = f"metadata.w{worker}.jsonl"
+    threading.Thread(target=_mirror_controls, args=(stop_event, go_event, downloader), daemon=True).start()
+
+    while not stop_event.is_set():
+        try:
+            shard = task_queue.get_nowait()
+        except queue.Empty:
+            break
+        index = shard["index"]
+
+        def on_page(posts, index=index):
+            rows = []
+            layout = folder_layout(folder, downloader.layout)
+            archive = downloader.archives.get(folder)
+            for p in posts:
+                if not p.get('file_url'):
+                    continue
+                if archive:
+                    entry = archive.index.lookup(p['id'])
+                    if entry:
+                        rows.append((p['id'], f"{entry[0]}/{entry[1]}", p.get('md5'), p.get('file_size')))
+                    continue
+                path = locate(folder, p, layout)
+                if os.path.exists(path):
+                    rows.append((p['id'], os.path.relpath(path, folder), p.get('md5'), p.get('file_size')))
+            event_queue.put(("page", pid, index, downloader.files_downloaded, downloader.bytes_downloaded, rows))
+
+        callbacks = {
+            'on_page': on_page,
+            'on_error': lambda err: event_queue.put(("error", pid, err)),
+        }
+        resume_mgr = ResumeManager(folder, security, file_name=shard_resume_file(index))
+        engine = SyncEngine(api, downloader, folder, resume_mgr)
+        ok = engine.run_range(tags, shard["low_id"], shard["high_id"], callbacks)
+        event_queue.put(("shard_done", pid, index, ok, downloader.files_downloaded, downloader.bytes_downloaded))
+
+    downloader.executor.shutdown(wait=True)
+    downloader.close()
+    event_queue.put(("exit", pid))
+
+class ShardedSync:
+    """
+    Coordinator for a sharded download.
+    settings: dict with username, apikey, email, max_workers (per process)
+    and optionally api_rate, bandwidth_limit in KB/s (both shared by all
+    processes) and base_url.
+    security_factory builds the security manager inside each process (it
+    holds a keyring-backed key and isn't sent across processes).
+    """
+
+    def __init__(self, settings, download_path, processes=4, shards=None, security_factory=SecurityManager):
+        self.settings = settings
+        self.download_path = download_path
+        self.processes = processes
+        self.shard_count = shards or processes * 4 # more shards than processes keeps them all busy
+        self.security_factory = security_factory
+        self.security = security_factory()
+        self.ctx = multiprocessing.get_context("spawn")
+        self.stop_event = self.ctx.Event()
+        self.go_event = self.ctx.Event()
+        self.go_event.set()
+
+    def _load_plan(self, tags):
+        path = os.path.join(self.download_path, PLAN_FILE)
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    plan = json.loads(self.security.decrypt(f.read()))
+                if plan.get("query") == tags:
+                    return plan["shards"]
+                print("Shard plan belongs to another query; planning again")
+            except Exception as e:
+                print(f"Failed to read shard plan: {e}")
+        return None
+
+    def _save_plan(self, tags, shards):
+        path = os.path.join(self.download_path, PLAN_FILE)
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(self.security.encrypt(json.dumps({"query": tags, "shards": shards}, indent=2)))
+        except Exception as e:
+            print(f"Failed to save shard plan: {e}")
+
+    def _finish(self, tags, shards):
+        """All shards done: hand over to the regular resume file so later runs only fetch the delta."""
+        ResumeManager(self.download_path, self.security).save(
+            tags, max(s["high_id"] for s in shards), 0, True, min(s["low_id"] for s in shards))
+        for name in [PLAN_FILE] + [shard_resume_file(s["index"]) for s in shards]:
+            try:
+                os.remove(os.path.join(self.download_path, name))
+            except OSError:
+                pass
+
+    def toggle_pause(self):
+        if self.go_event.is_set():
+            self.go_event.clear()
+            return True
+        self.go_event.set()
+        return False
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self, tags, callbacks=None):
+        """
+        callbacks: dict of functions {'on_status': fn, 'on_error': fn}
+        Returns a summary dict; "complete" is True when every shard finished.
+        """
+        callbacks = callbacks or {}
+        on_status = callbacks.get('on_status') or (lambda text: None)
+        on_error = callbacks.get('on_error') or (lambda err: print(f"Error: {err}"))
+        if not os.path.exists(self.download_path):
+            os.makedirs(self.download_path)
+
+        shards = self._load_plan(tags)
+        if shards is None:
+            api = DanbooruClient(self.settings["username"], self.settings["apikey"], self.settings["username"],
+                                 self.settings["email"], base_url=self.settings.get("base_url"),
+                                 rate_limit=self.settings.get("api_rate"))
+            shards = plan_shards(api, tags, self.shard_count)
+            if not shards:
+                return {"complete": True, "shards": 0, "done": 0, "failed": 0, "files": 0, "bytes": 0, "manifest_posts": 0, "seconds": 0}
+            self._save_plan(tags, shards)
+
+        pending = [s for s in shards
+                   if not ResumeManager(self.download_path, self.security, shard_resume_file(s["index"])).get_state()["is_complete"]]
+        print(f"{len(shards)} shards over ids {shards[-1]['low_id']}..{shards[0]['high_id']}, "
+              f"{len(pending)} to do, {self.processes} processes")
+
+        task_queue = self.ctx.Queue()
+        event_queue = self.ctx.Queue()
+        for shard in pending:
+            task_queue.put(shard)
+
+        workers = []
+        process_count = min(self.processes, len(pending))
+        # The API rate limit and bandwidth cap are split evenly between the processes
+        api_rate = self.settings.get("api_rate")
+        api_rate = api_rate / max(1, process_count) if api_rate else None
+        bandwidth = (self.settings.get("bandwidth_limit") or 0) * 1024 // max(1, process_count)
+        for worker in range(process_count):
+            p = self.ctx.Process(target=_shard_worker, daemon=True,
+                                 args=(worker, self.settings, tags, self.download_path, task_queue, event_queue,
+                                       self.stop_event, self.go_event, self.security_factory, api_rate, bandwidth))
+            p.start()
+            workers.append(p)
+
+        manifest = Manifest(self.download_path)
+        done = len(shards) - len(pending)
+        failed = 0
+        totals = {} # pid -> (files, bytes); cumulative per process, newest report wins
+        exited = 0
+        started = time.perf_counter()
+        try:
+            while exited < len(workers):
+                try:
+                    event = event_queue.get(timeout=0.5)
+                except queue.Empty:
+                    if not any(p.is_alive() for p in workers):
+                        break # a process died without saying goodbye
+                    continue
+                except KeyboardInterrupt:
+                    print("Stopping shard workers...")
+                    self.stop()
+                    continue
+
+                kind = event[0]
+                if kind == "page":
+                    _, pid, index, files, size, rows = event
+                    totals[pid] = (files, size)
+                    if rows:
+                        manifest.add_posts(rows, query=tags, shard=index)
+                elif kind == "shard_done":
+                    _, pid, index, ok, files, size = event
+                    totals[pid] = (files, size)
+                    if ok:
+                        done += 1
+                    elif not self.stop_event.is_set():
+                        failed += 1
+                elif kind == "error":
+                    on_error(event[2])
+                    continue
+                elif kind == "exit":
+                    exited += 1
+                    continue
+
+                files = sum(f for f, _ in totals.values())
+                size = sum(b for _, b in totals.values())
+                on_status(f"Shards {done}/{len(shards)} | {files} files | {size / 1048576:.1f} MB")
+        finally:
+            for p in workers:
+                p.join(timeout=10)
+            manifest_count = manifest.count()
+            manifest.close()
+
+        complete = done == len(shards) and not self.stop_event.is_set()
+        if complete:
+            self._finish(tags, shards)
+        return {"complete": complete, "shards": len(shards), "done": done, "failed": failed,
+                "files": sum(f for f, _ in totals.values()), "bytes": sum(b for _, b in totals.values()),
+                "manifest_posts": manifest_count, "seconds": round(time.perf_counter() - started, 3)}
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    import argparse
+    from config import load_settings
+
+    parser = argparse.ArgumentParser(description="Download a large tag with several processes")
+    parser.add_argument("tags")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--shards", type=int, help="Number of id ranges (default: 4 per process)")
+    parser.add_argument("--output", help="Target folder (default: download path from settings)")
+    parser.add_argument("--bandwidth-limit", type=int, metavar="KBPS", help="Cap total download speed in KB/s (0 = off)")
+    args = parser.parse_args()
+
+    security = SecurityManager()
+    settings = load_settings(security)
+    tags = args.tags + (" is:sfw" if settings["safe_search"] else "")
+    if args.bandwidth_limit is not None:
+        settings["bandwidth_limit"] = args.bandwidth_limit
+
+    sync = ShardedSync(settings, args.output or settings["download_path"], processes=args.processes, shards=args.shards)
+    print(sync.run(tags, {'on_status': print}))
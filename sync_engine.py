@@ -0,0 +1,230 @@
+import threading
+from metrics import SYNC_PAGES
+from enumerator import RangeEnumerator
+from transport import TRANSPORT
+
+class SyncEngine:
+    """
+    Bulk download driven by id ranges instead of page numbers.
+
+    Resume state keeps the newest id (top_id) and the lowest id reached so far
+    (lowest_id). A run fetches the delta above top_id, then backfills below
+    lowest_id until the query is exhausted. Both walks use Danbooru's id
+    cursors ("a<id>" / "b<id>"), which select the same ranges as id:>N / id:<N
+    without using up a tag slot. With partitions > 1 the downward walks fetch
+    several id ranges at once (see RangeEnumerator).
+    """
+
+    PAGE_LIMIT = 100
+
+    def __init__(self, api, downloader, download_path, resume_mgr, page_limit=PAGE_LIMIT, only=None, partitions=1):
+        self.api = api
+        self.downloader = downloader
+        self.download_path = download_path
+        self.resume_mgr = resume_mgr
+        self.page_limit = page_limit
+        self.only = only
+        self.partitions = partitions
+        TRANSPORT.ensure_pool_size("api", partitions + 2)
+        self.api_calls = 0
+        self.pages = 0
+        self.lock = threading.Lock()
+
+    def _stopped(self):
+        return self.downloader.stop_event.is_set()
+
+    def _fetch(self, tags, page, only=None, limit=None):
+        # Wait if paused (blocks here until resumed)
+        self.downloader.pause_event.wait()
+        with self.lock:
+            self.api_calls += 1
+        only = only or self.only or self.downloader.bulk_fields
+        return self.api.fetch_posts(tags, limit=limit or self.page_limit, page=page, raise_errors=True, only=only)
+
+    def walk_up(self, tags, above_id):
+        """Yield pages of posts newer than above_id, oldest page first."""
+        cursor = above_id
+        while not self._stopped():
+            posts = self._fetch(tags, f"a{cursor}")
+            if not posts:
+                return
+            yield posts
+            cursor = max(p['id'] for p in posts)
+
+    def walk_down(self, tags, below_id=None, floor_id=None):
+        """
+        Yield pages of posts older than below_id (or from the newest post), newest page first.
+        floor_id: stop at this id (inclusive).
+        """
+        if self.partitions > 1:
+            enumerator = RangeEnumerator(self._fetch, self.partitions, self.page_limit, self.downloader.stop_event)
+            yield from enumerator.walk_down(tags, below_id, floor_id)
+            return
+
+        cursor = below_id
+        while not self._stopped():
+            posts = self._fetch(tags, f"b{cursor}" if cursor else 1)
+            if floor_id:
+                in_range = [p for p in posts if p['id'] >= floor_id]
+                if in_range:
+                    yield in_range
+                if len(in_range) < len(posts) or not posts:
+                    return
+            else:
+                if not posts:
+                    return
+                yield posts
+            cursor = min(p['id'] for p in posts)
+
+    def walk_range(self, tags, low_id, high_id):
+        """Yield pages of posts with low_id <= id <= high_id, newest page first."""
+        yield from self.walk_down(tags, high_id + 1, floor_id=low_id)
+
+    def walk_numbered(self, tags):
+        """Yield pages by page number. Used for order: queries, where id cursors don't apply."""
+        page = 1
+        while not self._stopped():
+            posts = self._fetch(tags, page)
+            if not posts:
+                return
+            yield posts
+            page += 1
+
+    def _download(self, posts, callbacks, tags=""):
+        self.pages += 1
+        SYNC_PAGES.inc()
+        self._status(callbacks)
+        batch_futures = self.downloader.start_download_batch(posts, self.download_path, callbacks)
+        for f in batch_futures:
+            if self._stopped(): break
+            f.result()
+        self.downloader.flush()
+        on_page = callbacks.get('on_page')
+        if on_page and not self._stopped():
+            on_page(posts)
+
+    def _status(self, callbacks, text=None):
+        on_status = callbacks.get('on_status')
+        if on_status:
+            on_status(text or f"Page: {self.pages}")
+
+    def _resolve_legacy_lowest(self, tags, last_page):
+        """Old resume files only stored a page number; one request turns it into an id."""
+        posts = self._fetch(tags, last_page, only="id")
+        if posts:
+            return min(p['id'] for p in posts)
+        return None
+
+    def run(self, tags, repair_mode=False, callbacks=None):
+        """
+        Sync tags into download_path.
+        callbacks: dict of functions {'on_complete': fn, 'on_error': fn, 'on_status': fn, 'on_page': fn}
+        on_page receives each page of posts once its downloads have finished.
+        Returns True if the query was synced to the end without being stopped.
+        """
+        callbacks = callbacks or {}
+        self.api_calls = 0
+        self.pages = 0
+
+        try:
+            # Repair mode ignores resume state and rescans everything.
+            if repair_mode:
+                for posts in self.walk_down(tags):
+                    self._download(posts, callbacks, tags)
+                return not self._stopped()
+
+            if "order:" in tags.lower():
+                for posts in self.walk_numbered(tags):
+                    self._download(posts, callbacks, tags)
+                return not self._stopped()
+
+            return self._sync(tags, callbacks)
+        except Exception as e:
+            print(f"Sync error: {e}")
+            return False
+        finally:
+            self.downloader.flush()
+
+    def _state(self, tags):
+        """The resume state, or {} if it was saved for another query (its cursors mean nothing for tags)."""
+        stored = self.resume_mgr.get_query()
+        if stored and stored.lower() != tags.lower():
+            print(f"Resume state is for '{stored}', not '{tags}'; starting a fresh walk")
+            return {}
+        return self.resume_mgr.get_state()
+
+    def _sync(self, tags, callbacks):
+        state = self._state(tags)
+        top_id = state.get("top_id")
+        lowest_id = state.get("lowest_id")
+        is_complete = state.get("is_complete")
+        last_page = state.get("last_page") or 1
+
+        if top_id and not lowest_id and not is_complete and last_page > 1:
+            lowest_id = self._resolve_legacy_lowest(tags, last_page)
+
+        # 1. Delta: everything newer than what we already have
+        if top_id:
+            for posts in self.walk_up(tags, top_id):
+                self._download(posts, callbacks, tags)
+                if self._stopped(): break
+                top_id = max(top_id, max(p['id'] for p in posts))
+                self.resume_mgr.save(tags, top_id, self.pages, is_complete, lowest_id)
+            print(f"Delta sync for '{tags}' done in {self.api_calls} API calls")
+
+        if self._stopped():
+            return False
+
+        # 2. Backfill: everything older than the lowest id we reached
+        if not is_complete:
+            if lowest_id:
+                msg = f"Resuming below ID {lowest_id}..."
+                print(msg)
+                self._status(callbacks, msg)
+            for posts in self.walk_down(tags, lowest_id):
+                if top_id is None:
+                    top_id = max(p['id'] for p in posts)
+                self._download(posts, callbacks, tags)
+                if self._stopped(): break
+                lowest_id = min(p['id'] for p in posts)
+                self.resume_mgr.save(tags, top_id, self.pages, False, lowest_id)
+
+            if self._stopped():
+                return False
+            # Reached the end naturally
+            self.resume_mgr.save(tags, top_id, self.pages, True, lowest_id)
+
+        return True
+
+    def run_range(self, tags, low_id, high_id, callbacks=None):
+        """
+        Sync only the posts with low_id <= id <= high_id (one shard of a
+        sharded download). Resume state records how far down the range got.
+        Returns True once the whole range is done.
+        """
+        callbacks = callbacks or {}
+        self.api_calls = 0
+        self.pages = 0
+
+        state = self._state(tags)
+        if state.get("is_complete"):
+            return True
+        lowest_id = state.get("lowest_id")
+        start = lowest_id - 1 if lowest_id else high_id
+
+        try:
+            for posts in self.walk_range(tags, low_id, start):
+                self._download(posts, callbacks, tags)
+                if self._stopped(): break
+                lowest_id = min(p['id'] for p in posts)
+                self.resume_mgr.save(tags, high_id, self.pages, False, lowest_id)
+
+            if self._stopped():
+                return False
+            self.resume_mgr.save(tags, high_id, self.pages, True, low_id)
+            return True
+        except Exception as e:
+            print(f"Sync error in range {low_id}..{high_id}: {e}")
+            return False
+        finally:
+            self.downloader.flush()
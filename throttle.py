@@ -0,0 +1,103 @@
+import time
+import threading
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: rate tokens per second, bursts up to capacity.
+    rate 0 (or None) means unlimited.
+
+    Each acquire() reserves the next free slot (GCRA), so competing threads
+    are served in arrival order and get equal shares. Waits are sliced so
+    they can be interrupted (an interrupted wait returns its slot), and a
+    rate change applies to threads that are already waiting.
+    """
+
+    WAIT_SLICE = 0.05
+
+    def __init__(self, rate, capacity=None):
+        self.lock = threading.Lock()
+        self.rate = rate or 0
+        self.capacity = capacity or max(1.0, self.rate)
+        self.tat = time.monotonic() # theoretical arrival time of the next token
+        self.generation = 0
+
+    def set_rate(self, rate, capacity=None):
+        with self.lock:
+            self.rate = rate or 0
+            self.capacity = capacity or max(1.0, self.rate)
+            self.tat = time.monotonic()
+            self.generation += 1
+
+    def _reserve(self, tokens):
+        """Book tokens; returns when (monotonic time) they may be used. Call with lock held."""
+        now = time.monotonic()
+        self.tat = max(self.tat, now) + tokens / self.rate
+        return self.tat - self.capacity / self.rate
+
+    def acquire(self, tokens=1, stop_event=None, go_event=None):
+        """
+        Block until tokens are available. Returns False without them if
+        stop_event gets set or go_event (set means go, like a pause event)
+        gets cleared while waiting.
+        """
+        while True:
+            with self.lock:
+                if not self.rate:
+                    return True
+                generation = self.generation
+                ready_at = self._reserve(tokens)
+
+            while self.generation == generation:
+                wait = ready_at - time.monotonic()
+                if wait <= 0:
+                    return True
+                if (stop_event is not None and stop_event.is_set()) or (go_event is not None and not go_event.is_set()):
+                    self._refund(tokens, generation)
+                    return False
+                time.sleep(min(wait, self.WAIT_SLICE))
+            # The rate changed while we waited: book again at the new rate
+
+    def _refund(self, tokens, generation):
+        """Give back a reservation that won't be used, so later callers aren't delayed by it."""
+        with self.lock:
+            if self.generation == generation and self.rate: # set_rate() already reset the schedule
+                self.tat -= tokens / self.rate
+
+class ConcurrencyGate:
+    """
+    Semaphore whose limit can change while in use. Lowering the limit doesn't
+    interrupt anyone; it takes effect as active holders release.
+    """
+
+    def __init__(self, limit):
+        self.cond = threading.Condition()
+        self.limit = max(1, limit)
+        self.active = 0
+        self.waiting = 0
+        self.waited = 0 # acquires that had to queue, ever
+
+    def set_limit(self, limit):
+        with self.cond:
+            self.limit = max(1, limit)
+            self.cond.notify_all()
+
+    def acquire(self, stop_event=None):
+        """Returns False if stop_event was set while waiting for a slot."""
+        with self.cond:
+            if self.active >= self.limit:
+                self.waited += 1
+            self.waiting += 1
+            try:
+                while self.active >= self.limit:
+                    if stop_event is not None and stop_event.is_set():
+                        return False
+                    self.cond.wait(0.1)
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
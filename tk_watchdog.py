@@ -0,0 +1,151 @@
+import sys
+import time
+import tkinter
+import threading
+import traceback
+
+class TkWatchdog:
+    """
+    Measures how late the Tk main loop runs scheduled callbacks.
+
+    A heartbeat is scheduled every interval_ms; how late it fires goes into a
+    histogram. While installed, every after()/after_idle() callback is wrapped
+    so we know which one is running. A monitor thread notices when the
+    heartbeat is overdue by more than threshold_ms, grabs a stack sample of
+    the Tk thread while it is still stuck, and logs it with the callback name
+    once the loop is responsive again.
+
+    Create and install it from the Tk thread.
+    """
+
+    BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500]
+
+    def __init__(self, root, interval_ms=50, threshold_ms=200, log_path=None):
+        self.root = root
+        self.interval_ms = interval_ms
+        self.threshold_ms = threshold_ms
+        self.log_path = log_path
+        self.histogram = [0] * (len(self.BUCKETS_MS) + 1)
+        self.ticks = 0
+        self.max_lag_ms = 0
+        self.stalls = [] # (duration_ms, callback, stack)
+        self.slow_callbacks = {} # name -> [count, total_ms, max_ms]
+        self.current_callback = None
+        self._expected = None
+        self._pending_sample = None
+        self._main_ident = threading.get_ident()
+        self._stop = threading.Event()
+        self._original_after = None
+        self._original_after_idle = None
+
+    # --- Install / uninstall ---
+
+    def install(self):
+        self._wrap_after()
+        self._schedule()
+        threading.Thread(target=self._monitor, name="tk-watchdog", daemon=True).start()
+        print(f"UI watchdog on (stall threshold {self.threshold_ms} ms)")
+        return self
+
+    def uninstall(self):
+        self._stop.set()
+        if self._original_after:
+            tkinter.Misc.after = self._original_after
+            tkinter.Misc.after_idle = self._original_after_idle
+            self._original_after = None
+
+    def _wrap_after(self):
+        watchdog = self
+        original_after = self._original_after = tkinter.Misc.after
+        original_after_idle = self._original_after_idle = tkinter.Misc.after_idle
+
+        def after(widget, ms, func=None, *args):
+            if func is None:
+                return original_after(widget, ms)
+            return original_after(widget, ms, watchdog._wrap(func), *args)
+
+        def after_idle(widget, func, *args):
+            return original_after_idle(widget, watchdog._wrap(func), *args)
+
+        tkinter.Misc.after = after
+        tkinter.Misc.after_idle = after_idle
+
+    def _wrap(self, func):
+        name = getattr(func, "__qualname__", None) or repr(func)
+
+        def call(*args):
+            previous = self.current_callback
+            self.current_callback = name
+            start = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                self.current_callback = previous
+                elapsed_ms = (time.perf_counter() - start) * 1000
+                if elapsed_ms >= self.threshold_ms / 2:
+                    entry = self.slow_callbacks.setdefault(name, [0, 0.0, 0.0])
+                    entry[0] += 1
+                    entry[1] += elapsed_ms
+                    entry[2] = max(entry[2], elapsed_ms)
+        return call
+
+    # --- Heartbeat ---
+
+    def _schedule(self):
+        self._expected = time.perf_counter() + self.interval_ms / 1000
+        self._original_after(self.root, self.interval_ms, self._tick)
+
+    def _tick(self):
+        if self._stop.is_set():
+            return
+        now = time.perf_counter()
+        lag_ms = max(0.0, (now - self._expected) * 1000)
+        self.ticks += 1
+        self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+        for i, bound in enumerate(self.BUCKETS_MS):
+            if lag_ms <= bound:
+                self.histogram[i] += 1
+                break
+        else:
+            self.histogram[-1] += 1
+
+        sample = self._pending_sample
+        if sample:
+            self._pending_sample = None
+            if lag_ms >= self.threshold_ms:
+                self._report_stall(lag_ms, *sample)
+        self._schedule()
+
+    def _monitor(self):
+        while not self._stop.wait(self.threshold_ms / 4000):
+            if self._pending_sample is not None:
+                continue
+            overdue_ms = (time.perf_counter() - self._expected) * 1000
+            if overdue_ms >= self.threshold_ms:
+                frame = sys._current_frames().get(self._main_ident)
+                stack = "".join(traceback.format_stack(frame)) if frame else ""
+                self._pending_sample = (self.current_callback or "<event handler / unknown>", stack)
+
+    def _report_stall(self, lag_ms, callback, stack):
+        self.stalls.append((lag_ms, callback, stack))
+        message = f"[UI stall] {lag_ms:.0f} ms in {callback}\n{stack}"
+        print(message)
+        if self.log_path:
+            try:
+                with open(self.log_path, 'a', encoding='utf-8') as f:
+                    f.write(time.strftime("%Y-%m-%d %H:%M:%S ") + message + "\n")
+            except Exception as e:
+                print(f"Failed to write watchdog log: {e}")
+
+    # --- Summary ---
+
+    def summary(self):
+        lines = [f"UI watchdog: {self.ticks} heartbeats, max lag {self.max_lag_ms:.0f} ms, {len(self.stalls)} stalls >= {self.threshold_ms} ms"]
+        labels = [f"<= {b} ms" for b in self.BUCKETS_MS] + [f"> {self.BUCKETS_MS[-1]} ms"]
+        for label, count in zip(labels, self.histogram):
+            lines.append(f"  {label:<12} {count}")
+        if self.slow_callbacks:
+            lines.append("Slow callbacks (by total time):")
+            for name, (count, total, worst) in sorted(self.slow_callbacks.items(), key=lambda kv: kv[1][1], reverse=True)[:15]:
+                lines.append(f"  {name}: {count}x, total {total:.0f} ms, max {worst:.0f} ms")
+        return "\n".join(lines)
@@ -0,0 +1,342 @@
+"""
+Shared HTTP transport.
+
+Every request the app makes goes through one of a few named pools, each a
+requests.Session with its own retry policy and (connect, read) timeout:
+
+    api       Danbooru JSON API
+    files     full-size downloads (DownloadManager, ImageViewer)
+    previews  thumbnails shown while browsing
+
+Sessions keep one keep-alive connection pool per host. Callers declare how
+many requests they may run at once with ensure_pool_size(), so pools are
+never smaller than the concurrency in use (requests' default of 10 would
+otherwise drop connections when more workers share a host). New connections
+and requests are counted per pool, which gives the keep-alive reuse ratio.
+
+With enable_http2() (needs the optional httpx[http2] package) pools use
+HTTP/2 instead: all requests to a host share one multiplexed connection, so
+a page of thumbnails costs one handshake instead of one per thumbnail.
+Hosts that don't offer HTTP/2 are spoken to over HTTP/1.1 by the same
+session. Callers see the same session/response interface either way.
+"""
+import json
+import time
+import socket
+import threading
+import requests
+from datetime import timedelta
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry, RequestHistory
+from metrics import HTTP_REQUESTS, HTTP_CONNECTIONS
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# 429 is retried too; Retry honours the Retry-After header
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+POOLS = {
+    "api": {"timeout": (5, 10), "retries": 5, "backoff": 1},
+    "files": {"timeout": (5, 30), "retries": 5, "backoff": 0.5},
+    "previews": {"timeout": (5, 10), "retries": 2, "backoff": 0.3},
+}
+
+DEFAULT_POOL_SIZE = 10
+
+class PoolStats:
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.versions = {} # "HTTP/1.1" / "HTTP/2" -> responses
+
+    def count(self, field):
+        with self.lock:
+            setattr(self, field, getattr(self, field) + 1)
+        if field == "requests":
+            HTTP_REQUESTS.inc(pool=self.name)
+        else:
+            HTTP_CONNECTIONS.inc(pool=self.name)
+
+    def count_version(self, version):
+        with self.lock:
+            self.versions[version] = self.versions.get(version, 0) + 1
+
+    def reuse_ratio(self):
+        """Share of requests that went out on an already open connection."""
+        with self.lock:
+            if not self.requests:
+                return 0.0
+            return max(0.0, 1 - self.connections / self.requests)
+
+class _CountingAdapter(HTTPAdapter):
+    """HTTPAdapter that counts requests and the connections opened for them."""
+
+    def __init__(self, stats, pool_size, retries):
+        self.stats = stats
+        super().__init__(pool_connections=DEFAULT_POOL_SIZE, pool_maxsize=pool_size, max_retries=retries)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        super().init_poolmanager(connections, maxsize, block, **pool_kwargs)
+        stats = self.stats
+
+        def counting(base):
+            def _new_conn(pool):
+                stats.count("connections")
+                return base._new_conn(pool)
+            return type(base.__name__, (base,), {"_new_conn": _new_conn})
+
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": counting(HTTPConnectionPool),
+            "https": counting(HTTPSConnectionPool),
+        }
+
+    def send(self, request, **kwargs):
+        self.stats.count("requests")
+        return super().send(request, **kwargs)
+
+    def resize(self, maxsize):
+        old = self.poolmanager
+        self.init_poolmanager(self._pool_connections, maxsize, self._pool_block)
+        # Idle connections close now; ones in use close when they come back
+        old.clear()
+
+# --- HTTP/2 (httpx) ---
+
+def _to_requests_error(e):
+    """Map an httpx exception onto the requests exception callers already handle."""
+    if isinstance(e, httpx.ConnectTimeout):
+        return requests.exceptions.ConnectTimeout(str(e))
+    if isinstance(e, httpx.TimeoutException):
+        return requests.exceptions.ReadTimeout(str(e))
+    if isinstance(e, httpx.TransportError):
+        return requests.exceptions.ConnectionError(str(e))
+    return requests.exceptions.RequestException(str(e))
+
+def _httpx_timeout(timeout):
+    if isinstance(timeout, tuple):
+        connect, read = timeout
+        return httpx.Timeout(read, connect=connect)
+    return httpx.Timeout(timeout)
+
+class _Raw:
+    """Stands in for response.raw: only the retry history is read (metrics.count_retried_status)."""
+
+    def __init__(self, history):
+        self.retries = Retry(total=0, history=tuple(history)) if history else None
+
+class Http2Response:
+    """The parts of requests.Response the app uses, over a streamed httpx response."""
+
+    def __init__(self, response, history, elapsed):
+        self._response = response
+        self._content = None
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.url = str(response.url)
+        self.http_version = response.http_version
+        self.elapsed = elapsed
+        self.raw = _Raw(history)
+
+    @property
+    def content(self):
+        if self._content is None:
+            try:
+                self._content = self._response.read()
+            except httpx.HTTPError as e:
+                raise _to_requests_error(e) from e
+        return self._content
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+    def iter_content(self, chunk_size=1):
+        try:
+            yield from self._response.iter_bytes(chunk_size)
+        except httpx.HTTPError as e:
+            raise _to_requests_error(e) from e
+
+    def close(self):
+        self._response.close()
+
+    def abort(self):
+        """Called from another thread: reset just this stream, not the shared connection."""
+        threading.Thread(target=self.close, daemon=True).start()
+
+class Http2Session:
+    """
+    requests.Session look-alike on an httpx client with HTTP/2 enabled.
+    HTTP/2 is negotiated per host over TLS (ALPN) with HTTP/1.1 as the
+    fallback; prior_knowledge speaks HTTP/2 straight away, which plain
+    http:// test servers need. 429/5xx are retried like urllib3's Retry.
+    """
+
+    def __init__(self, stats, retries, backoff, prior_knowledge=False):
+        self.stats = stats
+        self.retries = retries
+        self.backoff = backoff
+        self.client = httpx.Client(http2=True, http1=not prior_knowledge,
+                                   limits=httpx.Limits(max_connections=None, max_keepalive_connections=None))
+
+    def _trace(self, event, info):
+        if event == "connection.connect_tcp.complete":
+            self.stats.count("connections")
+
+    def request(self, method, url, params=None, auth=None, headers=None, timeout=None, stream=False, allow_redirects=True):
+        self.stats.count("requests")
+        history = []
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            request = self.client.build_request(method, url, params=params, headers=headers,
+                                                timeout=_httpx_timeout(timeout), extensions={"trace": self._trace})
+            try:
+                response = self.client.send(request, auth=auth, stream=True, follow_redirects=allow_redirects)
+            except httpx.HTTPError as e:
+                if attempt >= self.retries:
+                    raise _to_requests_error(e) from e
+                attempt += 1
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+                continue
+            elapsed = timedelta(seconds=time.perf_counter() - start)
+            if response.status_code in RETRY_STATUSES and attempt < self.retries:
+                history.append(RequestHistory(method, url, None, response.status_code, None))
+                retry_after = response.headers.get("retry-after", "")
+                response.close()
+                attempt += 1
+                time.sleep(float(retry_after) if retry_after.isdigit() else self.backoff * 2 ** (attempt - 1))
+                continue
+            break
+
+        self.stats.count_version(response.http_version)
+        wrapped = Http2Response(response, history, elapsed)
+        if not stream:
+            try:
+                wrapped.content
+            finally:
+                response.close()
+        return wrapped
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault("allow_redirects", False)
+        return self.request("HEAD", url, **kwargs)
+
+    def resize(self, maxsize):
+        pass # Requests to a host share one connection; nothing to size
+
+    def close(self):
+        self.client.close()
+
+class Transport:
+    def __init__(self, pools=POOLS):
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.adapters = {}
+        self.stats = {}
+        self.timeouts = {}
+        self.sizes = {}
+        for name, spec in pools.items():
+            stats = PoolStats(name)
+            retries = Retry(total=spec["retries"], backoff_factor=spec["backoff"], status_forcelist=RETRY_STATUSES)
+            adapter = _CountingAdapter(stats, DEFAULT_POOL_SIZE, retries)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self.sessions[name] = session
+            self.adapters[name] = adapter
+            self.stats[name] = stats
+            self.timeouts[name] = spec["timeout"]
+            self.sizes[name] = DEFAULT_POOL_SIZE
+
+    def enable_http2(self, pools=("api", "files", "previews"), prior_knowledge=False):
+        """
+        Switch pools to HTTP/2. Sessions already handed out keep their old
+        transport, so call this before creating clients.
+        Returns False (staying on HTTP/1.1) if httpx or h2 isn't installed.
+        """
+        if httpx is None:
+            print("HTTP/2 needs the httpx package (pip install httpx[http2]); staying on HTTP/1.1")
+            return False
+        with self.lock:
+            try:
+                for name in pools:
+                    spec = POOLS[name]
+                    session = Http2Session(self.stats[name], spec["retries"], spec["backoff"], prior_knowledge)
+                    self.sessions[name] = session
+                    self.adapters[name] = session
+            except ImportError as e:
+                print(f"HTTP/2 unavailable ({e}); staying on HTTP/1.1")
+                return False
+        return True
+
+    def apply_settings(self, settings):
+        if settings.get("http2"):
+            self.enable_http2()
+
+    def session(self, pool):
+        return self.sessions[pool]
+
+    def timeout(self, pool):
+        return self.timeouts[pool]
+
+    def get(self, pool, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeouts[pool])
+        return self.sessions[pool].get(url, **kwargs)
+
+    def ensure_pool_size(self, pool, size):
+        """Grow pool so it can keep size connections per host open. Never shrinks."""
+        with self.lock:
+            if size <= self.sizes[pool]:
+                return
+            self.sizes[pool] = size
+            self.adapters[pool].resize(size)
+
+    def warmup(self, pool, url, connections=1):
+        """
+        Resolve url's host and open connections (TCP + TLS) to it in the
+        background, so the first real requests don't pay for the handshakes.
+        """
+        def connect():
+            try:
+                self.sessions[pool].head(url, timeout=self.timeouts[pool], allow_redirects=False)
+            except requests.exceptions.RequestException as e:
+                print(f"Warmup of {url} failed: {e}")
+
+        def run():
+            parts = urlsplit(url)
+            try:
+                socket.getaddrinfo(parts.hostname, parts.port or (443 if parts.scheme == "https" else 80))
+            except OSError as e:
+                print(f"Warmup of {url} failed: {e}")
+                return
+            threads = [threading.Thread(target=connect, daemon=True) for _ in range(connections)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        thread = threading.Thread(target=run, name=f"warmup-{pool}", daemon=True)
+        thread.start()
+        return thread
+
+    def report(self):
+        """{pool: {"size", "requests", "connections", "reuse", "versions"}}"""
+        return {name: {"size": self.sizes[name], "requests": s.requests, "connections": s.connections,
+                       "reuse": round(s.reuse_ratio(), 3), "versions": dict(s.versions)}
+                for name, s in self.stats.items()}
+
+# One transport per process; clients share its pools
+TRANSPORT = Transport()
@@ -0,0 +1,198 @@
+import os
+import re
+import json
+import time
+import random
+import threading
+from danbooru_api import DanbooruClient
+from downloader import DownloadManager
+from resume_manager import ResumeManager
+from security import SecurityManager
+from sync_engine import SyncEngine
+from config import load_settings
+from metrics import start_metrics_server, WATCH_POLLS, WATCH_LAST_POLL
+from transport import TRANSPORT
+
+def load_watch_list(path, default_root):
+    """
+    Read saved queries, one per line: "tags" or "tags | folder".
+    Blank lines and lines starting with # are ignored.
+    Queries without a folder go to <default_root>/<tags>.
+    """
+    entries = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if "|" in line:
+                tags, folder = [part.strip() for part in line.split("|", 1)]
+            else:
+                tags, folder = line, ""
+            if not folder:
+                safe_name = re.sub(r'[<>:"/\\|?*]+', "_", tags).strip(" .") or "query"
+                folder = os.path.join(default_root, safe_name)
+            entries.append({"tags": tags, "folder": folder})
+    return entries
+
+class WatchDaemon:
+    """
+    Keeps a list of saved queries mirrored by polling them on a schedule.
+
+    Each poll first asks for the newest post only (with If-None-Match when the
+    server gave us an ETag) and runs the SyncEngine only if something newer
+    than the stored top_id exists. Polls are spread over the interval with
+    jitter and never fire closer than min_gap seconds apart.
+    """
+
+    def __init__(self, api, downloader, security, entries, interval=3600, jitter=0.2, min_gap=2.0, log_path=None):
+        self.api = api
+        self.downloader = downloader
+        self.security = security
+        self.entries = entries
+        self.interval = interval
+        self.jitter = jitter
+        self.min_gap = min_gap
+        self.log_path = log_path
+        self.etags = {}
+        self.stop_event = threading.Event()
+
+        # Stagger the first round so all queries don't fire at once
+        now = time.time()
+        spacing = interval / max(1, len(entries))
+        for i, entry in enumerate(entries):
+            entry["next_due"] = now + i * spacing * random.uniform(0.5, 1.0)
+            entry["slot"] = str(i) # metrics label: the entry's place in the watch list, not its query
+
+    def _next_delay(self):
+        return self.interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def poll(self, entry):
+        tags = entry["tags"]
+        folder = entry["folder"]
+        started = time.time()
+        calls_before = self.api.request_count
+        api_bytes_before = self.api.bytes_received
+        dl_bytes_before = self.downloader.bytes_downloaded
+        files_before = self.downloader.files_downloaded
+        linked_before = self.downloader.files_linked
+        saved_before = self.downloader.bytes_saved
+
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        resume_mgr = ResumeManager(folder, self.security)
+        state = resume_mgr.get_state()
+
+        result = "synced"
+        needs_sync = True
+        if state.get("is_complete") and state.get("top_id"):
+            newest_id, etag, not_modified = self.api.probe_newest_id(tags, self.etags.get(tags))
+            if etag:
+                self.etags[tags] = etag
+            if not_modified or (newest_id is not None and newest_id <= state["top_id"]):
+                needs_sync = False
+                result = "unchanged"
+            elif newest_id is None:
+                needs_sync = False
+                result = "probe_failed"
+
+        if needs_sync:
+            self.downloader.stop_event.clear()
+            engine = SyncEngine(self.api, self.downloader, folder, resume_mgr)
+            ok = engine.run(tags, callbacks={'on_error': lambda err: print(f"[watch] {tags}: {err}")})
+            if not ok:
+                result = "incomplete"
+
+        record = {
+            "query": tags,
+            "folder": folder,
+            "started_at": started,
+            "duration": round(time.time() - started, 3),
+            "result": result,
+            "api_calls": self.api.request_count - calls_before,
+            "api_bytes": self.api.bytes_received - api_bytes_before,
+            "download_bytes": self.downloader.bytes_downloaded - dl_bytes_before,
+            "files": self.downloader.files_downloaded - files_before,
+            "files_linked": self.downloader.files_linked - linked_before,
+            "bytes_saved": self.downloader.bytes_saved - saved_before,
+        }
+        WATCH_POLLS.inc(result=result)
+        WATCH_LAST_POLL.set(started, slot=entry["slot"])
+        self._log(record)
+        return record
+
+    def _log(self, record):
+        print(f"[watch] {record['query']}: {record['result']} | "
+              f"{record['api_calls']} API calls, {record['api_bytes']:,} B metadata, "
+              f"{record['files']} files, {record['download_bytes']:,} B")
+        if self.log_path:
+            try:
+                with open(self.log_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            except Exception as e:
+                print(f"Failed to write watch log: {e}")
+
+    def run_once(self):
+        for entry in self.entries:
+            if self.stop_event.is_set(): break
+            self.poll(entry)
+            self.stop_event.wait(self.min_gap)
+
+    def run_forever(self):
+        while not self.stop_event.is_set():
+            entry = min(self.entries, key=lambda e: e["next_due"])
+            delay = entry["next_due"] - time.time()
+            if delay > 0 and self.stop_event.wait(delay):
+                break
+            try:
+                self.poll(entry)
+            except Exception as e:
+                print(f"[watch] Poll failed for '{entry['tags']}': {e}")
+            entry["next_due"] = time.time() + self._next_delay()
+            self.stop_event.wait(self.min_gap)
+
+    def stop(self):
+        self.stop_event.set()
+        self.downloader.stop_all()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Poll saved queries and download new posts")
+    parser.add_argument("watch_list", help="Text file with one query per line (\"tags | folder\")")
+    parser.add_argument("--interval", type=float, default=3600, help="Seconds between polls of the same query")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Random spread applied to the interval (0.2 = +/-20%%)")
+    parser.add_argument("--min-gap", type=float, default=2.0, help="Minimum seconds between two polls")
+    parser.add_argument("--log", default="watch_log.jsonl", help="JSONL file receiving one cost record per poll")
+    parser.add_argument("--once", action="store_true", help="Poll every query once and exit")
+    parser.add_argument("--bandwidth-limit", type=int, metavar="KBPS", help="Cap total download speed in KB/s (0 = off)")
+    parser.add_argument("--metrics-port", type=int, help="Serve Prometheus metrics on this port")
+    parser.add_argument("--metrics-host", default="127.0.0.1", help="Address the metrics endpoint binds to")
+    args = parser.parse_args()
+
+    security = SecurityManager()
+    settings = load_settings(security)
+    TRANSPORT.apply_settings(settings)
+    metrics_port = args.metrics_port if args.metrics_port is not None else settings["metrics_port"]
+    if metrics_port:
+        start_metrics_server(metrics_port, args.metrics_host)
+    api = DanbooruClient(settings["username"], settings["apikey"], settings["username"], settings["email"],
+                         rate_limit=settings["api_rate"])
+    bandwidth_limit = args.bandwidth_limit if args.bandwidth_limit is not None else settings["bandwidth_limit"]
+    downloader = DownloadManager(max_workers=settings["max_workers"], bandwidth_limit=bandwidth_limit * 1024,
+                                 auto_concurrency=settings["auto_concurrency"])
+    downloader.apply_settings(settings)
+    entries = load_watch_list(args.watch_list, settings["download_path"])
+    if settings["safe_search"]:
+        for entry in entries:
+            entry["tags"] += " is:sfw"
+
+    daemon = WatchDaemon(api, downloader, security, entries, args.interval, args.jitter, args.min_gap, args.log)
+    try:
+        if args.once:
+            daemon.run_once()
+        else:
+            daemon.run_forever()
+    except KeyboardInterrupt:
+        daemon.stop()
+    finally:
+        downloader.close()